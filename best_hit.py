@@ -1,116 +1,245 @@
 #! /usr/bin/env python3
 
+import os
 import sys
 from argparse import ArgumentParser
+from itertools import chain
+from multiprocessing import Pool
 
 import pymysql
 
-from phylome.blast_parser import parse_blast_file_to_hits, iterate_by_query
-from phylome.taxonomy import get_supertaxon_from_list
+from phylome.accessions import AccessionIndex, get_taxids, prefetch_taxids
+from phylome.blast_parser import parse_blast_file_to_hits, iterate_by_query, \
+    iterate_blast_shard, pool_shards, BlastCache, tables_to_hits
+from phylome.taxonomy import SupertaxonCache, TaxonomyTree
 
 
-def cached_supertaxon(taxon, supertaxa, cursor, cache={}):
+def classify_query(hit_list, acc2taxid, taxonomy, cache, best_only=False):
     """
-    Get supertaxon from a list.
-    Takes a taxon, a list of (potential) supertaxa and a pymysql cursor.
-    If a taxon is a descendant of one of these supertaxa, returns that
-    supertaxon, otherwise returns None.
-    This function is cached and stores all the requests made during this
-    program's run. Assumes that it wouldn't be called with different supertaxa
-    lists during a single run.
+    Classify a single query by its best Archaeplastida hit.
+    Nothing is printed here; instead, a list of (destination, text) events is
+    returned in the order they should be written. Destination is 'stdout',
+    'stderr' or one of the 'red', 'green' and 'none' categories, in which
+    case the text is a query ID.
+    :param hit_list: list of BlastHits for a single query
+    :param acc2taxid: dict of versionless accessions to taxids
+    :param taxonomy: pymysql cursor or TaxonomyTree
+    :param cache: SupertaxonCache
+    :param best_only: bool. Consider only the very best hit
+    :return: list
+    """
+    events = []
+    l = sorted(hit_list, key=lambda x: min([hsp.evalue for hsp in x.hsps]))
+    for hit in (l[:1] if best_only else l):
+        try:
+            taxon = acc2taxid[hit.hit_id.split('.')[0]]
+        except KeyError:
+            events.append(('stdout',
+                           'Unknown sequence ID {}'.format(hit.hit_id)))
+            continue
+        try:
+            supertaxon = cache.get(taxon, [2763, 33090], taxonomy)
+        except ValueError:
+            events.append(('stderr', 'Unknown ID {}'.format(taxon)))
+            continue
+        if supertaxon:
+            events.append(('stdout', '{} {}'.format(hit.query_id, supertaxon)))
+            if supertaxon == 2763:
+                events.append(('red', hit.query_id))
+            elif supertaxon == 33090:
+                events.append(('green', hit.query_id))
+            break
+        else:
+            events.append(('none', hit.query_id))
+    return events
+
+
+def write_events(events, handles, best):
+    """
+    Write the events produced by `classify_query`.
+    Category events go to the respective handle and `best` list.
+    :param events: list
+    :param handles: dict of category to filehandle
+    :param best: dict of category to list of query IDs
+    :return:
+    """
+    for destination, text in events:
+        if destination == 'stdout':
+            print(text)
+        elif destination == 'stderr':
+            print(text, file=sys.stderr)
+        else:
+            print(text, file=handles[destination])
+            handles[destination].flush()
+            best[destination].append(text)
+
+
+def classify_groups(query_groups):
+    """
+    Look up taxids for query groups and classify them.
+    Yields (query_id, events, taxa) for every group, where taxa are the
+    known taxids of all its hits (for LCA).
+    :param query_groups: iterable of hit lists
     :return:
     """
-    if taxon not in cache:
-        cache[taxon] = get_supertaxon_from_list(taxon, supertaxa,
-                                                cursor)
-    return cache[taxon]
-    
-    
+    global args, accessions, taxonomy, supertaxon_cache
+    if args.prefetch:
+        # A new connection for the background thread, if it needs one at all
+        if args.a:
+            source_factory = lambda: accessions
+        else:
+            source_factory = lambda: pymysql.connect(user=args.u, host=args.o,
+                                                     password=args.p,
+                                                     database=args.d).cursor()
+        groups = prefetch_taxids(query_groups, source_factory,
+                                 accessions_of=lambda g: [x.hit_id for x in g],
+                                 batch_size=args.prefetch,
+                                 lookahead=args.lookahead)
+    else:
+        groups = ((hit_list,
+                   get_taxids([x.hit_id for x in hit_list], accessions))
+                  for hit_list in query_groups)
+    for hit_list, acc2taxid in groups:
+        taxa = []
+        if args.lca:
+            for hit in hit_list:
+                taxon = acc2taxid.get(hit.hit_id.split('.')[0])
+                if taxon is not None:
+                    taxa.append(taxon)
+        yield hit_list[0].query_id, \
+            classify_query(hit_list, acc2taxid, taxonomy, supertaxon_cache,
+                           args.best), taxa
+
+
+def init_worker():
+    """
+    Open a separate database connection in every worker process; the one
+    inherited from the parent can't be shared.
+    :return:
+    """
+    global cursor, taxonomy, accessions
+    if cursor is not None:
+        cursor = pymysql.connect(user=args.u, host=args.o, password=args.p,
+                                 database=args.d).cursor()
+        if not isinstance(taxonomy, TaxonomyTree):
+            taxonomy = cursor
+        if not isinstance(accessions, AccessionIndex):
+            accessions = cursor
+
+
+def process_shard(shard):
+    """
+    Classify all queries from a byte range of the BLAST file, or a row range
+    of the BLAST cache. Hits are read one query at a time; only the (small)
+    classification results of the shard are collected.
+    :param shard: (start, end) tuple
+    :return: list of `classify_groups` results
+    """
+    global args
+    if os.path.isdir(args.f):
+        tables = BlastCache(args.f).tables(start=shard[0], end=shard[1])
+        return list(classify_groups(iterate_by_query(tables_to_hits(tables))))
+    return list(classify_groups(iterate_blast_shard(args.f, *shard)))
+
+
 parser = ArgumentParser('Return best Archaeplastida hit')
-parser.add_argument('-f', type=str, help='BLAST TSV file')
+parser.add_argument('-f', type=str, help='BLAST TSV file or BLAST cache directory')
 parser.add_argument('-d', type=str, help='mySQL DB name')
 parser.add_argument('-o', type=str, help='mySQL host')
 parser.add_argument('-u', type=str, help='mySQL username')
 parser.add_argument('-p', type=str, help='mySQL password')
 parser.add_argument('--best', action='store_true',
                 help='Store only if the Archaeplastida hit is the very best')
+parser.add_argument('-m', action='store_true',
+                    help='Load the entire taxonomy in memory')
+parser.add_argument('--taxonomy', type=str,
+                    help='Taxonomy directory made by build_taxonomy.py')
+parser.add_argument('-a', type=str,
+                    help='Accession index made by build_accessions.py, used instead of acc2taxid table')
+parser.add_argument('--lca', action='store_true',
+                    help='Write LCA of all hits for every query to {f}.lca. Requires -m or --taxonomy')
+parser.add_argument('--prefetch', type=int, default=0,
+                    help='Look up taxids for this many queries at once in a background thread. Default 0 (no prefetching)')
+parser.add_argument('--lookahead', type=int, default=4,
+                    help='Max number of prefetched batches in memory')
+parser.add_argument('--cache', type=str,
+                    help='Supertaxon cache file, loaded if exists and saved at exit. Only updated with a single worker')
+parser.add_argument('--cache_size', type=int, default=2**20,
+                    help='Max number of cached supertaxa')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of worker processes, each with its own connection. Requires an uncompressed BLAST file or a BLAST cache')
+parser.add_argument('--shard_size', type=int, default=64,
+                    help='Size of the BLAST file pieces processed by workers, in MB. Default 64')
 args = parser.parse_args()
+if args.lca and not (args.m or args.taxonomy):
+    parser.error('--lca requires -m or --taxonomy')
 
-cnx = pymysql.connect(user=args.u, host=args.o, password=args.p,
-                                  database=args.d)
-cursor = cnx.cursor()
-taxid_request = 'select * from acc2taxid where accession in ({});'
+# With both local indices the database is not needed at all
+cursor = None
+if not (args.a and args.taxonomy):
+    cnx = pymysql.connect(user=args.u, host=args.o, password=args.p,
+                          database=args.d)
+    cursor = cnx.cursor()
+if args.taxonomy:
+    taxonomy = TaxonomyTree.load(args.taxonomy)
+elif args.m:
+    taxonomy = TaxonomyTree.from_cursor(cursor).build_index()
+else:
+    taxonomy = cursor
+accessions = AccessionIndex(args.a) if args.a else cursor
+# Workers get their own copy of the cache when forked
+supertaxon_cache = SupertaxonCache(args.cache_size, args.cache)
 
 # Opening handles
-red_handle = open(args.f + '.reds', mode='w')
-green_handle = open(args.f + '.greens', mode='w')
-none_handle = open(args.f + '.none', mode='w')
+handles = {'red': open(args.f + '.reds', mode='w'),
+           'green': open(args.f + '.greens', mode='w'),
+           'none': open(args.f + '.none', mode='w')}
 best = {'red': [], 'green': [], 'none': []}
-for hit_list in iterate_by_query(parse_blast_file_to_hits(filename=args.f)):
-    # Loading the relevant piece of acc2taxid
-    r = taxid_request.format(', '.join(['"'+x.hit_id.split('.')[0]+'"' for x in hit_list]))
-    cursor.execute(r)
-    result = cursor.fetchall()
-    acc2taxid = {}
-    for x in result:
-        acc2taxid[x[0]] = x[1]
-    l = sorted(hit_list, key=lambda x: min([hsp.evalue for hsp in x.hsps]))
-    if args.best:
-        hit = l[0]
-        try:
-            taxon = acc2taxid[hit.hit_id.split('.')[0]]
-        except KeyError:
-            print('Unknown sequence ID {}'.format(hit.hit_id))
-            continue
-        try:
-            supertaxon = cached_supertaxon(taxon, [2763, 33090], cursor)
-        except ValueError:
-            print('Unknown ID {}'.format(taxon), file=sys.stderr)
-            continue
-        if supertaxon:
-            print(hit.query_id, supertaxon)
-            if supertaxon == 2763:
-                print(hit.query_id, file=red_handle)
-                red_handle.flush()
-                best['red'].append(hit.query_id)
-            elif supertaxon == 33090:
-                best['green'].append(hit.query_id)
-                print(hit.query_id, file=green_handle)
-                green_handle.flush()
-        else:
-            best['none'].append(hit.query_id)
-            print(hit.query_id, file=none_handle)
-            none_handle.flush()
+# Taxids of all hits and their query numbers, LCAs are calculated in bulk
+lca_queries = []
+lca_taxa = []
+lca_groups = []
+if args.workers > 1:
+    # Shards of a fixed size, so that their number grows with the file.
+    # Shards are merged in the file order, so the output is the same as with
+    # a single worker
+    shard_size = args.shard_size * 2**20
+    if os.path.isdir(args.f):
+        cache = BlastCache(args.f)
+        # Cache rows are counted as about 100 bytes of BLAST text each
+        shards = cache.shards(max(args.workers,
+                                  int(cache.groups[-1]) * 100 // shard_size + 1))
     else:
-        for hit in l:
-            try:
-                taxon = acc2taxid[hit.hit_id.split('.')[0]]
-            except KeyError:
-                print('Unknown sequence ID {}'.format(hit.hit_id))
-                continue
-            try:
-                supertaxon = cached_supertaxon(taxon, [2763, 33090], cursor)
-            except ValueError:
-                print('Unknown ID {}'.format(taxon), file=sys.stderr)
-                continue
-            if supertaxon:
-                print(hit.query_id, supertaxon)
-                if supertaxon == 2763:
-                    print(hit.query_id, file=red_handle)
-                    red_handle.flush()
-                    best['red'].append(hit.query_id)
-                elif supertaxon == 33090:
-                    best['green'].append(hit.query_id)
-                    print(hit.query_id, file=green_handle)
-                    green_handle.flush()
-                break
-            else:
-                best['none'].append(hit.query_id)
-                print(hit.query_id, file=none_handle)
-                none_handle.flush()
+        shards = pool_shards(args.f, args.workers, shard_size)
+    pool = Pool(processes=args.workers, initializer=init_worker)
+    results = chain.from_iterable(pool.imap(process_shard, shards))
+else:
+    pool = None
+    results = classify_groups(
+        iterate_by_query(parse_blast_file_to_hits(filename=args.f)))
+for query_id, events, taxa in results:
+    if args.lca:
+        lca_queries.append(query_id)
+        lca_taxa += taxa
+        lca_groups += [len(lca_queries) - 1] * len(taxa)
+    write_events(events, handles, best)
+if pool is not None:
+    pool.close()
+    pool.join()
 
 print('Red\t{}\nGreen\t{}\nNone\t{}'.format(len(best['red']),
                                             len(best['green']),
                                             len(best['none'])))
-for handle in (red_handle, green_handle, none_handle):
+for handle in handles.values():
     handle.close()
+# Workers' caches are gone with them
+if args.workers == 1:
+    print('Supertaxon cache: {}'.format(supertaxon_cache.stats()),
+          file=sys.stderr)
+    if args.cache:
+        supertaxon_cache.save(args.cache)
+if args.lca:
+    lcas = taxonomy.group_lca(lca_taxa, lca_groups, len(lca_queries))
+    with open(args.f + '.lca', mode='w') as lca_handle:
+        for query_id, lca in zip(lca_queries, lcas):
+            print('{}\t{}'.format(query_id, lca), file=lca_handle)
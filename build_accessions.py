@@ -0,0 +1,16 @@
+#! /usr/bin/env python3
+
+from argparse import ArgumentParser
+from sys import stderr
+
+from phylome.accessions import build_accession_index, AccessionIndex
+
+parser = ArgumentParser(description='Build a memory-mappable accession to taxid index')
+parser.add_argument('-i', type=str,
+                    help='NCBI accession2taxid file (may be compressed)')
+parser.add_argument('-o', type=str, help='Output directory')
+args = parser.parse_args()
+
+build_accession_index(args.i, args.o)
+print('Indexed {} accessions'.format(len(AccessionIndex(args.o))),
+      file=stderr)
@@ -0,0 +1,16 @@
+#! /usr/bin/env python3
+
+from argparse import ArgumentParser
+from sys import stderr
+
+from phylome.taxonomy import TaxonomyTree
+
+parser = ArgumentParser(description='Build a memory-mappable taxonomy from NCBI taxdump')
+parser.add_argument('-n', type=str, help='nodes.dmp')
+parser.add_argument('-m', type=str, help='names.dmp (optional)')
+parser.add_argument('-o', type=str, help='Output directory')
+args = parser.parse_args()
+
+tree = TaxonomyTree.from_taxdump(args.n, args.m).build_index()
+tree.save(args.o)
+print('Saved {} taxa'.format(int((tree.parent > 0).sum())), file=stderr)
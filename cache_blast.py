@@ -0,0 +1,17 @@
+#! /usr/bin/env python3
+
+from argparse import ArgumentParser
+from sys import stderr
+
+from phylome.blast_parser import write_blast_cache, BlastCache
+
+parser = ArgumentParser(description='Convert BLAST TSV into a binary cache')
+parser.add_argument('-b', type=str, help='BLAST TSV file (may be compressed)')
+parser.add_argument('-o', type=str, help='Cache directory to be created')
+args = parser.parse_args()
+
+write_blast_cache(args.b, args.o)
+cache = BlastCache(args.o)
+print('Cached {} HSPs of {} queries'.format(len(cache.columns['evalue']),
+                                            len(cache)),
+      file=stderr, flush=True)
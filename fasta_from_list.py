@@ -4,29 +4,11 @@ import os
 import sys
 from argparse import ArgumentParser
 
-from Bio import SeqIO
-
-from phylome.blast_parser import parse_blast_file_to_hits
-
-
-def batches(d, batch_size):
-    """
-    Yields subdicts of a given size (so many key/value pairs)
-    :param dict:
-    :param batch_size:
-    :return:
-    """
-    r = {}
-    c = 0
-    for key in d.keys():
-        r[key] = d[key]
-        c += 1
-        if c == batch_size:
-            yield r
-            r = {}
-            c = 0
-    yield r
-    return
+from phylome.blast_parser import parse_blast_file_to_hits, BlastIndex, \
+    build_query_index, query_index_is_current
+from phylome.clusters import ClusterStore
+from phylome.fasta import Demultiplexer, demultiplex_fasta
+from phylome.fasta_index import FastaIndex
 
 
 parser = ArgumentParser(description='Generate a lot of FASTAs using list file')
@@ -48,74 +30,124 @@ parser.add_argument('--min_species', type=int, default=10,
                     help='Minimum species count in cluster')
 parser.add_argument('--evalue', type=float, default=1e-30,
                     help='Evalue cutoff for external sequences')
-parser.add_argument('--batch', type=int, help='Batch size', default=1000)
+parser.add_argument('--batch', type=int, default=1000,
+                    help='Maximum number of simultaneously open output files')
+parser.add_argument('--index', action='store_true',
+                    help='Use a query index of the BLAST file and FASTA indices (built if absent)')
+parser.add_argument('--clusters', type=str,
+                    help='Directory with the cluster store. It\'s loaded instead of the list file if it exists (and was made with the same -l, --min, --max and --min_species), and saved there otherwise')
 args = parser.parse_args()
 
-clusters = {}
-counter = 0
-cluster_mappings = {}
+
+def accepted_clusters(filename):
+    """
+    Yield ID lists of the clusters that pass size and species filters.
+    Assumes list to consist of tab-separated ID lists, one cluster in each
+    line.
+    :param filename: str
+    :return:
+    """
+    for line in open(filename):
+        ids = line.rstrip().split('\t')
+        species = len({x.split('|')[0] for x in ids})
+        if args.min <= len(ids) <= args.max and species >= args.min_species:
+            yield ids
+
+
+def hit_pairs():
+    """
+    Yield (cluster, hit ID) for every BLAST hit of the clustered sequences.
+    A query that is in several clusters is assigned to the last of them.
+    :return:
+    """
+    if args.index:
+        if not query_index_is_current(args.b):
+            print('Building BLAST query index', flush=True, file=sys.stderr)
+            build_query_index(args.b)
+        # HSPs above the cutoff are dropped by the parser, so any hit left
+        # has at least one good HSP
+        with BlastIndex(args.b) as blast_index:
+            for query, hits in blast_index.iterate_queries(
+                    clusters, evalue_cutoff=args.evalue):
+                cluster = clusters.cluster_of(query)
+                for hit in hits:
+                    yield cluster, hit.hit_id
+    else:
+        for hit in parse_blast_file_to_hits(args.b, query_ids=clusters,
+                                            evalue_cutoff=args.evalue):
+            yield clusters.cluster_of(hit.query_id), hit.hit_id
+
+
+# Saved clusters are only reused with the same list file and filters
+parameters = {'list': os.path.abspath(args.l) if args.l else None,
+              'min': args.min, 'max': args.max,
+              'min_species': args.min_species}
+if args.clusters and os.path.exists(args.clusters):
+    print('Loading clusters from {}'.format(args.clusters), flush=True,
+          file=sys.stderr)
+    try:
+        clusters = ClusterStore.load(args.clusters, parameters)
+    except ValueError as e:
+        parser.error(str(e))
+else:
+    print('Loading clusters from {}'.format(args.l), flush=True,
+          file=sys.stderr)
+    clusters = ClusterStore.from_lists(accepted_clusters(args.l))
+    if args.clusters:
+        clusters.save(args.clusters, parameters)
 os.mkdir(args.d)
-# Assumes list to consist of tab-separated ID lists, one cluster in each line
-print('Loading clusters from {}'.format(args.l), flush=True, file=sys.stderr)
-for line in open(args.l):
-    ids = line.rstrip().split('\t')
-    species = len({x.split('|')[0] for x in ids})
-    if args.min <= len(ids) <= args.max and species >= args.min_species:
-        clusters[counter] = set(ids)
-        for seqid in ids:
-            cluster_mappings[seqid] = counter
-        counter += 1
-print('Loaded {} clusters'.format(counter), flush=True, file=sys.stderr)
+print('Loaded {} clusters'.format(len(clusters)), flush=True, file=sys.stderr)
 
-if args.f:
+if args.f and args.index:
+    # Raw records are copied cluster by cluster, without parsing
+    print('Copying diatom sequences from {}'.format(args.f), flush=True,
+          file=sys.stderr)
+    with FastaIndex(args.f) as fasta_index:
+        for index in range(len(clusters)):
+            with open('{0}/{1}{2}.diatoms.fasta'.format(args.d, args.o, index),
+                      mode='wb') as handle:
+                fasta_index.write_records(clusters.members_of(index), handle)
+    print('Written diatom sequences', file=sys.stderr, flush=True)
+elif args.f:
     # This part can be safely skipped if no FASTA is supplied
-    print('Loading diatom FASTAs in batches of {}'.format(args.batch),
-          flush=True, file=sys.stderr)
-    for cluster_batch in batches(clusters, args.batch):
-        # Creating output filehandles
-        diatom_filehandles = {x: open('{0}/{1}{2}.diatoms.fasta'.format(args.d,
-                                                                        args.o,
-                                                                        x),
-                                      mode='w+')
-                              for x in cluster_batch.keys()}
-        for record in SeqIO.parse(args.f, 'fasta'):
-            for index, cluster in cluster_batch.items():
-                if record.id in cluster:
-                    SeqIO.write(record, diatom_filehandles[index], 'fasta')
-        for handle in diatom_filehandles.values():
-            handle.close()
-        print('Written a batch', file=sys.stderr, flush=True)
+    print('Splitting diatom FASTA {}'.format(args.f), flush=True,
+          file=sys.stderr)
+    filenames = ['{0}/{1}{2}.diatoms.fasta'.format(args.d, args.o, x)
+                 for x in range(len(clusters))]
+    with Demultiplexer(max_handles=args.batch) as demultiplexer:
+        for filename in filenames:
+            demultiplexer.create(filename)
+        demultiplex_fasta(args.f, clusters.routes(filenames), demultiplexer)
+    print('Written diatom sequences', file=sys.stderr, flush=True)
 
 if not args.b:
     # No external sequences
     quit()
-    
+
 # Assembling BLAST hit lists
 print('Parsing BLAST file {}'.format(args.b), flush=True, file=sys.stderr)
-other_seqs = {x: set() for x in clusters.keys()}
-for hit in parse_blast_file_to_hits(args.b):
-    if hit.query_id in cluster_mappings and \
-                    min((x.evalue for x in hit.hsps)) < args.evalue:
-        other_seqs[cluster_mappings[hit.query_id]].add(hit.hit_id)
+other_seqs = ClusterStore.from_pairs(hit_pairs(), len(clusters))
 
-print('Parsing external FASTA {}'.format(args.db), flush=True, file=sys.stderr)
 # Sequences absent from the FASTA, but present in BLAST, are silently ignored
-for batch in batches(other_seqs, args.batch):
-    external_filehandles = {x: open('{0}/{1}{2}.external.fasta'.format(args.d,
-                                                                       args.o,
-                                                                       x),
-                                    mode='w+')
-                          for x in batch.keys()}
-    cluster_cache = {}
-    for cluster_id, cluster in batch.items():
-        for item in cluster:
-            cluster_cache[item] = cluster_id
-    print('Batch size {} seqs'.format(len(cluster_cache)), file=sys.stderr,
+if args.index:
+    print('Copying external sequences from {}'.format(args.db), flush=True,
+          file=sys.stderr)
+    with FastaIndex(args.db) as fasta_index:
+        for cluster_id in range(len(other_seqs)):
+            with open('{0}/{1}{2}.external.fasta'.format(args.d, args.o,
+                                                         cluster_id),
+                      mode='wb') as handle:
+                fasta_index.write_records(other_seqs.members_of(cluster_id),
+                                          handle)
+    print('Done', flush=True, file=sys.stderr)
+    quit()
+print('Parsing external FASTA {}'.format(args.db), flush=True, file=sys.stderr)
+filenames = ['{0}/{1}{2}.external.fasta'.format(args.d, args.o, x)
+             for x in range(len(other_seqs))]
+with Demultiplexer(max_handles=args.batch) as demultiplexer:
+    for filename in filenames:
+        demultiplexer.create(filename)
+    print('{} external seqs'.format(len(other_seqs.ids)), file=sys.stderr,
           flush=True)
-    for record in SeqIO.parse(args.db, 'fasta'):
-        if record.id in cluster_cache:
-            SeqIO.write(record, external_filehandles[cluster_cache[record.id]], 'fasta')
-    for handle in external_filehandles.values():
-        handle.close()
-    print('Loaded a batch', file=sys.stderr, flush=True)
+    demultiplex_fasta(args.db, other_seqs.routes(filenames), demultiplexer)
 print('Done', flush=True, file=sys.stderr)
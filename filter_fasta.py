@@ -3,47 +3,78 @@
 import shutil
 import sys
 from argparse import ArgumentParser
+from functools import partial
+from itertools import count
+from multiprocessing import Pool
 from tempfile import NamedTemporaryFile
 
-from Bio import SeqIO
+from phylome.compressed import compression_type
+from phylome.fasta import read_fasta, write_fasta, filter_fasta_records
 
-parser = ArgumentParser(description='Filter aminoacid sequences in FASTA file by length and percentage of X\'es')
-parser.add_argument('-f', type=str, nargs='+', help='FASTA file(s)')
-parser.add_argument('-x', type=float, default=0.1,
-                    help='Maximum allowed percentage of X\'s')
-parser.add_argument('-l', type=int, help='Minimum allowed length. Default 100',
-                    default=100)
-parser.add_argument('-i', action='store_true',
-                    help='Filter in-place. Disabled by default')
-parser.add_argument('-v', action='store_true',
-                    help='Verbose output')
-args = parser.parse_args()
+
+def filter_file(fasta_file, min_length, max_x, in_place=False):
+    """
+    Filter a single FASTA file.
+    Returns a tuple of filename, record count and accepted record count.
+    :param fasta_file: str
+    :param min_length: int
+    :param max_x: float
+    :param in_place: bool. Replace the file instead of writing
+    `{fasta_file}.filtered`
+    :return:
+    """
+    #  Counter is advanced once for every record read
+    counter = count()
+    records = (record for record, _ in zip(read_fasta(fasta_file), counter))
+    with NamedTemporaryFile(mode='w+b') as output_handle:
+        accepted_record_count = write_fasta(
+            filter_fasta_records(records, min_length=min_length, max_x=max_x),
+            output_handle)
+        output_handle.flush()
+        if in_place:
+            shutil.copy(output_handle.name, fasta_file)
+        else:
+            dest = '{}.filtered'.format(fasta_file)
+            shutil.copy(output_handle.name, dest)
+    return fasta_file, next(counter), accepted_record_count
 
 
-for fasta_file in args.f:
-    with NamedTemporaryFile(mode='w+') as output_handle:
-        record_count = 0
-        accepted_record_count = 0
-        for record in SeqIO.parse(fasta_file, format='fasta'):
-            record_count += 1
-            if len(record) > args.l:
-                x_perc = (record.seq.count('X') + record.seq.count('x'))/len(record)
-                if x_perc < args.x:
-                    accepted_record_count += 1
-                    SeqIO.write(record, handle=output_handle, format='fasta')
-            if args.v and record_count % 10000 == 0:
-                sys.stderr.write('Accepted {0} out of {1} records ({2}%) from {3}\n'.\
-                    format(accepted_record_count, record_count,
-                    int(100*accepted_record_count/record_count), fasta_file))
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Filter aminoacid sequences in FASTA file by length and percentage of X\'es')
+    parser.add_argument('-f', type=str, nargs='+', help='FASTA file(s)')
+    parser.add_argument('-x', type=float, default=0.1,
+                        help='Maximum allowed percentage of X\'s')
+    parser.add_argument('-l', type=int, help='Minimum allowed length. Default 100',
+                        default=100)
+    parser.add_argument('-i', action='store_true',
+                        help='Filter in-place. Disabled by default. Not available for compressed files')
+    parser.add_argument('-t', type=int, default=1,
+                        help='Number of files processed in parallel. Default 1')
+    parser.add_argument('-v', action='store_true',
+                        help='Verbose output')
+    args = parser.parse_args()
+    if args.i:
+        compressed = [x for x in args.f if compression_type(x)]
+        if compressed:
+            #  Output is always uncompressed and can't replace these
+            parser.error('-i is not available for compressed files: {}'.format(
+                ', '.join(compressed)))
+
+    worker = partial(filter_file, min_length=args.l, max_x=args.x,
+                     in_place=args.i)
+    if args.t > 1:
+        pool = Pool(processes=args.t)
+        results = pool.imap(worker, args.f)
+    else:
+        pool = None
+        results = map(worker, args.f)
+    for fasta_file, record_count, accepted_record_count in results:
         if args.v:
             sys.stderr.write('Accepted {0} out of {1} records ({2}%) from {3}\n'.format(
                 accepted_record_count, record_count,
-                int(100*accepted_record_count/record_count), fasta_file
+                int(100*accepted_record_count/max(record_count, 1)), fasta_file
             ))
             sys.stderr.flush()
-        output_handle.flush()
-        if args.i:
-            shutil.copy(output_handle.name, fasta_file)
-        else:
-            dest = '{}.filtered'.format(fasta_file)
-            shutil.copy(output_handle.name, dest)
+    if pool is not None:
+        pool.close()
+        pool.join()
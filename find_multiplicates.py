@@ -1,53 +1,107 @@
 #! /usr/bin/env python3
 
+import os
 from argparse import ArgumentParser
+from functools import partial
 from sys import stderr
 
-from Bio import SeqIO
+from phylome.blast_parser import parse_blast_file_to_table, BlastCache, \
+    query_aligned_tables, map_blast_table_shards
+from phylome.fasta import read_fasta, write_fasta
+from phylome.fasta_index import FastaIndex
+from phylome.multiplicates import query_duplicate_fractions, \
+    query_sweep_fractions
 
-from phylome.blast_parser import parse_blast_file_to_hits, iterate_by_query
-from phylome.multiplicates import is_duplicate
 
-
-def duplicate_percentage(hit_iterable, overlap_cutoff, len_cutoff):
+def sweep(table_fractions, args):
     """
-    Return a percentage of duplicate hits in a list
-    :param hit_iterable:
+    Count duplicates for every combination of cutoffs and write them to
+    `{args.n}.sweep.tsv`. If `args.sweep_ids` is set, duplicate IDs for every
+    combination are written to `{args.n}.sweep_ids.tsv`, one line per query
+    and combination, with the cutoff values in the columns.
+    :param table_fractions: iterable of query_sweep_fractions results
+    :param args:
     :return:
     """
-    duplicate_count = 0
-    for hit in hit_iterable:
-        if is_duplicate(hit, overlap_cutoff=overlap_cutoff,
-                        len_cutoff=len_cutoff):
-            duplicate_count += 1
-    return duplicate_count/len(hit_iterable)
+    combinations = [(i, j, c) for i in range(len(args.o))
+                    for j in range(len(args.l)) for c in args.c]
+    counts = {x: 0 for x in combinations}
+    id_file = open('{}.sweep_ids.tsv'.format(args.n), mode='w') \
+        if args.sweep_ids else None
+    if id_file:
+        print('query\toverlap\tlength\tpercentage', file=id_file)
+    for query_fractions in table_fractions:
+        for query, fractions in query_fractions:
+            for i, j, c in combinations:
+                if fractions[i, j] >= c:
+                    counts[(i, j, c)] += 1
+                    if id_file:
+                        print(query, args.o[i], args.l[j], c, sep='\t',
+                              file=id_file)
+    if id_file:
+        id_file.close()
+    with open('{}.sweep.tsv'.format(args.n), mode='w') as sweep_file:
+        print('overlap\tlength\tpercentage\tduplicates', file=sweep_file)
+        for i, j, c in combinations:
+            print(args.o[i], args.l[j], c, counts[(i, j, c)], sep='\t',
+                  file=sweep_file)
 
 
 parser = ArgumentParser(description='Detect multiplicates based on BLAST hits')
 parser.add_argument('-b', type=str, help='BLAST TSV file')
 parser.add_argument('-f', type=str, default='',
                     help='FASTA file of queries')
-parser.add_argument('-o', type=float, default=0.5,
+parser.add_argument('-o', type=float, nargs='+', default=[0.5],
                     help='Overlap cutoff. Default 0.5')
-parser.add_argument('-l', type=int, default=50,
+parser.add_argument('-l', type=int, nargs='+', default=[50],
                     help='Length cutoff. Default 50')
-parser.add_argument('-c', type=float, default=0.5,
+parser.add_argument('-c', type=float, nargs='+', default=[0.5],
                     help='Duplicate hit percentage. Default 0.5')
 parser.add_argument('-n', type=str, default='multiples',
                     help='Output filename')
 parser.add_argument('-s', action='store_true',
         help='Print species statistics. Assumes FASTA headers to be species|ID')
+parser.add_argument('-t', type=int, default=1,
+                    help='Number of parser processes. Default 1')
+parser.add_argument('--sweep_ids', action='store_true',
+                    help='Write duplicate IDs for every cutoff combination')
+parser.add_argument('--index', action='store_true',
+                    help='Copy duplicates from FASTA using its index (built if absent) instead of parsing it')
 args = parser.parse_args()
 
 if not args.b:
     print('Need a BLAST file', file=stderr)
     quit()
-    
+
+# Several values of any cutoff mean a sweep over all their combinations in
+# a single pass over the BLAST file
+sweep_mode = len(args.o) > 1 or len(args.l) > 1 or len(args.c) > 1
+if sweep_mode and (args.f or args.s):
+    parser.error('-f and -s are not supported with several cutoff values')
 duplicates = set()
-for query_group in iterate_by_query(parse_blast_file_to_hits(filename=args.b)):
-    if duplicate_percentage(query_group, overlap_cutoff=args.o,
-                            len_cutoff=args.l) >= args.c:
-        duplicates.add(query_group[0].query_id)
+# Duplicate percentages are calculated for entire tables of query groups
+if sweep_mode:
+    fractions = partial(query_sweep_fractions, overlap_cutoffs=args.o,
+                        len_cutoffs=args.l)
+else:
+    fractions = partial(query_duplicate_fractions, overlap_cutoff=args.o[0],
+                        len_cutoff=args.l[0])
+if os.path.isdir(args.b):
+    table_fractions = map(fractions, BlastCache(args.b).tables())
+elif args.t > 1:
+    # Query order is irrelevant, as duplicates are stored in a set anyway
+    table_fractions = map_blast_table_shards(fractions, args.b,
+                                             processes=args.t, ordered=False)
+else:
+    table_fractions = map(fractions, query_aligned_tables(
+        parse_blast_file_to_table(args.b)))
+if sweep_mode:
+    sweep(table_fractions, args)
+    print('Sweep results written to {}.sweep.tsv'.format(args.n), file=stderr)
+    quit()
+for query_fractions in table_fractions:
+    duplicates.update(query for query, fraction in query_fractions
+                      if fraction >= args.c[0])
 print('Found {} duplicates'.format(len(duplicates)), file=stderr, flush=True)
 if duplicates:
     species_mult = {}
@@ -62,11 +116,21 @@ if duplicates:
                     species_mult[species] = 1
     print('Generating FASTA...', file=stderr, flush=True)
     species_total = {}
-    if args.f:
-        with open('{}.duplicates.fasta'.format(args.n), mode='w') as outfasta:
-            for record in SeqIO.parse(args.f, 'fasta'):
+    if args.f and args.index:
+        # Records are copied as they are in the file, without parsing
+        with FastaIndex(args.f) as fasta_index, \
+                open('{}.duplicates.fasta'.format(args.n),
+                     mode='wb') as outfasta:
+            fasta_index.write_records(duplicates, outfasta)
+            if args.s:
+                for seqid in fasta_index:
+                    species = seqid.split('|')[0]
+                    species_total[species] = species_total.get(species, 0) + 1
+    elif args.f:
+        with open('{}.duplicates.fasta'.format(args.n), mode='wb') as outfasta:
+            for record in read_fasta(args.f):
                 if record.id in duplicates:
-                    SeqIO.write(record, outfasta, 'fasta')
+                    write_fasta([record], outfasta)
                 if args.s:
                     species = record.id.split('|')[0]
                     try:
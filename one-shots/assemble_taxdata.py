@@ -1,9 +1,10 @@
 #! /usr/bin/env python3
 
 from argparse import ArgumentParser
-from Bio import SeqIO
 import os
 
+from phylome.fasta import read_fasta
+
 
 def get_path(mask, cluster_id):
     """
@@ -38,19 +39,19 @@ for line in open(args.l):
     cluster_id = line.rstrip()
     with open(os.path.join(args.d, '{}.taxdata.tsv'.format(cluster_id)),
               mode='w') as outhandle:
-        for record in SeqIO.parse(diatom_mask.format(cluster_id), 'fasta'):
+        for record in read_fasta(diatom_mask.format(cluster_id)):
             print('{}\tdiatom'.format(record.id), file=outhandle)
         # Checking masks
         # Could've made that a function, but whatever
         red_path = get_path(red_mask, cluster_id)
         if red_path:
-            for record in SeqIO.parse(red_path, 'fasta'):
+            for record in read_fasta(red_path):
                 print('{}\tred'.format(record.id), file=outhandle)
         green_path = get_path(green_mask, cluster_id)
         if green_path:
-            for record in SeqIO.parse(green_path, 'fasta'):
+            for record in read_fasta(green_path):
                 print('{}\tgreen'.format(record.id), file=outhandle)
         rest_path = get_path(rest_mask, cluster_id)
         if rest_path:
-            for record in SeqIO.parse(rest_path, 'fasta'):
+            for record in read_fasta(rest_path):
                 print('{}\trest'.format(record.id), file=outhandle)
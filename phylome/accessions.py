@@ -0,0 +1,332 @@
+"""
+Accession to taxid mapping.
+Scripts used to query `acc2taxid` table in mySQL with a giant IN list for
+every query group or FASTA file. `AccessionIndex` is a local alternative
+built once from NCBI `prot.accession2taxid`: a sorted array of fixed-width
+accessions (without versions) and an array of taxids, both stored as .npy
+files and memory-mapped, so that the lookups are binary searches and the
+pages are shared between worker processes.
+"""
+
+import os
+from itertools import chain
+from queue import Queue, Full
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+
+import numpy as np
+
+from phylome.compressed import open_compressed
+from phylome.lookup import find_sorted
+
+
+def strip_version(accession):
+    """
+    Remove the version from accession the same way scripts always did.
+    :param accession: str
+    :return: str
+    """
+    return accession.split('.')[0]
+
+
+def _save_run(keys, taxids, path):
+    """
+    Sort a chunk of accessions and save it as a pair of .npy files.
+    :param keys: np.ndarray of bytes
+    :param taxids: np.ndarray of int32
+    :param path: str
+    :return: str
+    """
+    order = np.argsort(keys, kind='stable')
+    np.save(path + '.keys.npy', keys[order])
+    np.save(path + '.taxids.npy', taxids[order])
+    return path
+
+
+def _merge_runs(paths, output_path, block_size):
+    """
+    Merge sorted runs into a single one in one streaming pass.
+    At most `block_size` entries of every run are read at a time. Entries
+    below the smallest of the blocks' last keys can't be preceded by anything
+    not read yet, so they are sorted together and appended to the output.
+    The merge is stable: equal keys go in the run order, so that the first
+    occurrence in the input stays first.
+    :param paths: list of str
+    :param output_path: str
+    :param block_size: int
+    :return: str
+    """
+    keys = [np.load(x + '.keys.npy', mmap_mode='r') for x in paths]
+    taxids = [np.load(x + '.taxids.npy', mmap_mode='r') for x in paths]
+    dtype = max((x.dtype for x in keys), key=lambda x: x.itemsize)
+    length = sum(len(x) for x in keys)
+    merged_keys = np.lib.format.open_memmap(output_path + '.keys.npy',
+                                            mode='w+', dtype=dtype,
+                                            shape=(length,))
+    merged_taxids = np.lib.format.open_memmap(output_path + '.taxids.npy',
+                                              mode='w+', dtype=np.int32,
+                                              shape=(length,))
+    positions = [0] * len(paths)
+    written = 0
+    while written < length:
+        blocks = {i: keys[i][positions[i]:positions[i] + block_size].astype(
+                      dtype)
+                  for i in range(len(paths)) if positions[i] < len(keys[i])}
+        limit = min(x[-1] for x in blocks.values())
+        counts = {i: int(np.searchsorted(x, limit)) for i, x in blocks.items()}
+        if any(counts.values()):
+            #  Concatenated in the run order, so the stable sort keeps it for
+            #  equal keys
+            block_keys = np.concatenate([x[:counts[i]]
+                                         for i, x in blocks.items()])
+            block_taxids = np.concatenate(
+                [taxids[i][positions[i]:positions[i] + counts[i]]
+                 for i in blocks])
+            order = np.argsort(block_keys, kind='stable')
+            end = written + len(order)
+            merged_keys[written:end] = block_keys[order]
+            merged_taxids[written:end] = block_taxids[order]
+            written = end
+            for i, count in counts.items():
+                positions[i] += count
+            continue
+        #  All the blocks start with the limit key. It's copied run by run,
+        #  as it may continue past the blocks
+        for i in sorted(blocks):
+            while positions[i] < len(keys[i]):
+                block = keys[i][positions[i]:positions[i] + block_size]
+                count = int(np.searchsorted(block.astype(dtype), limit,
+                                            side='right'))
+                merged_keys[written:written + count] = block[:count]
+                merged_taxids[written:written + count] = \
+                    taxids[i][positions[i]:positions[i] + count]
+                written += count
+                positions[i] += count
+                if count < len(block):
+                    break
+    merged_keys.flush()
+    merged_taxids.flush()
+    del merged_keys, merged_taxids
+    return output_path
+
+
+def build_accession_index(filename, index_dir, chunk_size=2**24):
+    """
+    Build an accession index from NCBI accession2taxid file.
+    Both the old four-column format (accession, accession.version, taxid,
+    gi) and the two-column one (accession.version, taxid) are accepted, with
+    or without the header. The file may be compressed. Chunks of
+    `chunk_size` lines are sorted in memory and saved, and then merged into
+    the index in a single streaming pass over bounded blocks (see
+    `_merge_runs`), so the memory use depends on `chunk_size` and not on the
+    size of the file.
+    :param filename: str
+    :param index_dir: str
+    :param chunk_size: int
+    :return:
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    with TemporaryDirectory(dir=index_dir) as temp_dir:
+        runs = []
+
+        def flush(keys, taxids):
+            runs.append(_save_run(np.array(keys, dtype=bytes),
+                                  np.array(taxids, dtype=np.int32),
+                                  os.path.join(temp_dir, str(len(runs)))))
+
+        keys = []
+        taxids = []
+        with open_compressed(filename) as handle:
+            for line in handle:
+                fields = line.rstrip('\n').split('\t')
+                if not fields[-1].isdigit():
+                    #  Header or garbage
+                    continue
+                taxids.append(int(fields[2] if len(fields) > 2 else fields[1]))
+                keys.append(strip_version(fields[0]).encode())
+                if len(keys) == chunk_size:
+                    flush(keys, taxids)
+                    keys = []
+                    taxids = []
+        if keys or not runs:
+            flush(keys, taxids)
+        if len(runs) > 1:
+            #  Blocks of all runs together are about as large as a chunk
+            runs = [_merge_runs(runs, os.path.join(temp_dir, 'merged'),
+                                max(chunk_size // len(runs), 1))]
+        for suffix in ('.keys.npy', '.taxids.npy'):
+            os.replace(runs[0] + suffix,
+                       os.path.join(index_dir, 'accessions' + suffix))
+
+
+class AccessionIndex:
+    """
+    Memory-mapped accession to taxid index made by `build_accession_index`.
+    Accessions are looked up without versions. `lookup_many` and `as_dict`
+    are vectorized and should be preferred for large batches.
+    """
+    def __init__(self, index_dir):
+        self.keys = np.load(os.path.join(index_dir, 'accessions.keys.npy'),
+                            mmap_mode='r')
+        self.taxids = np.load(os.path.join(index_dir,
+                                           'accessions.taxids.npy'),
+                              mmap_mode='r')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, accession):
+        return self.lookup(accession) is not None
+
+    def lookup_many(self, accessions):
+        """
+        Return taxids for a list of accessions (with or without versions),
+        0 for the unknown ones.
+        :param accessions: iterable of str
+        :return: np.ndarray of int32
+        """
+        positions = find_sorted(self.keys, [strip_version(x).encode()
+                                            for x in accessions])
+        result = np.zeros(len(positions), dtype=np.int32)
+        found = positions >= 0
+        result[found] = self.taxids[positions[found]]
+        return result
+
+    def lookup(self, accession):
+        """
+        Return taxid for a single accession, or None if it's unknown.
+        :param accession: str
+        :return: int or None
+        """
+        taxid = int(self.lookup_many([accession])[0])
+        return taxid or None
+
+    def as_dict(self, accessions):
+        """
+        Return a dict of versionless accession to taxid for all known
+        accessions from a list. It's what the scripts used to build from
+        `acc2taxid` SQL results.
+        :param accessions: iterable of str
+        :return: dict
+        """
+        stripped = [strip_version(x) for x in accessions]
+        return {accession: taxid for accession, taxid in
+                zip(stripped, self.lookup_many(stripped).tolist()) if taxid}
+
+
+def get_taxids(accessions, cursor):
+    """
+    Return a dict of versionless accession to taxid.
+    Takes a list of accessions (versions are stripped) and either a pymysql
+    cursor for the database with `acc2taxid` table or an AccessionIndex.
+    Unknown accessions are simply absent from the result.
+    :param accessions: iterable of str
+    :param cursor: pymysql cursor or AccessionIndex
+    :return: dict
+    """
+    if isinstance(cursor, AccessionIndex):
+        return cursor.as_dict(accessions)
+    stripped = list(set(strip_version(x) for x in accessions))
+    if not stripped:
+        return {}
+    #  Only the first two columns (accession and taxid) are used
+    cursor.execute('select * from acc2taxid where accession in ({});'.format(
+        ', '.join(['%s'] * len(stripped))), stripped)
+    return {x[0]: x[1] for x in cursor.fetchall()}
+
+
+def _close_source(source):
+    """
+    Close a taxid source: the connection of a database cursor, or anything
+    else that has `close`. AccessionIndex needs no closing.
+    :param source: pymysql cursor, AccessionIndex or None
+    :return:
+    """
+    closeable = getattr(source, 'connection', source)
+    if hasattr(closeable, 'close'):
+        closeable.close()
+
+
+def prefetch_taxids(groups, source_factory, accessions_of=list,
+                    batch_size=100, lookahead=4):
+    """
+    Look up taxids for the upcoming groups in a background thread.
+    Groups (eg query groups from `iterate_by_query`) are read in batches of
+    `batch_size`, and taxids for all accessions of a batch are fetched with a
+    single `get_taxids` call. It happens in a separate thread while the
+    consumer works on the previous batches, with at most `lookahead` batches
+    waiting in the queue. Yields (group, acc2taxid) tuples in the original
+    order, where acc2taxid covers the entire batch of a group.
+    `source_factory` is called in the background thread to get a cursor or an
+    AccessionIndex; database connections shouldn't be shared between threads,
+    so it should open a new one; it's closed when the thread is done (for a
+    cursor, its connection). `accessions_of` takes a group and returns its
+    accessions.
+    Exceptions in the background thread are re-raised in the consumer.
+    :param groups: iterable
+    :param source_factory: callable
+    :param accessions_of: callable
+    :param batch_size: int
+    :param lookahead: int
+    :return:
+    """
+    batches = Queue(maxsize=lookahead)
+    stop = Event()
+
+    def put(item):
+        #  Timeouts are there so that the thread quits if consumer stops early
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def fetch(batch, source):
+        return batch, get_taxids(chain.from_iterable(accessions_of(x)
+                                                     for x in batch),
+                                 source)
+
+    def put_batches(source):
+        batch = []
+        for group in groups:
+            batch.append(group)
+            if len(batch) == batch_size:
+                if not put(fetch(batch, source)):
+                    return False
+                batch = []
+        return not batch or put(fetch(batch, source))
+
+    def produce():
+        source = None
+        last = None
+        try:
+            source = source_factory()
+            finished = put_batches(source)
+        except BaseException as e:
+            #  Anything, or the consumer would wait forever
+            finished = True
+            last = e
+        try:
+            _close_source(source)
+        except BaseException as e:
+            last = last or e
+        #  The source is closed before the consumer learns that it's done
+        if finished:
+            put(last)
+
+    thread = Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            batch, acc2taxid = item
+            for group in batch:
+                yield group, acc2taxid
+    finally:
+        stop.set()
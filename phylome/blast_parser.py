@@ -4,32 +4,55 @@ It slightly outperforms Biopython's BLAST parser, but is mostly here as an
 exercise in a more functional programming style and proper unittests.
 """
 
+import mmap
+import os
+import shutil
+from array import array
 from collections import namedtuple
-from io import TextIOBase
+from heapq import merge
+from io import BufferedReader, RawIOBase, StringIO, TextIOBase, \
+    TextIOWrapper
+from itertools import chain, islice
+from multiprocessing import Pool
+from tempfile import mkdtemp, mkstemp
+
+import numpy as np
+
+from phylome.compressed import check_uncompressed, open_compressed
+from phylome.sidecar import index_is_current, read_index, write_index
 
 
 BlastHSP = namedtuple('BlastHSP', ['query_id', 'hit_id', 'query_pos', 'hit_pos',
                                    'evalue'])
 BlastHit = namedtuple('BlastHit', ['query_id', 'hit_id', 'hsps'])
+#  A chunk of BLAST file in columnar form. `names` is a list of IDs shared by
+#  all chunks of a file, `query_ids` and `hit_ids` are int32 indices into it.
+#  `length` is the alignment length.
+BlastTable = namedtuple('BlastTable', ['names', 'query_ids', 'hit_ids',
+                                       'query_start', 'query_end',
+                                       'hit_start', 'hit_end', 'evalue',
+                                       'length'])
 
 
-def create_handle(filename):
+def create_handle(filename, threads=None):
     """
     Take a readable filehandle or an str, return readable filehandle.
     If it's a filehandle already, this is an identity function, otherwise the
-    string is treated as a filename to be open. Any other argument type raises
-    TypeError.
+    string is treated as a filename to be open. gzip, BGZF and zstd files are
+    detected by their magic bytes and decompressed on the fly (BGZF in
+    `threads` threads). Any other argument type raises TypeError.
     :param filename:
+    :param threads: int
     :return:
     """
     if isinstance(filename, str):
-        return open(filename, mode='r')
+        return open_compressed(filename, threads)
     elif isinstance(filename, TextIOBase) and filename.readable():
         return filename
     else:
         raise TypeError('Only string or readable text-mode filehandle accepted by parse_blast_file')
-    
-    
+
+
 def parse_blast_line(line):
     """
     Take a single line from BLAST file and return a BlastHSP.
@@ -44,6 +67,15 @@ def parse_blast_line(line):
     arr = line.split('\t')
     if not len(arr) == 12:
         raise ValueError('Incorrect BLAST line {}'.format(line))
+    return fields_to_hsp(arr)
+
+
+def fields_to_hsp(arr):
+    """
+    Take a list of 12 fields of a BLAST line and return a BlastHSP.
+    :param arr: list of str
+    :return: BlastHSP
+    """
     #  There is no explicit validity check, but hopefully IndexError or some
     #  exception of the type converters will be raised on the invalid string
     return BlastHSP(query_id=arr[0],
@@ -58,7 +90,7 @@ def assemble_hits(iterable):
     Groups HSPs into BlastHit instances
     Takes an iterable of BlastHSPs, yields BlastHits. Assumes the iterable to be
     sorted by query ID and, for each query, to be sorted by hit ID (*vice versa
-    should also work).
+    should also work). Nothing is yielded for an empty iterable.
     :param iterable:
     :return:
     """
@@ -78,10 +110,75 @@ def assemble_hits(iterable):
             current_hit = blast_hsp.hit_id
             current_query = blast_hsp.query_id
             y = [blast_hsp]
-    yield BlastHit(query_id=current_query, hit_id=current_hit, hsps=y)
+    if y:
+        yield BlastHit(query_id=current_query, hit_id=current_hit, hsps=y)
+
+
+def _lines_of_queries(lines, store, batch_size=2**16):
+    """
+    Yield the lines (comments included) whose query is in a store with a
+    vectorized lookup, such as `ClusterStore`. Its `codes` method is called
+    once per batch of lines with their distinct query IDs, and should return
+    an array with negative values for unknown IDs.
+    :param lines: iterable of str
+    :param store: object with `codes` method
+    :param batch_size: int
+    :return: generator
+    """
+    lines = iter(lines)
+    while True:
+        batch = list(islice(lines, batch_size))
+        if not batch:
+            return
+        queries = list(dict.fromkeys(x[:x.find('\t')] for x in batch))
+        known = {query for query, code in zip(queries, store.codes(queries))
+                 if code >= 0}
+        for line in batch:
+            if line[0] == '#' or line[:line.find('\t')] in known:
+                yield line
+
+
+def filter_blast_fields(filename, ignore_trivial=True, evalue_cutoff=None,
+                        min_length=None, query_ids=None, hit_ids=None):
+    """
+    Take a BLAST output file and generate lists of fields of its lines.
+    This is the part of `parse_blast_file_to_hsps` that reads, splits and
+    filters the lines without converting anything. See it for the description
+    of arguments.
+    :param filename: str or filehandle
+    :param ignore_trivial: bool
+    :param evalue_cutoff: float
+    :param min_length: int
+    :param query_ids: set, dict or other container
+    :param hit_ids: set, dict or other container
+    :return: generator
+    """
+    lines = create_handle(filename)
+    if hasattr(query_ids, 'codes'):
+        lines = _lines_of_queries(lines, query_ids)
+        query_ids = None
+    for line in lines:
+        if line[0] == '#':
+            continue
+        #  Cheapest checks go first
+        if query_ids is not None and line[:line.find('\t')] not in query_ids:
+            continue
+        arr = line.split('\t')
+        if not len(arr) == 12:
+            raise ValueError('Incorrect BLAST line {}'.format(line))
+        if ignore_trivial and arr[0] == arr[1]:
+            continue
+        if hit_ids is not None and arr[1] not in hit_ids:
+            continue
+        if min_length is not None and int(arr[3]) < min_length:
+            continue
+        if evalue_cutoff is not None and not float(arr[10]) < evalue_cutoff:
+            continue
+        yield arr
 
 
-def parse_blast_file_to_hsps(filename, ignore_trivial=True):
+def parse_blast_file_to_hsps(filename, ignore_trivial=True, evalue_cutoff=None,
+                             min_length=None, query_ids=None, hit_ids=None):
     """
     Take a BLAST output file and generate BlastHSP instances from its lines.
     It assumes the default tabular output from BLAST 2.2.28+ (generated with
@@ -91,19 +188,30 @@ def parse_blast_file_to_hsps(filename, ignore_trivial=True):
     it would be opened in `'r'` mode.
     By default ignores trivial hits (ie ones where hit and query names are
     identical).
+    The rest of keyword arguments are filters applied to the raw fields, so
+    that no BlastHSP is created for the rejected lines. If not None, only the
+    HSPs with evalue below `evalue_cutoff`, alignment length of at least
+    `min_length`, query ID in `query_ids` and hit ID in `hit_ids` (any
+    containers supporting `in`) are yielded. Query IDs are checked before
+    the line is even split, so lines of the rejected queries are not
+    validated. `query_ids` may also be a store with vectorized `codes`
+    lookup (eg `phylome.clusters.ClusterStore`), which is then queried with
+    batches of lines.
     :param filename: str or filehandle
     :param ignore_trivial: bool
+    :param evalue_cutoff: float
+    :param min_length: int
+    :param query_ids: set, dict or other container
+    :param hit_ids: set, dict or other container
     :return:
     """
-    for line in create_handle(filename):
-        if not line[0] == '#':
-            hsp = parse_blast_line(line)
-            if (not ignore_trivial) or (not hsp.query_id == hsp.hit_id):
-                yield hsp
+    for arr in filter_blast_fields(filename, ignore_trivial, evalue_cutoff,
+                                   min_length, query_ids, hit_ids):
+        yield fields_to_hsp(arr)
     # Not closing a filehandle because it may be used by the calling code.
 
 
-def parse_blast_file_to_hits(filename, ignore_trivial=True):
+def parse_blast_file_to_hits(filename, ignore_trivial=True, **filters):
     """
     Take a BLAST output file and generate BlastHit instances from its lines.
     It assumes the default tabular output from BLAST 2.2.28+ (generated with
@@ -111,11 +219,19 @@ def parse_blast_file_to_hits(filename, ignore_trivial=True):
     Any line starting with `#` is considered a comment and omitted.
     `file` can be either a filehandle in text mode or a filename. In latter case
     it would be opened in `'r'` mode.
+    Other keyword arguments (`evalue_cutoff`, `min_length`, `query_ids` and
+    `hit_ids`) are HSP filters passed to `parse_blast_file_to_hsps`. Hits
+    with all HSPs filtered out are not yielded.
+    If `filename` is a directory, it is treated as a BLAST cache (see
+    `write_blast_cache`) and read with `BlastCache.iterate_hits`.
     :param filename: str or filehandle
     :param ignore_trivial: bool
     :return: generator
     """
-    return assemble_hits(parse_blast_file_to_hsps(filename, ignore_trivial))
+    if isinstance(filename, str) and os.path.isdir(filename):
+        return BlastCache(filename).iterate_hits(ignore_trivial, **filters)
+    return assemble_hits(parse_blast_file_to_hsps(filename, ignore_trivial,
+                                                  **filters))
 
 
 def iterate_by_query(hits_iterator):
@@ -124,10 +240,16 @@ def iterate_by_query(hits_iterator):
     Given an iterator of BlastHit instances, this function produces lists of the
     BlastHits with the same query. It assumes hits to be sorted by query, ie
     that all the hits of a given query are following one after another in the
-    list (which is a normal behaviour for BLAST output)
+    list (which is a normal behaviour for BLAST output). Nothing is yielded for
+    an empty iterator.
+    A BlastCache can be passed instead of an iterator, in which case its
+    query groups are read directly with the default filters.
     :param hits_iterator:
     :return:
     """
+    if isinstance(hits_iterator, BlastCache):
+        yield from hits_iterator.iterate_by_query()
+        return
     current_query = ''
     #  Probably could be an iterator as well, but I can't design the algorithm.
     hits = []
@@ -140,4 +262,1044 @@ def iterate_by_query(hits_iterator):
             yield hits
             hits = [blasthit]
             current_query = blasthit.query_id
-    yield hits
+    if hits:
+        yield hits
+
+
+def lines_to_table(lines, names, codes, ignore_trivial=True):
+    """
+    Take a list of BLAST lines and return a BlastTable.
+    IDs are interned: every new ID is appended to `names` and recorded in the
+    `codes` dict (ID to its index in `names`), so that a single `names` list
+    can be shared by all the tables made from one file. Comment lines are
+    omitted. Raises ValueError on the line with the wrong field count.
+    :param lines: list of str
+    :param names: list
+    :param codes: dict
+    :param ignore_trivial: bool
+    :return: BlastTable
+    """
+    fields = [line.split('\t') for line in lines if not line[0] == '#']
+    for arr in fields:
+        if not len(arr) == 12:
+            raise ValueError('Incorrect BLAST line {}'.format('\t'.join(arr)))
+    if not fields:
+        return BlastTable(names, *(np.empty(0, dtype=np.int32)
+                                   for _ in range(6)),
+                          evalue=np.empty(0, dtype=np.float64),
+                          length=np.empty(0, dtype=np.int32))
+    columns = list(zip(*fields))
+    #  Codes are assigned in the order IDs are first seen, so that they don't
+    #  depend on the hash seed
+    for name in dict.fromkeys(chain(columns[0], columns[1])):
+        if name not in codes:
+            codes[name] = len(names)
+            names.append(name)
+    table = BlastTable(names=names,
+                       query_ids=np.array(list(map(codes.__getitem__,
+                                                   columns[0])),
+                                          dtype=np.int32),
+                       hit_ids=np.array(list(map(codes.__getitem__,
+                                                 columns[1])),
+                                        dtype=np.int32),
+                       query_start=np.array(columns[6], dtype=np.int32),
+                       query_end=np.array(columns[7], dtype=np.int32),
+                       hit_start=np.array(columns[8], dtype=np.int32),
+                       hit_end=np.array(columns[9], dtype=np.int32),
+                       evalue=np.array(columns[10], dtype=np.float64),
+                       length=np.array(columns[3], dtype=np.int32))
+    if ignore_trivial:
+        table = mask_table(table, table.query_ids != table.hit_ids)
+    return table
+
+
+def mask_table(table, mask):
+    """
+    Return a BlastTable with only the rows where `mask` is True.
+    `names` is shared with the original table, not copied.
+    :param table: BlastTable
+    :param mask: boolean np.ndarray or index array
+    :return: BlastTable
+    """
+    return BlastTable(table.names, *(column[mask] for column in table[1:]))
+
+
+def parse_blast_file_to_table(filename, ignore_trivial=True,
+                              chunk_size=2**24):
+    """
+    Take a BLAST output file and generate BlastTable chunks from its lines.
+    This is a columnar alternative to `parse_blast_file_to_hsps`: instead of
+    creating a BlastHSP for every line it reads about `chunk_size` bytes at a
+    time and converts them to NumPy arrays (int32 IDs and positions, float64
+    evalues). IDs are interned into a single `names` list shared by all
+    chunks of a file. Chunks are split on line boundaries only, so a query
+    or a hit may span two consecutive chunks.
+    Format assumptions and `filename` handling are the same as in
+    `parse_blast_file_to_hsps`.
+    :param filename: str or filehandle
+    :param ignore_trivial: bool
+    :param chunk_size: int
+    :return: generator
+    """
+    handle = create_handle(filename)
+    names = []
+    codes = {}
+    while True:
+        lines = handle.readlines(chunk_size)
+        if not lines:
+            return
+        table = lines_to_table(lines, names, codes, ignore_trivial)
+        if len(table.evalue):
+            yield table
+
+
+def table_to_hsps(table):
+    """
+    Generate BlastHSP instances from the rows of a BlastTable.
+    :param table: BlastTable
+    :return: generator
+    """
+    names = table.names
+    for query, hit, qs, qe, hs, he, evalue, _ in zip(*(column.tolist()
+                                                       for column
+                                                       in table[1:])):
+        yield BlastHSP(query_id=names[query], hit_id=names[hit],
+                       query_pos=(qs, qe), hit_pos=(hs, he), evalue=evalue)
+
+
+def tables_to_hits(tables):
+    """
+    Generate BlastHit instances from an iterable of BlastTables.
+    Takes care of the hits split between consecutive tables, so
+    `tables_to_hits(parse_blast_file_to_table(f))` yields the same hits as
+    `parse_blast_file_to_hits(f)`.
+    :param tables: iterable of BlastTable
+    :return: generator
+    """
+    return assemble_hits(chain.from_iterable(map(table_to_hsps, tables)))
+
+
+def query_aligned_tables(tables):
+    """
+    Generate BlastTables that never split a query group between two tables.
+    The rows of the last query of every table are held back and prepended
+    to the next one. Takes an iterable of tables sharing `names`, such as
+    the output of `parse_blast_file_to_table`.
+    :param tables: iterable of BlastTable
+    :return: generator
+    """
+    pending = None
+    for table in tables:
+        if pending is not None:
+            table = BlastTable(table.names,
+                               *(np.concatenate((x, y)) for x, y
+                                 in zip(pending[1:], table[1:])))
+        if not len(table.evalue):
+            continue
+        queries = table.query_ids
+        #  Start of the last query group
+        tail = len(queries) - np.argmax(queries[::-1] != queries[-1])
+        if queries[0] == queries[-1]:
+            tail = 0
+        pending = mask_table(table, slice(tail, None))
+        if tail:
+            yield mask_table(table, slice(0, tail))
+    if pending is not None and len(pending.evalue):
+        yield pending
+
+
+class CompactHSP:
+    """
+    A view of a single HSP of a CompactHit.
+    Has the same attributes as a BlastHSP, but stores nothing except a
+    reference to the hit and an index. Created on access, not stored.
+    """
+    __slots__ = ('hit', 'index')
+
+    def __init__(self, hit, index):
+        self.hit = hit
+        self.index = index
+
+    @property
+    def query_id(self):
+        return self.hit.query_id
+
+    @property
+    def hit_id(self):
+        return self.hit.hit_id
+
+    @property
+    def query_pos(self):
+        i = self.index * 4
+        return self.hit.positions[i], self.hit.positions[i+1]
+
+    @property
+    def hit_pos(self):
+        i = self.index * 4
+        return self.hit.positions[i+2], self.hit.positions[i+3]
+
+    @property
+    def evalue(self):
+        return self.hit.evalues[self.index]
+
+    def to_hsp(self):
+        return BlastHSP(self.query_id, self.hit_id, self.query_pos,
+                        self.hit_pos, self.evalue)
+
+
+class CompactHSPList:
+    """
+    A read-only sequence of CompactHSPs of a CompactHit.
+    """
+    __slots__ = ('hit',)
+
+    def __init__(self, hit):
+        self.hit = hit
+
+    def __len__(self):
+        return len(self.hit.evalues)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('HSP index out of range')
+        return CompactHSP(self.hit, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield CompactHSP(self.hit, index)
+
+
+class CompactHit:
+    """
+    A memory-efficient alternative to BlastHit.
+    Instead of a list of BlastHSP tuples, HSP coordinates are stored in a
+    single `array('i')` (query start, query end, hit start, hit end for every
+    HSP) and evalues in an `array('d')`. `hsps` attribute provides the same
+    interface as BlastHit's, so `is_duplicate` and the like work with both.
+    """
+    __slots__ = ('query_id', 'hit_id', 'positions', 'evalues')
+
+    def __init__(self, query_id, hit_id, positions=None, evalues=None):
+        self.query_id = query_id
+        self.hit_id = hit_id
+        self.positions = positions if positions is not None else array('i')
+        self.evalues = evalues if evalues is not None else array('d')
+
+    @property
+    def hsps(self):
+        return CompactHSPList(self)
+
+    @classmethod
+    def from_hit(cls, hit):
+        """
+        Create a CompactHit from a BlastHit.
+        :param hit: BlastHit
+        :return: CompactHit
+        """
+        compact = cls(hit.query_id, hit.hit_id)
+        for hsp in hit.hsps:
+            compact.positions.extend(hsp.query_pos + hsp.hit_pos)
+            compact.evalues.append(hsp.evalue)
+        return compact
+
+    def to_hit(self):
+        """
+        Return a BlastHit with the same data.
+        :return: BlastHit
+        """
+        return BlastHit(self.query_id, self.hit_id,
+                        [x.to_hsp() for x in self.hsps])
+
+
+def compact_hits(hits_iterable, ignore_trivial=True):
+    """
+    Generate CompactHits from an iterable of BlastHits, or from a BLAST file
+    or cache given by its name.
+    Converting BlastHits still creates them first, so it only saves memory on
+    the hits that are kept. With a name, CompactHits are built straight from
+    the columns of BlastTables (see `tables_to_compact_hits`), and no BlastHit
+    or BlastHSP is ever created; `ignore_trivial` applies to this case only.
+    :param hits_iterable: iterable of BlastHits or str
+    :param ignore_trivial: bool
+    :return: generator
+    """
+    if isinstance(hits_iterable, str):
+        if os.path.isdir(hits_iterable):
+            tables = BlastCache(hits_iterable).tables(ignore_trivial)
+        else:
+            tables = parse_blast_file_to_table(hits_iterable, ignore_trivial)
+        yield from tables_to_compact_hits(tables)
+        return
+    for hit in hits_iterable:
+        yield CompactHit.from_hit(hit)
+
+
+def tables_to_compact_hits(tables):
+    """
+    Generate CompactHits from an iterable of BlastTables.
+    Works like `tables_to_hits`, but copies the columns into arrays directly,
+    without creating a BlastHSP for every row.
+    :param tables: iterable of BlastTable
+    :return: generator
+    """
+    pending = None
+    for table in tables:
+        if not len(table.evalue):
+            continue
+        keys = np.stack((table.query_ids, table.hit_ids))
+        starts = np.flatnonzero(np.any(np.diff(keys, axis=1), axis=0)) + 1
+        starts = [0] + starts.tolist()
+        ends = starts[1:] + [len(table.evalue)]
+        positions = np.stack((table.query_start, table.query_end,
+                              table.hit_start, table.hit_end),
+                             axis=1).astype(np.int32)
+        evalues = table.evalue.astype(np.float64)
+        for start, end in zip(starts, ends):
+            query_id = table.names[table.query_ids[start]]
+            hit_id = table.names[table.hit_ids[start]]
+            if pending is not None and pending.query_id == query_id and \
+                    pending.hit_id == hit_id:
+                #  A hit split between two tables
+                pending.positions.frombytes(positions[start:end].tobytes())
+                pending.evalues.frombytes(evalues[start:end].tobytes())
+                continue
+            if pending is not None:
+                yield pending
+            pending = CompactHit(query_id, hit_id,
+                                 array('i', positions[start:end].tobytes()),
+                                 array('d', evalues[start:end].tobytes()))
+    if pending is not None:
+        yield pending
+
+
+def query_aligned_shards(filename, shard_count):
+    """
+    Split a BLAST file into byte ranges that don't break query groups.
+    The file is cut into `shard_count` roughly equal pieces, and then every
+    boundary is moved forward to the start of the first line with a query
+    different from the one at the cut. Thus all lines of a given query (as
+    long as the file is sorted by query) end up in the same shard. Returns a
+    list of (start, end) tuples; it may be shorter than `shard_count` if some
+    of the queries are larger than a shard.
+    Accepts only filenames, as filehandles can't be shared between processes.
+    Compressed files raise ValueError.
+    :param filename: str
+    :param shard_count: int
+    :return: list
+    """
+    check_uncompressed(filename)
+    size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, mode='rb') as handle:
+        for shard in range(1, shard_count):
+            target = size * shard // shard_count
+            if target <= boundaries[-1]:
+                continue
+            handle.seek(target)
+            #  Skipping the line that was cut in the middle
+            handle.readline()
+            query = handle.readline().split(b'\t', 1)[0]
+            while True:
+                position = handle.tell()
+                line = handle.readline()
+                if not line:
+                    break
+                if not line.split(b'\t', 1)[0] == query:
+                    break
+            if boundaries[-1] < position < size:
+                boundaries.append(position)
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:])
+            if end > start]
+
+
+class _ByteRange(RawIOBase):
+    """
+    A raw binary stream of a byte range of a file.
+    """
+    def __init__(self, filename, start, end):
+        super().__init__()
+        self.handle = open(filename, mode='rb')
+        self.handle.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if not self.closed:
+            self.handle.close()
+        super().close()
+
+    def readinto(self, b):
+        size = self.handle.readinto(memoryview(b)[:self.remaining])
+        self.remaining -= size
+        return size
+
+
+def iterate_blast_shard(filename, start, end, ignore_trivial=True, **filters):
+    """
+    Yield query groups from a byte range of a BLAST file.
+    Query groups are lists of BlastHits, as produced by `iterate_by_query`.
+    The range is read through a buffer, so only the current group is held
+    in memory. The range is expected to start and end on line boundaries
+    (see `query_aligned_shards`). Filters are the same as in
+    `parse_blast_file_to_hsps`.
+    :param filename: str
+    :param start: int
+    :param end: int
+    :param ignore_trivial: bool
+    :return: generator
+    """
+    with TextIOWrapper(BufferedReader(_ByteRange(filename, start, end),
+                                      buffer_size=2**20),
+                       encoding='utf-8') as handle:
+        yield from iterate_by_query(parse_blast_file_to_hits(
+            handle, ignore_trivial, **filters))
+
+
+def parse_blast_shard(filename, start, end, ignore_trivial=True, **filters):
+    """
+    Return a list of query groups from a byte range of a BLAST file.
+    See `iterate_blast_shard` for the details.
+    :param filename: str
+    :param start: int
+    :param end: int
+    :param ignore_trivial: bool
+    :return: list
+    """
+    return list(iterate_blast_shard(filename, start, end, ignore_trivial,
+                                    **filters))
+
+
+def _parse_shard_star(args):
+    """
+    Unpack the arguments for `parse_blast_shard`. Needed because Pool.imap
+    only passes a single argument.
+    :param args:
+    :return:
+    """
+    *args, filters = args
+    return parse_blast_shard(*args, **filters)
+
+
+def parse_blast_file_parallel(filename, processes=None, ignore_trivial=True,
+                              ordered=True, shard_size=2**26, **filters):
+    """
+    Yield query groups from a BLAST file parsed in a process pool.
+    The file is split into query-aligned shards of about `shard_size` bytes
+    (but at least one per process), and every shard is parsed independently.
+    If `ordered` is True, query groups are yielded in the same order as
+    `iterate_by_query(parse_blast_file_to_hits(filename))` would. Otherwise
+    shards are yielded as soon as they are ready, which is faster when the
+    order doesn't matter. Only filenames are accepted. Filters are the same
+    as in `parse_blast_file_to_hsps`.
+    :param filename: str
+    :param processes: int or None for the CPU count
+    :param ignore_trivial: bool
+    :param ordered: bool
+    :param shard_size: int
+    :return: generator
+    """
+    if not isinstance(filename, str):
+        raise TypeError('Only filenames are accepted by parse_blast_file_parallel')
+    processes = processes or os.cpu_count()
+    shards = [(filename, start, end, ignore_trivial, filters) for start, end
+              in pool_shards(filename, processes, shard_size)]
+    with Pool(processes=processes) as pool:
+        if ordered:
+            results = pool.imap(_parse_shard_star, shards)
+        else:
+            results = pool.imap_unordered(_parse_shard_star, shards)
+        for groups in results:
+            yield from groups
+
+
+def pool_shards(filename, processes, shard_size):
+    """
+    Return query-aligned shards of about `shard_size` bytes, but at least one
+    per process, so that the shard count grows with the file size.
+    :param filename: str
+    :param processes: int
+    :param shard_size: int
+    :return: list
+    """
+    shard_count = max(processes, os.path.getsize(filename) // shard_size + 1)
+    return query_aligned_shards(filename, shard_count)
+
+
+def parse_blast_shard_to_table(filename, start, end, ignore_trivial=True):
+    """
+    Return a BlastTable of a byte range of a BLAST file.
+    The table has its own `names` list, ie codes are not comparable between
+    the tables of different shards.
+    :param filename: str
+    :param start: int
+    :param end: int
+    :param ignore_trivial: bool
+    :return: BlastTable
+    """
+    with open(filename, mode='rb') as handle:
+        handle.seek(start)
+        lines = handle.read(end - start).decode().splitlines(keepends=True)
+    return lines_to_table(lines, [], {}, ignore_trivial)
+
+
+def _map_shard_star(args):
+    """
+    Parse a shard into a table and apply a function to it. Needed because
+    Pool.imap only passes a single argument.
+    :param args:
+    :return:
+    """
+    function, *args = args
+    return function(parse_blast_shard_to_table(*args))
+
+
+def map_blast_table_shards(function, filename, processes=None,
+                           ignore_trivial=True, ordered=True,
+                           shard_size=2**26):
+    """
+    Apply a function to the BlastTables of a file's shards in a process pool.
+    The file is split as in `parse_blast_file_parallel`, every shard is
+    parsed into a single query-aligned BlastTable in a worker process and
+    `function(table)` is computed there, too. Yields the results, in the
+    file order if `ordered` is True. `function` should be picklable (ie a
+    module-level function or a partial of it) and return something small,
+    as the results are sent back to the main process. Tables may be empty.
+    :param function: callable
+    :param filename: str
+    :param processes: int or None for the CPU count
+    :param ignore_trivial: bool
+    :param ordered: bool
+    :param shard_size: int
+    :return: generator
+    """
+    if not isinstance(filename, str):
+        raise TypeError('Only filenames are accepted by map_blast_table_shards')
+    processes = processes or os.cpu_count()
+    shards = [(function, filename, start, end, ignore_trivial) for start, end
+              in pool_shards(filename, processes, shard_size)]
+    with Pool(processes=processes) as pool:
+        if ordered:
+            yield from pool.imap(_map_shard_star, shards)
+        else:
+            yield from pool.imap_unordered(_map_shard_star, shards)
+
+
+def build_query_index(filename, index_filename=None):
+    """
+    Build an index of query positions in a BLAST file.
+    For every query records the byte offset and length of its contiguous block
+    of lines. The index is written to a sidecar TSV file (`filename.qidx` by
+    default), one `query  offset  length` line per query after a header with
+    the size and modification time of the BLAST file (see `phylome.sidecar`),
+    and can be read with `load_query_index` or `BlastIndex`. The index is
+    replaced only when it's complete. Comment lines are not included in
+    the blocks. Raises ValueError if the file is not sorted by query, ie any
+    query has more than one block, or compressed.
+    Returns the index filename.
+    :param filename: str
+    :param index_filename: str
+    :return: str
+    """
+    check_uncompressed(filename)
+    index_filename = index_filename or filename + '.qidx'
+    seen = set()
+    current_query = None
+    block_start = block_end = position = 0
+    with open(filename, mode='rb') as handle, \
+            write_index(filename, index_filename) as index_handle:
+        for line in handle:
+            if not line[:1] == b'#':
+                query = line.split(b'\t', 1)[0]
+                if not query == current_query:
+                    if current_query is not None:
+                        print(current_query.decode(), block_start,
+                              block_end - block_start, sep='\t',
+                              file=index_handle)
+                    if query in seen:
+                        raise ValueError('Query {} is not contiguous in {}'.format(
+                            query.decode(), filename))
+                    seen.add(query)
+                    current_query = query
+                    block_start = position
+                block_end = position + len(line)
+            position += len(line)
+        if current_query is not None:
+            print(current_query.decode(), block_start,
+                  block_end - block_start, sep='\t', file=index_handle)
+    return index_filename
+
+
+def load_query_index(index_filename, filename=None):
+    """
+    Read a query index file produced by `build_query_index`.
+    Returns a dict of {query_id: (offset, length)}. If the BLAST `filename`
+    is given, raises ValueError when the index was made for another version
+    of it.
+    :param index_filename: str
+    :param filename: str
+    :return: dict
+    """
+    return {query: (int(offset), int(length)) for query, offset, length
+            in read_index(index_filename, filename)}
+
+
+def query_index_is_current(filename, index_filename=None):
+    """
+    Check that the query index of a BLAST file exists and is up to date.
+    :param filename: str
+    :param index_filename: str
+    :return: bool
+    """
+    return index_is_current(filename, index_filename or filename + '.qidx')
+
+
+class BlastIndex:
+    """
+    Random access to the hits of individual queries in a BLAST file.
+    Memory-maps the BLAST file and uses the query index (see
+    `build_query_index`) to parse only the blocks of the requested queries.
+    Raises ValueError if the index is outdated. Can be used as a context
+    manager.
+    """
+    def __init__(self, filename, index_filename=None):
+        self.index = load_query_index(index_filename or filename + '.qidx',
+                                      filename)
+        self.handle = open(filename, mode='rb')
+        self.map = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, query):
+        return query in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.map.close()
+        self.handle.close()
+
+    def get_hits(self, query, ignore_trivial=True, **filters):
+        """
+        Return a list of BlastHits for a single query.
+        Raises KeyError if the query is not in the index. Filters are the
+        same as in `parse_blast_file_to_hsps`.
+        :param query: str
+        :param ignore_trivial: bool
+        :return: list
+        """
+        offset, length = self.index[query]
+        text = self.map[offset:offset+length].decode()
+        return list(parse_blast_file_to_hits(StringIO(text), ignore_trivial,
+                                             **filters))
+
+    def iterate_queries(self, queries, ignore_trivial=True, **filters):
+        """
+        Yield (query_id, list of BlastHits) for every query in an iterable.
+        Queries absent from the index are silently skipped. Queries are
+        yielded in the order they are in the file, so that the reads from the
+        disk are sequential. Filters are the same as in
+        `parse_blast_file_to_hsps`.
+        `queries` may also be a store with vectorized `codes` lookup (eg
+        `phylome.clusters.ClusterStore`); then the indexed queries are looked
+        up in it, and its IDs are never decoded.
+        :param queries: iterable of str or a store
+        :param ignore_trivial: bool
+        :return: generator
+        """
+        if hasattr(queries, 'codes'):
+            indexed = list(self.index)
+            present = [x for x, code in zip(indexed, queries.codes(indexed))
+                       if code >= 0]
+        else:
+            present = [x for x in set(queries) if x in self.index]
+        present.sort(key=lambda x: self.index[x][0])
+        for query in present:
+            yield query, self.get_hits(query, ignore_trivial, **filters)
+
+
+def _line_key(line):
+    """
+    Return the `query<TAB>hit` prefix of a BLAST line. IDs contain no
+    characters below the tab, so these prefixes sort the same way as
+    (query, hit) pairs.
+    :param line: str
+    :return: str
+    """
+    return line[:line.find('\t', line.find('\t') + 1)]
+
+
+def _write_run(lines, directory):
+    """
+    Write sorted BLAST lines to a new run file in `directory`.
+    Returns the filename.
+    :param lines: iterable of str
+    :param directory: str
+    :return: str
+    """
+    descriptor, filename = mkstemp(suffix='.run', dir=directory)
+    with open(descriptor, mode='w') as handle:
+        handle.writelines(lines)
+    return filename
+
+
+def _read_run(filename):
+    """
+    Yield the lines of a run file.
+    :param filename: str
+    :return:
+    """
+    with open(filename) as handle:
+        yield from handle
+
+
+def _merge_runs(filenames, directory):
+    """
+    Merge run files into a single new one and remove them. Equal keys are
+    taken from the earlier runs first, so the merge is stable.
+    :param filenames: list of str
+    :param directory: str
+    :return: str
+    """
+    filename = _write_run(merge(*map(_read_run, filenames), key=_line_key),
+                          directory)
+    for run in filenames:
+        os.remove(run)
+    return filename
+
+
+def parse_unsorted_blast_file_to_hsps(filename, ignore_trivial=True,
+                                      memory_limit=2**28, temp_dir=None,
+                                      max_runs=64, **filters):
+    """
+    Take an unsorted BLAST file and generate BlastHSPs sorted by query and hit.
+    `assemble_hits` and `iterate_by_query` assume the input to be sorted, which
+    is not the case for, say, concatenated outputs of several BLAST or DIAMOND
+    runs. This is an external merge sort: lines are read until they take
+    roughly `memory_limit` bytes (the text plus about 64 bytes per line; sort
+    keys take some more while a run is sorted), sorted and spilled to a
+    temporary directory in `temp_dir` (system default if None), and the
+    sorted runs are then merged. At most `max_runs` run files are merged (and
+    open) at once; if there are more, they are merged in several passes.
+    The sort is stable, so the HSPs of every hit retain their order in the
+    file. Queries and hits are sorted lexicographically. Filters are the same
+    as in `parse_blast_file_to_hsps` and are applied before sorting.
+    :param filename: str or filehandle
+    :param ignore_trivial: bool
+    :param memory_limit: int
+    :param temp_dir: str
+    :param max_runs: int
+    :return: generator
+    """
+    directory = mkdtemp(dir=temp_dir)
+    try:
+        runs = []
+        run = []
+        run_size = 0
+        for arr in filter_blast_fields(filename, ignore_trivial, **filters):
+            line = '\t'.join(arr)
+            #  The last line of the file may lack a newline
+            if not line.endswith('\n'):
+                line += '\n'
+            run.append(line)
+            #  The text plus str object header and list slot
+            run_size += len(line) + 64
+            if run_size >= memory_limit:
+                run.sort(key=_line_key)
+                runs.append(_write_run(run, directory))
+                run = []
+                run_size = 0
+        while len(runs) > max_runs:
+            runs = [_merge_runs(runs[x:x + max_runs], directory)
+                    for x in range(0, len(runs), max_runs)]
+        run.sort(key=_line_key)
+        for line in merge(*map(_read_run, runs), run, key=_line_key):
+            yield fields_to_hsp(line.split('\t'))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def parse_unsorted_blast_file_to_hits(filename, ignore_trivial=True,
+                                      memory_limit=2**28, temp_dir=None,
+                                      max_runs=64, **filters):
+    """
+    Take an unsorted BLAST file and generate BlastHits sorted by query and hit.
+    See `parse_unsorted_blast_file_to_hsps` for the details.
+    :param filename: str or filehandle
+    :param ignore_trivial: bool
+    :param memory_limit: int
+    :param temp_dir: str
+    :param max_runs: int
+    :return: generator
+    """
+    return assemble_hits(parse_unsorted_blast_file_to_hsps(
+        filename, ignore_trivial, memory_limit, temp_dir, max_runs,
+        **filters))
+
+
+#  File name and dtype of every column of a BLAST cache
+CACHE_COLUMNS = {'query_ids': np.int32, 'hit_ids': np.int32,
+                 'query_start': np.int32, 'query_end': np.int32,
+                 'hit_start': np.int32, 'hit_end': np.int32,
+                 'evalue': np.float64, 'length': np.int32}
+
+
+def _read_column(filename, dtype):
+    """
+    Memory-map a column file of a BLAST cache.
+    np.memmap refuses empty files, hence this wrapper.
+    :param filename: str
+    :param dtype:
+    :return: np.ndarray
+    """
+    if os.path.getsize(filename) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r')
+
+
+def write_blast_cache(filename, cache_dir, chunk_size=2**24):
+    """
+    Convert a BLAST file into a binary columnar cache.
+    The cache is a directory of raw binary files that can be memory-mapped:
+    a column per BlastTable field (`query_ids.bin` etc., int32 or float64),
+    the ID dictionary as concatenated UTF-8 IDs (`names.bin`) with their
+    int64 offsets (`name_offsets.bin`), and int64 row offsets of every query
+    group (`groups.bin`). All HSPs, including trivial ones, are stored, so
+    that any filters can be applied when reading. Query groups are runs of
+    lines with the same query, same as in `iterate_by_query`.
+    The cache is written to a temporary directory next to `cache_dir`, which
+    replaces `cache_dir` (if it exists) only when everything is written.
+    Returns `cache_dir`.
+    :param filename: str or filehandle
+    :param cache_dir: str
+    :param chunk_size: int
+    :return: str
+    """
+    temp_dir = '{}.tmp{}'.format(cache_dir.rstrip(os.sep), os.getpid())
+    os.makedirs(temp_dir)
+    try:
+        _write_cache_files(filename, temp_dir, chunk_size)
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.rename(temp_dir, cache_dir)
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    return cache_dir
+
+
+def _write_cache_files(filename, cache_dir, chunk_size):
+    """
+    Write the files of a BLAST cache to a directory. See `write_blast_cache`.
+    :param filename: str or filehandle
+    :param cache_dir: str
+    :param chunk_size: int
+    :return:
+    """
+    handles = {x: open(os.path.join(cache_dir, x + '.bin'), mode='wb')
+               for x in list(CACHE_COLUMNS) + ['names', 'name_offsets',
+                                               'groups']}
+    names_written = 0
+    names_size = 0
+    rows = 0
+    previous_query = -1
+    np.zeros(1, dtype=np.int64).tofile(handles['name_offsets'])
+    for table in parse_blast_file_to_table(filename, ignore_trivial=False,
+                                           chunk_size=chunk_size):
+        for column in CACHE_COLUMNS:
+            getattr(table, column).tofile(handles[column])
+        new_names = [x.encode() for x in table.names[names_written:]]
+        handles['names'].write(b''.join(new_names))
+        offsets = np.cumsum([len(x) for x in new_names], dtype=np.int64)
+        (offsets + names_size).tofile(handles['name_offsets'])
+        names_written = len(table.names)
+        names_size += int(offsets[-1]) if len(offsets) else 0
+        queries = table.query_ids
+        starts = np.flatnonzero(np.diff(queries, prepend=previous_query))
+        (starts + rows).astype(np.int64).tofile(handles['groups'])
+        rows += len(queries)
+        previous_query = queries[-1]
+    np.array([rows], dtype=np.int64).tofile(handles['groups'])
+    for handle in handles.values():
+        handle.close()
+
+
+class NameTable:
+    """
+    A read-only list of IDs stored in a BLAST cache.
+    IDs are decoded from the memory-mapped file on access, so that huge
+    dictionaries are not loaded in memory. Can be used as `names` of a
+    BlastTable.
+    """
+    def __init__(self, names, offsets):
+        self.names = names
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, code):
+        return bytes(self.names[self.offsets[code]:
+                                self.offsets[code+1]]).decode()
+
+    def codes(self):
+        """
+        Return a dict of {ID: code} for all IDs. This decodes the entire
+        dictionary.
+        :return: dict
+        """
+        return {self[x]: x for x in range(len(self))}
+
+
+class BlastCache:
+    """
+    A BLAST cache created by `write_blast_cache`.
+    All columns are memory-mapped, and BlastTables returned by `query_table`
+    and `tables` (without filters) are slices of these maps, ie are not
+    copied in memory.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.exists(os.path.join(cache_dir, 'length.bin')):
+            raise ValueError('{} is not a complete BLAST cache, rebuild it'.format(
+                cache_dir))
+        self.columns = {x: _read_column(os.path.join(cache_dir, x + '.bin'),
+                                        CACHE_COLUMNS[x])
+                        for x in CACHE_COLUMNS}
+        self.names = NameTable(
+            _read_column(os.path.join(cache_dir, 'names.bin'), np.uint8),
+            _read_column(os.path.join(cache_dir, 'name_offsets.bin'),
+                         np.int64))
+        self.groups = _read_column(os.path.join(cache_dir, 'groups.bin'),
+                                   np.int64)
+        self._codes = None
+
+    def __len__(self):
+        return len(self.groups) - 1
+
+    def slice(self, start, end):
+        """
+        Return a BlastTable of rows from `start` to `end`, without copying.
+        :param start: int
+        :param end: int
+        :return: BlastTable
+        """
+        return BlastTable(self.names, **{x: self.columns[x][start:end]
+                                         for x in CACHE_COLUMNS})
+
+    def query_table(self, index):
+        """
+        Return a BlastTable of the `index`th query group.
+        :param index: int
+        :return: BlastTable
+        """
+        return self.slice(self.groups[index], self.groups[index+1])
+
+    def _id_codes(self, ids):
+        """
+        Return an array of codes for the IDs present in the cache. `ids` may
+        also be a store with vectorized `codes` lookup, which is queried with
+        all IDs of the cache instead.
+        :param ids: iterable of str or a store
+        :return: np.ndarray
+        """
+        if self._codes is None:
+            self._codes = self.names.codes()
+        if hasattr(ids, 'codes'):
+            names = list(self._codes)
+            return np.array([self._codes[x] for x, code
+                             in zip(names, ids.codes(names)) if code >= 0],
+                            dtype=np.int32)
+        return np.array([self._codes[x] for x in ids if x in self._codes],
+                        dtype=np.int32)
+
+    def shards(self, count):
+        """
+        Split the cache into about `count` row ranges of similar size that
+        don't break query groups, like `query_aligned_shards` does for files.
+        Ranges can be read with `tables(start=..., end=...)`.
+        :param count: int
+        :return: list of (start, end) tuples
+        """
+        total = int(self.groups[-1]) if len(self.groups) else 0
+        boundaries = np.unique(self.groups[np.searchsorted(
+            self.groups, np.linspace(0, total, count + 1).astype(np.int64))])
+        return [(int(start), int(end)) for start, end
+                in zip(boundaries, boundaries[1:])]
+
+    def tables(self, ignore_trivial=True, evalue_cutoff=None, min_length=None,
+               query_ids=None, hit_ids=None, chunk_rows=2**20, start=0,
+               end=None):
+        """
+        Generate BlastTables of about `chunk_rows` rows each.
+        Tables are split on query group boundaries only, so a table is longer
+        than `chunk_rows` if a single group is. Filters have the same meaning as in
+        `parse_blast_file_to_hsps` and are applied as vectorized masks. Without
+        any filters the tables are slices of the memory maps. Only the rows
+        from `start` to `end` are read; both should be group boundaries (see
+        `shards`).
+        :param ignore_trivial: bool
+        :param evalue_cutoff: float
+        :param min_length: int
+        :param query_ids: iterable of str
+        :param hit_ids: iterable of str
+        :param chunk_rows: int
+        :param start: int
+        :param end: int
+        :return: generator
+        """
+        query_codes = None if query_ids is None else self._id_codes(query_ids)
+        hit_codes = None if hit_ids is None else self._id_codes(hit_ids)
+        total = int(self.groups[-1]) if len(self.groups) else 0
+        if end is not None:
+            total = min(total, end)
+        while start < total:
+            #  Moving the end to the next group boundary
+            chunk_end = self.groups[np.searchsorted(
+                self.groups, min(start + chunk_rows, total))]
+            table = self.slice(start, chunk_end)
+            start = int(chunk_end)
+            mask = np.ones(len(table.evalue), dtype=bool)
+            if ignore_trivial:
+                mask &= table.query_ids != table.hit_ids
+            if evalue_cutoff is not None:
+                mask &= table.evalue < evalue_cutoff
+            if min_length is not None:
+                mask &= table.length >= min_length
+            if query_codes is not None:
+                mask &= np.isin(table.query_ids, query_codes)
+            if hit_codes is not None:
+                mask &= np.isin(table.hit_ids, hit_codes)
+            if not mask.all():
+                table = mask_table(table, mask)
+            if len(table.evalue):
+                yield table
+
+    def iterate_hits(self, ignore_trivial=True, **filters):
+        """
+        Generate BlastHits from the cache. Filters are the same as in `tables`.
+        :param ignore_trivial: bool
+        :return: generator
+        """
+        return tables_to_hits(self.tables(ignore_trivial, **filters))
+
+    def iterate_by_query(self, ignore_trivial=True, **filters):
+        """
+        Generate lists of BlastHits with the same query, like
+        `iterate_by_query`. Filters are the same as in `tables`.
+        :param ignore_trivial: bool
+        :return: generator
+        """
+        for group in iterate_by_query(self.iterate_hits(ignore_trivial,
+                                                        **filters)):
+            if group[0].hsps:
+                yield group
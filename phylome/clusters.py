@@ -0,0 +1,230 @@
+"""
+Compact cluster membership.
+`ClusterStore` keeps every sequence ID once, in a sorted fixed-width array,
+and refers to it by its integer code (the position in that array). Cluster
+membership is stored CSR-style: members of cluster `i` are
+`members[offsets[i]:offsets[i+1]]`, and the inverse mapping (clusters of
+every ID) is stored the same way. All arrays can be saved as .npy files and
+memory-mapped, so that several scripts can share the same store. Lookups
+are vectorized (`codes`); BLAST parsers use them for batches of lines when
+a store is passed as `query_ids`.
+"""
+
+import os
+
+import numpy as np
+
+from phylome.lookup import find_sorted
+
+
+class ClusterStore:
+    """
+    Cluster membership as NumPy arrays.
+    `ids` is a sorted array of unique IDs (as bytes); `offsets` (int64) and
+    `members` (int32 codes) hold the clusters, `id_offsets` and
+    `id_clusters` hold the clusters of every ID, and `last_cluster` is the
+    last cluster an ID belongs to (what a simple ID to cluster dict would
+    hold).
+    Build it with `from_lists` or `from_pairs`.
+    """
+    def __init__(self, ids, offsets, members, id_offsets=None,
+                 id_clusters=None, last_cluster=None):
+        self.ids = ids
+        self.offsets = offsets
+        self.members = members
+        if id_offsets is None:
+            id_offsets, id_clusters, last_cluster = self._invert()
+        self.id_offsets = id_offsets
+        self.id_clusters = id_clusters
+        self.last_cluster = last_cluster
+        #  BLAST files ask about the same query many times in a row
+        self._last_lookup = (None, -1)
+
+    def _invert(self):
+        """
+        Calculate the clusters of every ID from the cluster members.
+        :return: tuple of id_offsets, id_clusters, last_cluster
+        """
+        member_clusters = np.repeat(np.arange(len(self.offsets) - 1,
+                                              dtype=np.int32),
+                                    np.diff(self.offsets))
+        #  Stable sort keeps the clusters of every ID in ascending order
+        order = np.argsort(self.members, kind='stable')
+        id_clusters = member_clusters[order]
+        id_offsets = np.zeros(len(self.ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.members, minlength=len(self.ids)),
+                  out=id_offsets[1:])
+        last_cluster = np.full(len(self.ids), -1, dtype=np.int32)
+        present = id_offsets[1:] > id_offsets[:-1]
+        last_cluster[present] = id_clusters[id_offsets[1:][present] - 1]
+        return id_offsets, id_clusters, last_cluster
+
+    @classmethod
+    def from_lists(cls, lists):
+        """
+        Build a store from an iterable of ID lists, one per cluster.
+        Lists are consumed one at a time, so only the encoded IDs are kept
+        until the arrays are built. Repeated IDs in a list are stored once.
+        :param lists: iterable of lists of str
+        :return: ClusterStore
+        """
+        flat = []
+        sizes = []
+        for ids in lists:
+            ids = list(dict.fromkeys(ids))
+            flat.extend(x.encode() for x in ids)
+            sizes.append(len(ids))
+        ids, codes = np.unique(np.array(flat, dtype=bytes),
+                               return_inverse=True)
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        return cls(ids, offsets, codes.astype(np.int32).ravel())
+
+    @classmethod
+    def from_pairs(cls, pairs, cluster_count=None):
+        """
+        Build a store from (cluster, ID) pairs, where clusters are numbered
+        from 0. Repeated pairs are stored once. Clusters without any pairs are
+        empty; `cluster_count` may add more empty clusters at the end.
+        :param pairs: iterable of (int, str) tuples
+        :param cluster_count: int
+        :return: ClusterStore
+        """
+        clusters = []
+        flat = []
+        for cluster, seqid in pairs:
+            clusters.append(cluster)
+            flat.append(seqid.encode())
+        ids, codes = np.unique(np.array(flat, dtype=bytes),
+                               return_inverse=True)
+        pairs = np.unique(np.stack([np.array(clusters, dtype=np.int64),
+                                    codes.ravel().astype(np.int64)]),
+                          axis=1) if flat else np.zeros((2, 0), np.int64)
+        count = max(cluster_count or 0,
+                    int(pairs[0].max()) + 1 if flat else 0)
+        offsets = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pairs[0], minlength=count), out=offsets[1:])
+        return cls(ids, offsets, pairs[1].astype(np.int32))
+
+    def save(self, path, parameters=None):
+        """
+        Save the store as a directory of .npy files.
+        `parameters` (eg the filters the clusters were selected with) are
+        saved as `parameters.tsv`, last, so that `load` can check them.
+        :param path: str
+        :param parameters: dict
+        :return:
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in ('ids', 'offsets', 'members', 'id_offsets',
+                     'id_clusters', 'last_cluster'):
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'parameters.tsv'), mode='w') as handle:
+            for key, value in (parameters or {}).items():
+                print(key, value, sep='\t', file=handle)
+
+    @classmethod
+    def load(cls, path, parameters=None):
+        """
+        Memory-map a store saved with `save`.
+        If `parameters` are given, raises ValueError unless the store was
+        saved with the same ones (compared as strings); parameters that are
+        None are not checked.
+        :param path: str
+        :param parameters: dict
+        :return: ClusterStore
+        """
+        if parameters is not None:
+            try:
+                with open(os.path.join(path, 'parameters.tsv')) as handle:
+                    saved = dict(line.rstrip('\n').split('\t', 1)
+                                 for line in handle)
+            except FileNotFoundError:
+                raise ValueError('{} is not a complete cluster store'.format(
+                    path))
+            different = [key for key, value in parameters.items()
+                         if value is not None and
+                         not saved.get(key) == str(value)]
+            if different:
+                raise ValueError('Cluster store {} was made with different {}'.format(
+                    path, ', '.join(different)))
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                  for name in ('ids', 'offsets', 'members', 'id_offsets',
+                               'id_clusters', 'last_cluster')]
+        return cls(*arrays)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return (x.decode() for x in self.ids)
+
+    def __contains__(self, seqid):
+        return self.code(seqid) >= 0
+
+    def codes(self, seqids):
+        """
+        Return codes for a list of IDs, -1 for the unknown ones.
+        :param seqids: iterable of str
+        :return: np.ndarray of int64
+        """
+        return find_sorted(self.ids, [x.encode() for x in seqids])
+
+    def code(self, seqid):
+        """
+        Return the code of a single ID, or -1 if it's unknown.
+        :param seqid: str
+        :return: int
+        """
+        if not seqid == self._last_lookup[0]:
+            self._last_lookup = (seqid, int(self.codes([seqid])[0]))
+        return self._last_lookup[1]
+
+    def members_of(self, cluster):
+        """
+        Return the IDs of a cluster.
+        :param cluster: int
+        :return: list of str
+        """
+        codes = self.members[self.offsets[cluster]:self.offsets[cluster + 1]]
+        return [x.decode() for x in self.ids[codes]]
+
+    def clusters_of_code(self, code):
+        """
+        Return all clusters of an ID by its code.
+        :param code: int
+        :return: np.ndarray of int32
+        """
+        return self.id_clusters[self.id_offsets[code]:self.id_offsets[code + 1]]
+
+    def clusters_of(self, seqid):
+        """
+        Return all clusters of an ID (empty for unknown ones).
+        :param seqid: str
+        :return: np.ndarray of int32
+        """
+        code = self.code(seqid)
+        if code < 0:
+            return self.id_clusters[:0]
+        return self.clusters_of_code(code)
+
+    def cluster_of(self, seqid):
+        """
+        Return the last cluster an ID belongs to, or -1 if it's unknown.
+        :param seqid: str
+        :return: int
+        """
+        code = self.code(seqid)
+        return int(self.last_cluster[code]) if code >= 0 else -1
+
+    def routes(self, outputs):
+        """
+        Return a routing function for `demultiplex_fasta`: every ID is
+        written to the outputs of all its clusters.
+        :param outputs: list, an output (eg filename) for every cluster
+        :return: callable
+        """
+        def route_batch(seqids):
+            return [[outputs[x] for x in self.clusters_of_code(code)]
+                    if code >= 0 else () for code in self.codes(seqids)]
+        return route_batch
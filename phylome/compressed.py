@@ -0,0 +1,192 @@
+"""
+Transparent reading of compressed files.
+BLAST outputs (and pretty much everything else) tend to be archived as gzip,
+BGZF or zstd. Instead of decompressing them to a scratch disk before every run,
+`open_compressed` detects the compression by magic bytes and returns a text
+handle that decompresses on the fly. BGZF files, being a series of
+independent gzip blocks, are decompressed in several threads ahead of the
+reader.
+"""
+
+import gzip
+import io
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def header_compression(header):
+    """
+    Return the compression detected by the first (up to 16) bytes of a file.
+    Returns 'bgzf', 'gzip', 'zstd' or None for uncompressed files. BGZF is
+    gzip with the `BC` extra subfield in the header of the first block.
+    :param header: bytes
+    :return: str or None
+    """
+    if header[:2] == GZIP_MAGIC:
+        #  FEXTRA flag set and the first extra subfield is BC
+        if len(header) >= 16 and header[3] & 4 and header[12:14] == b'BC':
+            return 'bgzf'
+        return 'gzip'
+    if header[:4] == ZSTD_MAGIC:
+        return 'zstd'
+    return None
+
+
+def compression_type(filename):
+    """
+    Return the compression of a file as detected by its magic bytes (see
+    `header_compression`). The file is opened just for that, so this is not
+    for pipes; `open_compressed` detects the compression on its own handle.
+    :param filename: str
+    :return: str or None
+    """
+    with open(filename, mode='rb') as handle:
+        return header_compression(handle.read(16))
+
+
+def check_uncompressed(filename):
+    """
+    Raise ValueError if the file is compressed.
+    Byte offsets are meaningless in the compressed files, so everything
+    seeking in a file (or indexing it) should call this first.
+    :param filename: str
+    :return:
+    """
+    if compression_type(filename):
+        raise ValueError('Random access is impossible in a compressed file {}'.format(
+            filename))
+
+
+class BGZFReader(io.RawIOBase):
+    """
+    A raw binary stream of decompressed BGZF data.
+    Blocks are read sequentially, but decompressed in a thread pool (zlib
+    releases the GIL) with up to `lookahead` blocks in flight. Wrap it in
+    io.BufferedReader and io.TextIOWrapper to get a text handle. `filename`
+    may also be a binary filehandle.
+    """
+    def __init__(self, filename, threads=None, lookahead=None):
+        super().__init__()
+        #  A binary handle is taken over and closed with the reader
+        if isinstance(filename, str):
+            filename = open(filename, mode='rb')
+        self.handle = filename
+        threads = threads or os.cpu_count()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.lookahead = lookahead or threads * 4
+        self.pending = deque()
+        self.buffer = b''
+        self.buffer_position = 0
+        self.eof = False
+        self._fill_pending()
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if not self.closed:
+            self.executor.shutdown(cancel_futures=True)
+            self.handle.close()
+        super().close()
+
+    def _read_block(self):
+        """
+        Read a single compressed block and return its deflate payload, or
+        None at the end of file.
+        :return: bytes or None
+        """
+        header = self.handle.read(12)
+        if not header:
+            return None
+        if len(header) < 12 or not header[:2] == GZIP_MAGIC:
+            raise ValueError('Invalid BGZF block in {}'.format(self.handle.name))
+        extra_length = struct.unpack('<H', header[10:12])[0]
+        extra = self.handle.read(extra_length)
+        block_size = None
+        position = 0
+        while position < extra_length:
+            subfield_length = struct.unpack(
+                '<H', extra[position+2:position+4])[0]
+            if extra[position:position+2] == b'BC':
+                block_size = struct.unpack(
+                    '<H', extra[position+4:position+6])[0] + 1
+            position += 4 + subfield_length
+        if block_size is None:
+            raise ValueError('No BGZF block size in {}'.format(self.handle.name))
+        #  Payload is followed by CRC32 and ISIZE, 4 bytes each
+        body = self.handle.read(block_size - 12 - extra_length)
+        return body[:-8]
+
+    def _fill_pending(self):
+        while not self.eof and len(self.pending) < self.lookahead:
+            block = self._read_block()
+            if block is None:
+                self.eof = True
+            else:
+                self.pending.append(self.executor.submit(zlib.decompress,
+                                                         block, -15))
+
+    def readinto(self, b):
+        while self.buffer_position == len(self.buffer):
+            if not self.pending:
+                return 0
+            self.buffer = self.pending.popleft().result()
+            self.buffer_position = 0
+            self._fill_pending()
+        size = min(len(b), len(self.buffer) - self.buffer_position)
+        b[:size] = self.buffer[self.buffer_position:self.buffer_position+size]
+        self.buffer_position += size
+        return size
+
+
+class _GzipReader(gzip.GzipFile):
+    """
+    GzipFile reading from a handle, which is closed along with it.
+    """
+    def close(self):
+        handle = self.fileobj
+        super().close()
+        if handle is not None:
+            handle.close()
+
+
+def open_compressed(filename, threads=None, binary=False):
+    """
+    Open a possibly compressed file for reading in text mode (or in binary
+    mode, if `binary` is set).
+    Uncompressed files are simply opened. gzip and zstd are decompressed as a
+    stream, BGZF is decompressed in `threads` threads (CPU count by default).
+    zstd requires the `zstandard` package. The file is opened only once and
+    the compression is detected by peeking at its buffer, so pipes (eg
+    `<(zcat ...)` or /dev/stdin) are fine too.
+    :param filename: str
+    :param threads: int
+    :param binary: bool
+    :return: filehandle
+    """
+    handle = open(filename, mode='rb', buffering=2**20)
+    try:
+        compression = header_compression(handle.peek(16)[:16])
+        if compression == 'gzip':
+            handle = _GzipReader(fileobj=handle, mode='rb')
+        elif compression == 'bgzf':
+            handle = io.BufferedReader(BGZFReader(handle, threads),
+                                       buffer_size=2**20)
+        elif compression == 'zstd':
+            #  Optional dependency, only needed for zstd files
+            import zstandard
+            handle = zstandard.ZstdDecompressor().stream_reader(handle,
+                                                                closefd=True)
+    except BaseException:
+        handle.close()
+        raise
+    if binary:
+        return handle
+    return io.TextIOWrapper(handle)
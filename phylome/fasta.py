@@ -0,0 +1,313 @@
+"""
+FASTA utilities.
+`read_fasta` is a lightweight bytes-level reader: records are
+`FastaRecord` tuples holding the raw bytes of the record as they are in
+the file, so that records passed through are written back unchanged by
+`write_fasta`, and nothing is parsed beyond the header line.
+`fasta_statistics` and `filter_fasta_records` count residues, X and
+lowercase letters of many records at once with NumPy.
+`Demultiplexer` writes records to a large number of output files without
+keeping them all open: writes are buffered per file and flushed through a
+bounded pool of handles, the least recently used of which are closed and
+later reopened in append mode. It allows splitting a FASTA file into any
+number of outputs in a single pass.
+"""
+
+from collections import OrderedDict, namedtuple
+from itertools import islice
+
+import numpy as np
+
+from phylome.compressed import open_compressed
+
+
+#  `header` is the header line without `>` and the newline, `sequence` is a
+#  memoryview of the sequence lines (with newlines) and `raw` is the entire
+#  record
+FastaRecord = namedtuple('FastaRecord', ['id', 'header', 'sequence', 'raw'])
+
+#  Per-record counts: residues (everything but whitespace), X (either case),
+#  lowercase letters and masked residues (lowercase or X)
+FastaStatistics = namedtuple('FastaStatistics', ['length', 'x_count',
+                                                 'lowercase_count',
+                                                 'masked_count'])
+
+#  Lookup tables of byte classes
+_RESIDUE = np.ones(256, dtype=np.int64)
+_RESIDUE[list(b' \t\r\n')] = 0
+_X = np.zeros(256, dtype=np.int64)
+_X[list(b'Xx')] = 1
+_LOWERCASE = np.zeros(256, dtype=np.int64)
+_LOWERCASE[list(b'abcdefghijklmnopqrstuvwxyz')] = 1
+_MASKED = _LOWERCASE.copy()
+_MASKED[ord('X')] = 1
+
+
+def split_records(data):
+    """
+    Yield FastaRecords from a bytes object that consists of complete records.
+    Anything before the first header is ignored.
+    :param data: bytes
+    :return:
+    """
+    start = 0 if data[:1] == b'>' else data.find(b'\n>') + 1
+    if start == 0 and not data[:1] == b'>':
+        return
+    while start < len(data):
+        end = data.find(b'\n>', start) + 1 or len(data)
+        raw = data[start:end]
+        header_end = raw.find(b'\n')
+        if header_end == -1:
+            header_end = len(raw)
+        header = raw[1:header_end].rstrip(b'\r')
+        words = header.split(None, 1)
+        yield FastaRecord(words[0].decode() if words else '', header,
+                          memoryview(raw)[header_end + 1:], raw)
+        start = end
+
+
+def read_fasta(filename, chunk_size=2**24):
+    """
+    Iterate over FASTA records as FastaRecord tuples.
+    The file (which may be compressed) is read in large chunks, split on
+    record boundaries. `id` is the first word of the header, same as
+    `SeqRecord.id`.
+    :param filename: str
+    :param chunk_size: int
+    :return:
+    """
+    with open_compressed(filename, binary=True) as handle:
+        #  Chunks of the incomplete last record, joined once it's complete,
+        #  so that records longer than a chunk aren't copied over and over
+        pieces = []
+        while True:
+            chunk = handle.read(chunk_size)
+            if not chunk:
+                yield from split_records(b''.join(pieces))
+                return
+            last = chunk.rfind(b'\n>')
+            if last != -1:
+                last += 1
+            elif chunk[:1] == b'>' and pieces and pieces[-1][-1:] == b'\n':
+                #  Record boundary between the chunks
+                last = 0
+            else:
+                pieces.append(chunk)
+                continue
+            pieces.append(chunk[:last])
+            yield from split_records(b''.join(pieces))
+            pieces = [chunk[last:]]
+
+
+def sequence_bytes(record):
+    """
+    Return the sequence of a FastaRecord as bytes, without line breaks and
+    other whitespace.
+    :param record: FastaRecord
+    :return: bytes
+    """
+    return record.sequence.tobytes().translate(None, b' \t\r\n')
+
+
+def write_fasta(records, handle):
+    """
+    Write FastaRecords to a binary filehandle exactly as they were read.
+    A newline is added to the records that lack it (ie the last record of a
+    file without a final newline).
+    Returns the number of records written.
+    :param records: iterable of FastaRecords
+    :param handle: binary filehandle
+    :return: int
+    """
+    count = 0
+    for record in records:
+        handle.write(record.raw)
+        if not record.raw.endswith(b'\n'):
+            handle.write(b'\n')
+        count += 1
+    return count
+
+
+def fasta_statistics(records):
+    """
+    Count residues, X, lowercase and masked residues for a list of records.
+    Sequences are concatenated into a single NumPy array, and every count is
+    a difference of cumulative sums at the record boundaries, so there are
+    no per-residue Python loops. Whitespace is not counted, so `length` is
+    the same as `len(SeqRecord)`.
+    :param records: list of FastaRecords
+    :return: FastaStatistics of int64 arrays
+    """
+    sizes = np.array([len(x.sequence) for x in records], dtype=np.int64)
+    bounds = np.zeros(len(records) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=bounds[1:])
+    data = np.frombuffer(b''.join(x.sequence for x in records),
+                         dtype=np.uint8)
+
+    def count(table):
+        cumulative = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum(table[data], out=cumulative[1:])
+        return cumulative[bounds[1:]] - cumulative[bounds[:-1]]
+
+    return FastaStatistics(count(_RESIDUE), count(_X), count(_LOWERCASE),
+                           count(_MASKED))
+
+
+def filter_fasta_records(records, min_length=None, max_x=None,
+                         max_masked=None, batch_size=10000):
+    """
+    Yield the records that pass all the filters.
+    A record is accepted if it's longer than `min_length`, its fraction of X
+    is below `max_x` and its fraction of masked residues (lowercase or X) is
+    at most `max_masked`. Filters that are None are not applied. Records are
+    processed in batches of `batch_size` with `fasta_statistics`.
+    :param records: iterable of FastaRecords
+    :param min_length: int
+    :param max_x: float
+    :param max_masked: float
+    :param batch_size: int
+    :return:
+    """
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        statistics = fasta_statistics(batch)
+        #  Empty sequences have no X or masked residues
+        length = np.maximum(statistics.length, 1)
+        accepted = np.ones(len(batch), dtype=bool)
+        if min_length is not None:
+            accepted &= statistics.length > min_length
+        if max_x is not None:
+            accepted &= statistics.x_count / length < max_x
+        if max_masked is not None:
+            accepted &= statistics.masked_count / length <= max_masked
+        for index in np.flatnonzero(accepted):
+            yield batch[index]
+
+
+class Demultiplexer:
+    """
+    Buffered binary writer to many files with at most `max_handles` of them
+    open. Every file gets a buffer that's flushed when it exceeds
+    `buffer_size` bytes; when all buffers together exceed `max_buffered`,
+    everything is flushed. Files should be registered with `create`, which
+    truncates them, before anything is written, as all later writes append.
+    Use as a context manager or call `close` to flush the remaining data.
+    """
+    def __init__(self, max_handles=1000, buffer_size=2**16,
+                 max_buffered=2**28):
+        self.max_handles = max_handles
+        self.buffer_size = buffer_size
+        self.max_buffered = max_buffered
+        self.handles = OrderedDict()
+        self.buffers = {}
+        self.buffer_sizes = {}
+        self.buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def create(self, filename):
+        """
+        Create (or truncate) an output file.
+        :param filename: str
+        :return:
+        """
+        if filename in self.handles:
+            self.handles.pop(filename).close()
+        self.buffers[filename] = []
+        self.buffer_sizes[filename] = 0
+        open(filename, mode='wb').close()
+
+    def _get_handle(self, filename):
+        """
+        Return an open handle for a file, closing the least recently used
+        one if there are too many.
+        :param filename: str
+        :return:
+        """
+        if filename in self.handles:
+            self.handles.move_to_end(filename)
+            return self.handles[filename]
+        if len(self.handles) >= self.max_handles:
+            self.handles.popitem(last=False)[1].close()
+        handle = open(filename, mode='ab')
+        self.handles[filename] = handle
+        return handle
+
+    def flush(self, filename):
+        """
+        Write the buffer of a single file.
+        :param filename: str
+        :return:
+        """
+        if self.buffers[filename]:
+            self._get_handle(filename).write(b''.join(self.buffers[filename]))
+            self.buffered -= self.buffer_sizes[filename]
+            self.buffers[filename] = []
+            self.buffer_sizes[filename] = 0
+
+    def flush_all(self):
+        for filename in self.buffers:
+            self.flush(filename)
+
+    def write(self, filename, data):
+        """
+        Append bytes to a file created with `create`.
+        :param filename: str
+        :param data: bytes
+        :return:
+        """
+        self.buffers[filename].append(data)
+        self.buffer_sizes[filename] += len(data)
+        self.buffered += len(data)
+        if self.buffer_sizes[filename] >= self.buffer_size:
+            self.flush(filename)
+        elif self.buffered >= self.max_buffered:
+            self.flush_all()
+
+    def close(self):
+        self.flush_all()
+        for handle in self.handles.values():
+            handle.close()
+        self.handles = OrderedDict()
+
+
+def demultiplex_fasta(filename, routes, demultiplexer, batch_size=10000):
+    """
+    Split a FASTA file in a single pass.
+    Every record with a route is written, as it is in the input, to all
+    files listed for it; other records are skipped. The output files should
+    already be created in the demultiplexer.
+    `routes` is either a dict of sequence ID to a list of output filenames,
+    or a function that takes a list of IDs and returns a list of such lists
+    (empty for the IDs to skip); records are routed in batches of
+    `batch_size`, so that it can do vectorized lookups (eg in ClusterStore).
+    :param filename: str. FASTA file
+    :param routes: dict or callable
+    :param demultiplexer: Demultiplexer
+    :param batch_size: int
+    :return: int. Number of records written (once per ID)
+    """
+    if isinstance(routes, dict):
+        route_batch = lambda seqids: [routes.get(x, ()) for x in seqids]
+    else:
+        route_batch = routes
+    count = 0
+    records = read_fasta(filename)
+    for batch in iter(lambda: list(islice(records, batch_size)), []):
+        for record, outputs in zip(batch, route_batch([x.id for x in batch])):
+            if not len(outputs):
+                continue
+            raw = record.raw
+            if not raw.endswith(b'\n'):
+                raw += b'\n'
+            for output in outputs:
+                demultiplexer.write(output, raw)
+            count += 1
+    return count
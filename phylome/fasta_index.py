@@ -0,0 +1,232 @@
+"""
+Random access to the records of a FASTA file.
+`build_fasta_index` scans a FASTA file once and writes a sidecar index
+(`filename.fidx` directory by default): a sorted fixed-width array of record
+IDs with byte offsets and lengths of the records, all saved as .npy files.
+`FastaIndex` memory-maps these arrays and the FASTA, finds the requested IDs
+with a binary search and copies the raw bytes of their records to the
+output, without parsing them, so pulling a few thousand records out of a huge
+database takes neither a full scan nor loading the entire index. Indices
+made for another version of the FASTA (eg before `filter_fasta.py -i`) are
+rebuilt.
+"""
+
+import mmap
+import os
+import shutil
+
+import numpy as np
+
+from phylome.compressed import check_uncompressed
+from phylome.lookup import find_sorted
+from phylome.sidecar import source_stamp
+
+
+INDEX_ARRAYS = ('ids', 'offsets', 'lengths')
+
+
+def _record_positions(data, chunk_size):
+    """
+    Yield (ids, offsets, lengths) arrays for chunks of up to `chunk_size`
+    records of a memory-mapped FASTA.
+    :param data: mmap
+    :param chunk_size: int
+    :return: generator
+    """
+    #  Anything before the first header is ignored, like in SeqIO
+    start = 0 if data[:1] == b'>' else data.find(b'\n>') + 1
+    if start == 0 and not data[:1] == b'>':
+        return
+    ids = []
+    offsets = []
+    while start < len(data):
+        end = data.find(b'\n>', start) + 1 or len(data)
+        header_end = data.find(b'\n', start, end)
+        if header_end == -1:
+            header_end = end
+        seqid = data[start + 1:header_end].split(None, 1)
+        ids.append(seqid[0] if seqid else b'')
+        offsets.append(start)
+        start = end
+        if len(ids) == chunk_size or start == len(data):
+            offsets = np.array(offsets + [start], dtype=np.int64)
+            yield np.array(ids, dtype=bytes), offsets[:-1], np.diff(offsets)
+            ids = []
+            offsets = []
+
+
+def build_fasta_index(filename, index_filename=None, chunk_size=2**20):
+    """
+    Build an index of record positions in a FASTA file.
+    Every record (from its `>` line to the next one) is indexed by its ID,
+    the first word of the header, same as `SeqRecord.id`. If an ID occurs
+    several times, only the first record is kept. The index is a directory
+    of .npy files, `ids` (sorted), `offsets` and `lengths`, and a `source`
+    file with size and modification time of the FASTA (see
+    `phylome.sidecar`). It is written to a temporary directory that replaces
+    `index_filename` only when complete. Raises ValueError for compressed
+    files. Returns the index filename.
+    :param filename: str
+    :param index_filename: str
+    :param chunk_size: int. Records scanned before their IDs become an array
+    :return: str
+    """
+    check_uncompressed(filename)
+    index_filename = index_filename or filename + '.fidx'
+    #  Stamp is taken first, so that changes during the scan make it stale
+    stamp = source_stamp(filename)
+    temp_dir = '{}.tmp{}'.format(index_filename.rstrip(os.sep), os.getpid())
+    os.makedirs(temp_dir)
+    try:
+        chunks = []
+        with open(filename, mode='rb') as handle:
+            #  Empty file can't be mapped
+            if os.fstat(handle.fileno()).st_size:
+                with mmap.mmap(handle.fileno(), 0,
+                               access=mmap.ACCESS_READ) as data:
+                    chunks = list(_record_positions(data, chunk_size))
+        if chunks:
+            ids, offsets, lengths = (np.concatenate(x) for x in zip(*chunks))
+        else:
+            ids = np.array([], dtype='S1')
+            offsets = lengths = np.array([], dtype=np.int64)
+        #  Stable sort keeps the first of the repeated IDs first
+        order = np.argsort(ids, kind='stable')
+        ids = ids[order]
+        first = np.ones(len(ids), dtype=bool)
+        first[1:] = ids[1:] != ids[:-1]
+        for name, array in zip(INDEX_ARRAYS, (ids, offsets[order],
+                                              lengths[order])):
+            np.save(os.path.join(temp_dir, name + '.npy'), array[first])
+        with open(os.path.join(temp_dir, 'source'), mode='w') as handle:
+            handle.write(stamp)
+        if os.path.isdir(index_filename):
+            shutil.rmtree(index_filename)
+        elif os.path.exists(index_filename):
+            #  Index in the old TSV format
+            os.remove(index_filename)
+        os.rename(temp_dir, index_filename)
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    return index_filename
+
+
+def fasta_index_is_current(filename, index_filename=None):
+    """
+    Check that the index of a FASTA file exists and was made for its current
+    version.
+    :param filename: str
+    :param index_filename: str
+    :return: bool
+    """
+    index_filename = index_filename or filename + '.fidx'
+    try:
+        with open(os.path.join(index_filename, 'source')) as handle:
+            return handle.read() == source_stamp(filename)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+
+
+def load_fasta_index(index_filename, filename=None):
+    """
+    Memory-map a FASTA index made by `build_fasta_index`.
+    Returns a tuple of sorted IDs (fixed-width bytes), offsets and lengths of
+    the records. If the indexed FASTA `filename` is given, raises ValueError
+    when the index was made for another version of it.
+    :param index_filename: str
+    :param filename: str
+    :return: tuple of np.ndarray
+    """
+    if filename is not None and \
+            not fasta_index_is_current(filename, index_filename):
+        raise ValueError('Index {} is outdated or incomplete, rebuild it'.format(
+            index_filename))
+    return tuple(np.load(os.path.join(index_filename, name + '.npy'),
+                         mmap_mode='r') for name in INDEX_ARRAYS)
+
+
+class FastaIndex:
+    """
+    Random access to FASTA records by their IDs.
+    Memory-maps the FASTA file and the index made by `build_fasta_index`
+    (which is rebuilt if `filename.fidx` doesn't exist yet or is outdated).
+    Records are returned as raw bytes, exactly as they are in the file. Can
+    be used as a context manager.
+    """
+    def __init__(self, filename, index_filename=None):
+        index_filename = index_filename or filename + '.fidx'
+        if not fasta_index_is_current(filename, index_filename):
+            build_fasta_index(filename, index_filename)
+        self.ids, self.offsets, self.lengths = load_fasta_index(index_filename,
+                                                                filename)
+        self.handle = open(filename, mode='rb')
+        self.map = mmap.mmap(self.handle.fileno(), 0,
+                             access=mmap.ACCESS_READ) if len(self.ids) else b''
+
+    def __contains__(self, seqid):
+        return find_sorted(self.ids, [seqid.encode()])[0] >= 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        """
+        Iterate over the IDs in the order they are in the file.
+        """
+        order = np.argsort(self.offsets)
+        return (self.ids[x].decode() for x in order)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if len(self.ids):
+            self.map.close()
+        self.handle.close()
+
+    def _raw(self, position):
+        """
+        Return raw bytes of the record at a position of the index, always
+        ending with a newline.
+        :param position: int
+        :return: bytes
+        """
+        offset = int(self.offsets[position])
+        raw = self.map[offset:offset + int(self.lengths[position])]
+        if not raw.endswith(b'\n'):
+            raw += b'\n'
+        return raw
+
+    def get_raw(self, seqid):
+        """
+        Return raw bytes of a single record, always ending with a newline.
+        Raises KeyError if the ID is not in the index.
+        :param seqid: str
+        :return: bytes
+        """
+        position = find_sorted(self.ids, [seqid.encode()])[0]
+        if position < 0:
+            raise KeyError(seqid)
+        return self._raw(position)
+
+    def write_records(self, seqids, handle):
+        """
+        Copy the records with given IDs to a binary filehandle.
+        Records are written in the order they are in the FASTA file, so that
+        the reads are sequential; IDs absent from the index are silently
+        skipped.
+        Returns the number of records written.
+        :param seqids: iterable of str
+        :param handle: binary filehandle
+        :return: int
+        """
+        positions = find_sorted(self.ids, [x.encode() for x in set(seqids)])
+        positions = positions[positions >= 0]
+        positions = positions[np.argsort(self.offsets[positions])]
+        for position in positions:
+            handle.write(self._raw(position))
+        return len(positions)
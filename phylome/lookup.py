@@ -0,0 +1,30 @@
+"""
+Bulk lookups in sorted arrays of IDs.
+Accession indices, cluster stores and FASTA indices keep their IDs as sorted
+fixed-width bytes arrays (usually memory-mapped .npy files), so that a list
+of IDs is found with a single `np.searchsorted` call.
+"""
+
+import numpy as np
+
+
+def find_sorted(keys, ids):
+    """
+    Return the positions of IDs in a sorted fixed-width bytes array, -1 for
+    the absent ones.
+    :param keys: sorted np.ndarray of bytes
+    :param ids: list of bytes
+    :return: np.ndarray of int64
+    """
+    result = np.full(len(ids), -1, dtype=np.int64)
+    if not len(ids) or not len(keys):
+        return result
+    #  Anything longer than the key width would be silently truncated
+    width = keys.dtype.itemsize
+    fits = np.array([len(x) <= width for x in ids], dtype=bool)
+    queries = np.array(ids, dtype=keys.dtype)
+    positions = np.searchsorted(keys, queries)
+    positions[positions == len(keys)] = 0
+    found = fits & (keys[positions] == queries)
+    result[found] = positions[found]
+    return result
@@ -12,8 +12,13 @@ previously repeat-containing gene being split in pieces. Thus, the (ancestral)
 shorter form is always assumed to be in a hit, and the longer in a query.
 """
 
+from array import array
 from itertools import combinations
 
+import numpy as np
+
+from phylome.blast_parser import CompactHit
+
 
 def overlap(range1, range2):
     """
@@ -37,6 +42,47 @@ def overlap_len(range1, range2):
     return min(range1[1], range2[1]) - max(range1[0], range2[0])
 
 
+def hsp_pair_is_duplicate(h1, h2, overlap_cutoff):
+    """
+    Return True if two HSPs cover the same region of hit with different
+    regions of query.
+    Overlap on hit should be at least `overlap_cutoff` of both HSPs' lengths
+    on hit.
+    :param h1: BlastHSP
+    :param h2: BlastHSP
+    :param overlap_cutoff: float
+    :return:
+    """
+    if overlap(h1.hit_pos, h2.hit_pos) and \
+            not overlap(h1.query_pos, h2.query_pos):
+        l = overlap_len(h1.hit_pos, h2.hit_pos)
+        if l >= abs(h1.hit_pos[1]-h1.hit_pos[0]) * overlap_cutoff and \
+                l >= abs(h2.hit_pos[1]-h2.hit_pos[0]) * overlap_cutoff:
+            return True
+    return False
+
+
+def is_duplicate_pairwise(hit, overlap_cutoff=0.5, len_cutoff=50):
+    """
+    The original quadratic implementation of `is_duplicate`.
+    Tests every pair of HSPs; kept as a reference for testing the faster one
+    and for the hits with reverse hit coordinates.
+    :param hit: BlastHit
+    :param overlap_cutoff: int
+    :param len_cutoff: int
+    :return:
+    """
+    if len(hit.hsps) < 2:
+        #  Obviously one-HSP hit can't have the evidence we look for
+        return False
+    valid_hsps = filter(lambda x: abs(x.hit_pos[1]-x.hit_pos[0]) > len_cutoff,
+                        hit.hsps)
+    for h1, h2 in combinations(valid_hsps, 2):
+        if hsp_pair_is_duplicate(h1, h2, overlap_cutoff):
+            return True
+    return False
+
+
 def is_duplicate(hit, overlap_cutoff=0.5, len_cutoff=50):
     """
     Return True if this hit covers several regions of query sequence with the
@@ -46,6 +92,11 @@ def is_duplicate(hit, overlap_cutoff=0.5, len_cutoff=50):
     meaningful. Defaults to 50.
     `overlap_cutoff` is a minimum percentage of both hsps that should be in the
     overlap for it to be considered meaningful. Defaults to 0.5
+    This is a sweep over HSPs sorted by their start on hit: only the pairs
+    that actually overlap on hit are compared, so repeat-rich hits with
+    hundreds of HSPs don't cost a quadratic number of checks (unless all of
+    them overlap). Returns the same as `is_duplicate_pairwise`, which is
+    used if any HSP has reverse coordinates on hit.
     :param hit: BlastHit
     :param overlap_cutoff: int
     :param len_cutoff: int
@@ -54,13 +105,294 @@ def is_duplicate(hit, overlap_cutoff=0.5, len_cutoff=50):
     if len(hit.hsps) < 2:
         #  Obviously one-HSP hit can't have the evidence we look for
         return False
-    valid_hsps = filter(lambda x: abs(x.hit_pos[1]-x.hit_pos[0]) > len_cutoff,
-                        hit.hsps)
-    for h1, h2 in combinations(valid_hsps, 2):
-        if overlap(h1.hit_pos, h2.hit_pos) and \
-                not overlap(h1.query_pos, h2.query_pos):
-            l = overlap_len(h1.hit_pos, h2.hit_pos)
-            if l >= abs(h1.hit_pos[1]-h1.hit_pos[0]) * overlap_cutoff and \
-                    l >= abs(h2.hit_pos[1]-h2.hit_pos[0]) * overlap_cutoff:
+    valid_hsps = [x for x in hit.hsps
+                  if abs(x.hit_pos[1]-x.hit_pos[0]) > len_cutoff]
+    if any(x.hit_pos[0] > x.hit_pos[1] for x in valid_hsps):
+        #  Sorting by start makes no sense for reverse ranges
+        return is_duplicate_pairwise(hit, overlap_cutoff, len_cutoff)
+    valid_hsps.sort(key=lambda x: x.hit_pos[0])
+    #  HSPs that start before the current one and end after its start
+    active = []
+    for hsp in valid_hsps:
+        start = hsp.hit_pos[0]
+        active = [x for x in active if x.hit_pos[1] >= start]
+        for other in active:
+            if hsp_pair_is_duplicate(other, hsp, overlap_cutoff):
                 return True
+        active.append(hsp)
     return False
+
+
+def overlapping_pairs(hit_index, hit_start, hit_end, max_hit_pairs=None):
+    """
+    Return all pairs of HSPs of the same hit that overlap on hit.
+    This is a vectorized sweep: HSPs are sorted by hit and start on hit, so
+    the HSPs overlapping a given one and starting after it follow it in a
+    single run, found with a binary search for its end. Only the overlapping
+    pairs are ever created. Hit coordinates should be forward (start is not
+    greater than end) and non-negative.
+    `hit_index` is an array of hit numbers (from 0), one per HSP. Hits that
+    have more than `max_hit_pairs` overlapping pairs are skipped entirely.
+    Returns three arrays: `first` and `second` positions of every pair (each
+    pair once) and the numbers of skipped hits.
+    :param hit_index: np.ndarray
+    :param hit_start: np.ndarray
+    :param hit_end: np.ndarray
+    :param max_hit_pairs: int or None for no limit
+    :return: tuple of np.ndarray
+    """
+    n = len(hit_index)
+    if n < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), \
+            np.empty(0, dtype=np.int64)
+    hit_index, hit_start, hit_end = (np.asarray(x, dtype=np.int64) for x in
+                                     (hit_index, hit_start, hit_end))
+    order = np.lexsort((hit_start, hit_index))
+    hits = hit_index[order]
+    #  (hit, coordinate) pairs as single sortable keys
+    scale = int(max(hit_start.max(), hit_end.max())) + 1
+    keys = hits * scale + hit_start[order]
+    reach = np.searchsorted(keys, hits * scale + hit_end[order], side='right')
+    followers = reach - np.arange(n) - 1
+    skipped = np.empty(0, dtype=np.int64)
+    if max_hit_pairs is not None:
+        pair_counts = np.bincount(hits, weights=followers)
+        skipped = np.flatnonzero(pair_counts > max_hit_pairs)
+        followers[np.isin(hits, skipped)] = 0
+    first = np.repeat(np.arange(n), followers)
+    #  Position of every pair within its `first` HSP's block of pairs
+    block_starts = np.repeat(np.cumsum(followers) - followers, followers)
+    second = first + 1 + np.arange(len(first)) - block_starts
+    return order[first], order[second], skipped
+
+
+def hit_duplicate_flags(hit_index, query_start, query_end, hit_start, hit_end,
+                        overlap_cutoff=0.5, len_cutoff=50,
+                        max_hit_pairs=2**16):
+    """
+    Vectorized `is_duplicate` for a batch of hits.
+    Takes the HSPs of several hits as NumPy arrays: hit numbers (from 0 to
+    the number of hits minus one, with the HSPs of every hit following one
+    after another) and coordinates. Returns a boolean array with an
+    `is_duplicate` result for every hit. Cutoffs have the same meaning as in
+    `is_duplicate`, and the results are the same. Hits with more than
+    `max_hit_pairs` overlapping HSP pairs are tested with `is_duplicate`.
+    :param hit_index: np.ndarray
+    :param query_start: np.ndarray
+    :param query_end: np.ndarray
+    :param hit_start: np.ndarray
+    :param hit_end: np.ndarray
+    :param overlap_cutoff: float
+    :param len_cutoff: int
+    :param max_hit_pairs: int
+    :return: np.ndarray
+    """
+    hit_count = int(hit_index[-1]) + 1 if len(hit_index) else 0
+    flags = np.zeros(hit_count, dtype=bool)
+    pairs, fallback = candidate_pairs(hit_index, query_start, query_end,
+                                      hit_start, hit_end, len_cutoff,
+                                      max_hit_pairs)
+    flags[hit_index[pairs[0][duplicate_pair_mask(
+        pairs, overlap_cutoff, len_cutoff)]]] = True
+    flags[fallback] = fallback_flags(fallback, hit_index, query_start,
+                                     query_end, hit_start, hit_end,
+                                     overlap_cutoff, len_cutoff)
+    return flags
+
+
+def candidate_pairs(hit_index, query_start, query_end, hit_start, hit_end,
+                    len_cutoff=50, max_hit_pairs=2**16):
+    """
+    Return the HSP pairs that may be evidence of duplication.
+    These are the pairs of HSPs of the same hit, both longer than
+    `len_cutoff` on hit, that overlap on hit and don't overlap on query.
+    Arguments are the same as in `hit_duplicate_flags`. Pairs are found with
+    `overlapping_pairs`, so the work depends on the number of HSPs that
+    overlap on hit rather than on the square of the HSP count.
+    Returns a tuple of pairs and an array of hit numbers that are left out:
+    the ones with more than `max_hit_pairs` overlapping pairs or with reverse
+    coordinates on hit. These should be tested with `is_duplicate` (see
+    `fallback_flags`). Pairs are a tuple of arrays: first and second HSP
+    positions, their overlap length on hit and their lengths on hit. Overlap
+    cutoff (and a larger length cutoff) can then be applied with
+    `duplicate_pair_mask` without recalculating pairs.
+    :param hit_index: np.ndarray
+    :param query_start: np.ndarray
+    :param query_end: np.ndarray
+    :param hit_start: np.ndarray
+    :param hit_end: np.ndarray
+    :param len_cutoff: int
+    :param max_hit_pairs: int
+    :return: tuple
+    """
+    hit_index = np.asarray(hit_index)
+    query_start, query_end, hit_start, hit_end = \
+        (np.asarray(x, dtype=np.int64) for x in (query_start, query_end,
+                                                 hit_start, hit_end))
+    hit_len = np.abs(hit_end - hit_start)
+    valid = np.flatnonzero(hit_len > len_cutoff)
+    #  Sweep needs forward ranges, like `is_duplicate`
+    reverse = np.unique(hit_index[valid][hit_start[valid] > hit_end[valid]])
+    valid = valid[~np.isin(hit_index[valid], reverse)]
+    first, second, crowded = overlapping_pairs(hit_index[valid],
+                                               hit_start[valid],
+                                               hit_end[valid], max_hit_pairs)
+    first = valid[first]
+    second = valid[second]
+    #  Same comparison as `hsp_pair_is_duplicate`; pairs overlap on hit
+    query_overlap = (query_start[first] <= query_end[second]) & \
+                    (query_start[second] <= query_end[first])
+    first = first[~query_overlap]
+    second = second[~query_overlap]
+    overlap_length = np.minimum(hit_end[first], hit_end[second]) - \
+        np.maximum(hit_start[first], hit_start[second])
+    return (first, second, overlap_length, hit_len[first], hit_len[second]), \
+        np.union1d(reverse, crowded).astype(np.int64)
+
+
+def fallback_flags(hits, hit_index, query_start, query_end, hit_start,
+                   hit_end, overlap_cutoff=0.5, len_cutoff=50):
+    """
+    Return `is_duplicate` results for selected hits of a batch.
+    Used for the hits left out by `candidate_pairs`: every hit is made into a
+    CompactHit straight from the coordinate arrays and tested with the
+    sweep in `is_duplicate`, which stops at the first duplicate pair.
+    Arguments are the same as in `hit_duplicate_flags`.
+    :param hits: np.ndarray of hit numbers
+    :param hit_index: np.ndarray
+    :param query_start: np.ndarray
+    :param query_end: np.ndarray
+    :param hit_start: np.ndarray
+    :param hit_end: np.ndarray
+    :param overlap_cutoff: float
+    :param len_cutoff: int
+    :return: np.ndarray
+    """
+    flags = np.zeros(len(hits), dtype=bool)
+    if not len(hits):
+        return flags
+    starts = np.searchsorted(hit_index, hits)
+    ends = np.searchsorted(hit_index, hits, side='right')
+    positions = np.stack((query_start, query_end, hit_start, hit_end),
+                         axis=1).astype(np.int32)
+    for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        hit = CompactHit(None, None, array('i', positions[start:end].tobytes()),
+                         array('d', bytes(8 * (end - start))))
+        flags[i] = is_duplicate(hit, overlap_cutoff, len_cutoff)
+    return flags
+
+
+def duplicate_pair_mask(pairs, overlap_cutoff=0.5, len_cutoff=50):
+    """
+    Return a boolean mask of the candidate pairs that are duplicates.
+    `pairs` is the output of `candidate_pairs`; `len_cutoff` should not be
+    less than the one it was called with.
+    :param pairs: tuple of np.ndarray
+    :param overlap_cutoff: float
+    :param len_cutoff: int
+    :return: np.ndarray
+    """
+    first, second, overlap_length, first_len, second_len = pairs
+    return (first_len > len_cutoff) & (second_len > len_cutoff) & \
+        (overlap_length >= first_len * overlap_cutoff) & \
+        (overlap_length >= second_len * overlap_cutoff)
+
+
+def table_duplicate_fractions(table, overlap_cutoff=0.5, len_cutoff=50):
+    """
+    Return the fraction of duplicate hits for every query in a BlastTable.
+    Hits and query groups are runs of rows with the same query and hit, or
+    query, exactly as in `assemble_hits` and `iterate_by_query`. The table
+    should contain the entire groups (see
+    `phylome.blast_parser.query_aligned_tables`). Returns two arrays: query
+    ID codes and fractions of hits for which `is_duplicate` is True.
+    :param table: BlastTable
+    :param overlap_cutoff: float
+    :param len_cutoff: int
+    :return: tuple of np.ndarray
+    """
+    queries, fractions = table_sweep_fractions(table, [overlap_cutoff],
+                                               [len_cutoff])
+    return queries, fractions[0, 0]
+
+
+def table_sweep_fractions(table, overlap_cutoffs, len_cutoffs,
+                          max_hit_pairs=2**16):
+    """
+    Return the fraction of duplicate hits for every query in a BlastTable and
+    every combination of cutoffs.
+    Same as `table_duplicate_fractions`, but HSP pairs are calculated once
+    for all the cutoffs. Returns query ID codes and an array of fractions
+    with the shape (len(overlap_cutoffs), len(len_cutoffs), query count).
+    Hits with more than `max_hit_pairs` overlapping HSP pairs are tested
+    with `is_duplicate` instead (see `candidate_pairs`).
+    :param table: BlastTable
+    :param overlap_cutoffs: list of float
+    :param len_cutoffs: list of int
+    :param max_hit_pairs: int
+    :return: tuple of np.ndarray
+    """
+    if not len(table.evalue):
+        return np.empty(0, dtype=np.int32), \
+            np.empty((len(overlap_cutoffs), len(len_cutoffs), 0))
+    new_hit = np.ones(len(table.evalue), dtype=bool)
+    new_hit[1:] = (np.diff(table.query_ids) != 0) | \
+        (np.diff(table.hit_ids) != 0)
+    hit_index = np.cumsum(new_hit) - 1
+    coordinates = (table.query_start, table.query_end, table.hit_start,
+                   table.hit_end)
+    pairs, fallback = candidate_pairs(hit_index, *coordinates,
+                                      len_cutoff=min(len_cutoffs),
+                                      max_hit_pairs=max_hit_pairs)
+    hit_queries = table.query_ids[new_hit]
+    new_query = np.ones(len(hit_queries), dtype=bool)
+    new_query[1:] = np.diff(hit_queries) != 0
+    query_index = np.cumsum(new_query) - 1
+    hit_counts = np.bincount(query_index)
+    fractions = np.empty((len(overlap_cutoffs), len(len_cutoffs),
+                          len(hit_counts)))
+    for i, overlap_cutoff in enumerate(overlap_cutoffs):
+        for j, len_cutoff in enumerate(len_cutoffs):
+            flags = np.zeros(len(hit_queries), dtype=bool)
+            flags[hit_index[pairs[0][duplicate_pair_mask(
+                pairs, overlap_cutoff, len_cutoff)]]] = True
+            flags[fallback] = fallback_flags(fallback, hit_index,
+                                             *coordinates,
+                                             overlap_cutoff=overlap_cutoff,
+                                             len_cutoff=len_cutoff)
+            fractions[i, j] = np.bincount(query_index, weights=flags,
+                                          minlength=len(hit_counts)) / \
+                hit_counts
+    return hit_queries[new_query], fractions
+
+
+def query_duplicate_fractions(table, overlap_cutoff=0.5, len_cutoff=50):
+    """
+    Same as `table_duplicate_fractions`, but returns a list of
+    (query_id, fraction) tuples. Suitable for
+    `phylome.blast_parser.map_blast_table_shards`.
+    :param table: BlastTable
+    :param overlap_cutoff: float
+    :param len_cutoff: int
+    :return: list
+    """
+    queries, fractions = table_duplicate_fractions(table, overlap_cutoff,
+                                                   len_cutoff)
+    return [(table.names[query], fraction) for query, fraction
+            in zip(queries.tolist(), fractions.tolist())]
+
+
+def query_sweep_fractions(table, overlap_cutoffs, len_cutoffs):
+    """
+    Same as `table_sweep_fractions`, but returns a list of (query_id,
+    fractions) tuples, where fractions is an array of the shape
+    (len(overlap_cutoffs), len(len_cutoffs)).
+    :param table: BlastTable
+    :param overlap_cutoffs: list of float
+    :param len_cutoffs: list of int
+    :return: list
+    """
+    queries, fractions = table_sweep_fractions(table, overlap_cutoffs,
+                                               len_cutoffs)
+    return [(table.names[query], fractions[:, :, i]) for i, query
+            in enumerate(queries.tolist())]
@@ -0,0 +1,82 @@
+"""
+Sidecar index files.
+Indices of BLAST files (`.qidx`) start with a header line recording size and
+modification time of the indexed file, so that an index left over from
+another version of that file is detected on loading (FASTA indices keep the
+same line in their `source` file). They are written to a temporary file that
+replaces the index only when it's complete, so an interrupted build never
+leaves a partial index behind.
+"""
+
+import os
+from contextlib import contextmanager
+
+
+def source_stamp(filename):
+    """
+    Return the header line identifying the current version of a file.
+    :param filename: str
+    :return: str
+    """
+    stat = os.stat(filename)
+    return '#source\t{}\t{}\n'.format(stat.st_size, stat.st_mtime_ns)
+
+
+@contextmanager
+def write_index(filename, index_filename):
+    """
+    Open an index of `filename` for writing (as text), with the header line
+    already written. The data goes to a temporary file in the same directory,
+    which replaces `index_filename` when the block ends, or is removed if it
+    raises.
+    :param filename: str. Indexed file
+    :param index_filename: str
+    :return:
+    """
+    #  Stamp is taken first, so that changes during the scan make it stale
+    stamp = source_stamp(filename)
+    temp_filename = '{}.tmp{}'.format(index_filename, os.getpid())
+    try:
+        with open(temp_filename, mode='w') as handle:
+            handle.write(stamp)
+            yield handle
+        os.replace(temp_filename, index_filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+
+def index_is_current(filename, index_filename):
+    """
+    Check that an index exists and was made for the current version of the
+    file.
+    :param filename: str
+    :param index_filename: str
+    :return: bool
+    """
+    try:
+        with open(index_filename) as handle:
+            return handle.readline() == source_stamp(filename)
+    except FileNotFoundError:
+        return False
+
+
+def read_index(index_filename, filename=None):
+    """
+    Yield the lines of an index (without the header) split on tabs.
+    If the indexed `filename` is given, raises ValueError when the index was
+    made for another version of it.
+    :param index_filename: str
+    :param filename: str
+    :return:
+    """
+    with open(index_filename) as handle:
+        header = handle.readline()
+        if filename is not None and not header == source_stamp(filename):
+            raise ValueError('Index {} is outdated or incomplete, rebuild it'.format(
+                index_filename))
+        if header and not header.startswith('#source\t'):
+            yield header.rstrip('\n').split('\t')
+        for line in handle:
+            yield line.rstrip('\n').split('\t')
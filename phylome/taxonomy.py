@@ -5,8 +5,441 @@ All functions in this file rely on NCBI taxonomy database being available via
 mySQL and require a mysql.connector.cursor as one of the arguments. All these
 things can probably be written trivially using pure SQL, but I don't know SQL
 and I kinda need them right now.
+Alternatively, a TaxonomyTree can be passed instead of the cursor, in which
+case everything is done in memory without any queries.
 """
 
+import os
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+
+
+class TaxonomyTree:
+    """
+    NCBI taxonomy tree held in memory.
+    The tree is stored as a parent-pointer array indexed by NCBI taxon ID
+    (0 for the IDs absent from the taxonomy; root is its own parent). It
+    provides the same functions as this module, but as in-memory lookups,
+    and can be passed to them instead of a cursor.
+    Optionally, it also stores ranks (as uint8 codes in `rank`, indices in
+    `rank_names`) and scientific names (as a UTF-8 blob `names` with int64
+    `name_offsets` indexed by taxon ID).
+    A tree can be built from NCBI taxdump files (`from_taxdump`), saved as a
+    directory of .npy files (`save`) and then memory-mapped (`load`), so
+    that it loads instantly and its pages are shared between processes.
+    After `build_index` every taxon also has its depth and DFS entry and
+    exit numbers, so that ancestor checks need no walking up the tree.
+    """
+    def __init__(self, parent, root=1, rank=None, rank_names=None, names=None,
+                 name_offsets=None):
+        self.parent = parent
+        self.root = root
+        self.rank = rank
+        self.rank_names = rank_names
+        self.names = names
+        self.name_offsets = name_offsets
+        self.depth = None
+        self.entry = None
+        self.exit = None
+        self.ancestors = None
+
+    @classmethod
+    def from_taxdump(cls, nodes_dmp, names_dmp=None):
+        """
+        Build a tree from NCBI taxdump `nodes.dmp` and (optionally)
+        `names.dmp` files.
+        :param nodes_dmp: str
+        :param names_dmp: str
+        :return: TaxonomyTree
+        """
+        taxa = []
+        parents = []
+        ranks = []
+        for line in open(nodes_dmp):
+            arr = line.split('\t|\t', 3)
+            taxa.append(int(arr[0]))
+            parents.append(int(arr[1]))
+            ranks.append(arr[2])
+        taxa = np.array(taxa, dtype=np.int64)
+        parent = np.zeros(taxa.max() + 1, dtype=np.int32)
+        parent[taxa] = parents
+        rank_names, rank_codes = np.unique(ranks, return_inverse=True)
+        rank = np.zeros(len(parent), dtype=np.uint8)
+        rank[taxa] = rank_codes
+        names = name_offsets = None
+        if names_dmp:
+            scientific = {}
+            for line in open(names_dmp):
+                arr = line.split('\t|\t')
+                if arr[3].startswith('scientific name'):
+                    scientific[int(arr[0])] = arr[1].encode()
+            lengths = np.zeros(len(parent), dtype=np.int64)
+            for taxon, name in scientific.items():
+                lengths[taxon] = len(name)
+            name_offsets = np.zeros(len(parent) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=name_offsets[1:])
+            names = np.frombuffer(b''.join(scientific[x] for x
+                                           in sorted(scientific)),
+                                  dtype=np.uint8)
+        #  Root is its own parent in nodes.dmp
+        return cls(parent, 1, rank, list(rank_names), names, name_offsets)
+
+    def save(self, path):
+        """
+        Save the tree as a directory of .npy files, to be loaded with `load`.
+        :param path: str
+        :return:
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'parent.npy'), self.parent)
+        if self.rank is not None:
+            np.save(os.path.join(path, 'rank.npy'), self.rank)
+            with open(os.path.join(path, 'ranks.txt'), mode='w') as handle:
+                for rank_name in self.rank_names:
+                    print(rank_name, file=handle)
+        if self.names is not None:
+            np.save(os.path.join(path, 'names.npy'), self.names)
+            np.save(os.path.join(path, 'name_offsets.npy'), self.name_offsets)
+        if self.entry is not None:
+            for name in ('depth', 'entry', 'exit'):
+                np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-map a tree saved with `save`.
+        :param path: str
+        :return: TaxonomyTree
+        """
+        def load_array(name):
+            filename = os.path.join(path, name + '.npy')
+            if os.path.exists(filename):
+                return np.load(filename, mmap_mode='r')
+            return None
+        parent = load_array('parent')
+        rank_names = None
+        if os.path.exists(os.path.join(path, 'ranks.txt')):
+            rank_names = [x.rstrip('\n') for x
+                          in open(os.path.join(path, 'ranks.txt'))]
+        roots = np.flatnonzero(parent == np.arange(len(parent)))
+        root = int(roots[roots > 0][0])
+        tree = cls(parent, root, load_array('rank'), rank_names,
+                   load_array('names'), load_array('name_offsets'))
+        tree.depth = load_array('depth')
+        tree.entry = load_array('entry')
+        tree.exit = load_array('exit')
+        return tree
+
+    def build_index(self):
+        """
+        Calculate depth and DFS entry and exit numbers for every taxon.
+        `entry` is the preorder number of a taxon and `exit` is the largest
+        preorder number in its subtree, so A is an ancestor of B if
+        `entry[A] < entry[B] <= exit[A]`. All three arrays are indexed by
+        taxon ID and are -1 for the absent taxa. The tree is processed level
+        by level with NumPy, there is no recursion.
+        Returns the tree itself.
+        :return: TaxonomyTree
+        """
+        parent = np.asarray(self.parent, dtype=np.int64)
+        n = len(parent)
+        taxa = np.flatnonzero(parent > 0)
+        taxa = taxa[taxa != self.root]
+        #  Children of every taxon, grouped by parent
+        children = taxa[np.argsort(parent[taxa], kind='stable')]
+        child_start = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(parent[taxa], minlength=n), out=child_start[1:])
+        levels = [np.array([self.root], dtype=np.int64)]
+        while True:
+            frontier = levels[-1]
+            counts = child_start[frontier + 1] - child_start[frontier]
+            total = int(counts.sum())
+            if not total:
+                break
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts,
+                                                   counts)
+            levels.append(children[np.repeat(child_start[frontier], counts) +
+                                   offsets])
+        depth = np.full(n, -1, dtype=np.int32)
+        size = np.zeros(n, dtype=np.int64)
+        for level_depth, level in enumerate(levels):
+            depth[level] = level_depth
+            size[level] = 1
+        #  Subtree sizes, from leaves up
+        for level in reversed(levels[1:]):
+            size += np.bincount(parent[level], weights=size[level],
+                                minlength=n).astype(np.int64)
+        #  Every child starts after its parent and all its previous siblings
+        entry = np.full(n, -1, dtype=np.int32)
+        entry[self.root] = 0
+        for level in levels[1:]:
+            level_parents = parent[level]
+            new_parent = np.ones(len(level), dtype=bool)
+            new_parent[1:] = level_parents[1:] != level_parents[:-1]
+            before = np.cumsum(size[level]) - size[level]
+            group = np.cumsum(new_parent) - 1
+            siblings_before = before - before[new_parent][group]
+            entry[level] = entry[level_parents] + 1 + siblings_before
+        self.depth = depth
+        self.entry = entry
+        self.exit = np.where(entry >= 0, entry + size - 1, -1).astype(np.int32)
+        return self
+
+    def get_rank(self, taxon):
+        """
+        Return the rank of a taxon, or None if ranks are unknown.
+        :param taxon: int
+        :return: str
+        """
+        if self.rank is None:
+            return None
+        if not self.is_valid(taxon):
+            raise ValueError('Invalid NCBI taxon id {}'.format(taxon))
+        return self.rank_names[self.rank[taxon]]
+
+    def get_name(self, taxon):
+        """
+        Return the scientific name of a taxon, or None if names are unknown.
+        :param taxon: int
+        :return: str
+        """
+        if self.names is None:
+            return None
+        if not self.is_valid(taxon):
+            raise ValueError('Invalid NCBI taxon id {}'.format(taxon))
+        return bytes(self.names[self.name_offsets[taxon]:
+                                self.name_offsets[taxon+1]]).decode()
+
+    @classmethod
+    def from_cursor(cls, cursor):
+        """
+        Load the entire `taxon` table of a BioSQL database.
+        :param cursor:
+        :return: TaxonomyTree
+        """
+        cursor.execute('SELECT `taxon_id`, `ncbi_taxon_id`, `parent_taxon_id` FROM taxon;')
+        rows = np.array([[x or 0 for x in row] for row in cursor.fetchall()],
+                        dtype=np.int64).reshape(-1, 3)
+        internal, ncbi, parent = rows.T
+        ncbi_by_internal = np.zeros(internal.max() + 1, dtype=np.int64)
+        ncbi_by_internal[internal] = ncbi
+        tree = np.zeros(ncbi.max() + 1, dtype=np.int32)
+        tree[ncbi] = ncbi_by_internal[parent]
+        #  BioSQL root is the one with internal ID 1
+        root = int(ncbi_by_internal[1])
+        tree[root] = root
+        return cls(tree, root)
+
+    def is_valid(self, taxon):
+        """
+        Return True if the taxon ID is present in the taxonomy.
+        :param taxon: int
+        :return: bool
+        """
+        return 0 < taxon < len(self.parent) and self.parent[taxon] > 0
+
+    def descend_taxon_tree(self, starting_taxon):
+        """
+        Yield the ancestors of a taxon until the root. Same as the module-level
+        `descend_taxon_tree`.
+        :param starting_taxon: int
+        :return: generator
+        """
+        if not isinstance(starting_taxon, int):
+            raise TypeError('Taxon ID should be int')
+        if not self.is_valid(starting_taxon):
+            raise ValueError('Invalid NCBI taxon id {}'.format(starting_taxon))
+        parent = self.parent
+        taxon = int(parent[starting_taxon])
+        while taxon > 0 and not taxon == self.root:
+            yield taxon
+            taxon = int(parent[taxon])
+
+    def get_taxa_list(self, taxon_id):
+        return get_taxa_list(taxon_id, self)
+
+    def _check_taxon(self, taxon):
+        """
+        Raise the same exceptions as `descend_taxon_tree` for invalid taxa.
+        :param taxon:
+        :return:
+        """
+        if not isinstance(taxon, int):
+            raise TypeError('Taxon ID should be int')
+        if not self.is_valid(taxon):
+            raise ValueError('Invalid NCBI taxon id {}'.format(taxon))
+
+    def _is_strict_ancestor(self, ancestor, taxon):
+        """
+        Return True if `ancestor` is an ancestor of `taxon` other than root,
+        which is what walking with `descend_taxon_tree` finds. Needs index.
+        :param ancestor: int
+        :param taxon: int
+        :return: bool
+        """
+        return self.is_valid(ancestor) and not ancestor == self.root and \
+            bool(self.entry[ancestor] < self.entry[taxon] <= self.exit[ancestor])
+
+    def is_taxon_member(self, taxon1, taxon2):
+        """
+        Same as the module-level `is_taxon_member`. With the index it's just
+        a couple of comparisons.
+        :param taxon1: int
+        :param taxon2: int
+        :return: bool
+        """
+        if self.entry is None:
+            return taxon2 in self.descend_taxon_tree(taxon1)
+        self._check_taxon(taxon1)
+        return self._is_strict_ancestor(taxon2, taxon1)
+
+    def get_supertaxon_from_list(self, taxon, taxa_list):
+        """
+        Same as the module-level `get_supertaxon_from_list`. With the index,
+        the lineage is not walked; the nearest of the ancestors found in the
+        list is the one with the largest entry number.
+        :param taxon: int
+        :param taxa_list: list of int
+        :return: int or None
+        """
+        if self.entry is None:
+            taxa_set = set(taxa_list)
+            for supertaxon in self.descend_taxon_tree(taxon):
+                if supertaxon in taxa_set:
+                    return supertaxon
+            return None
+        self._check_taxon(taxon)
+        best = None
+        for candidate in taxa_list:
+            if self._is_strict_ancestor(candidate, taxon) and \
+                    (best is None or self.entry[candidate] > self.entry[best]):
+                best = candidate
+        return best
+
+    def batch_supertaxa(self, taxa, taxa_list):
+        """
+        Vectorized `get_supertaxon_from_list` for an array of taxa.
+        Returns an int array with the nearest supertaxon from `taxa_list` for
+        every taxon, or 0 if there is none or the taxon is invalid. Requires
+        the index (see `build_index`).
+        :param taxa: np.ndarray or list of int
+        :param taxa_list: list of int
+        :return: np.ndarray
+        """
+        taxa = np.asarray(taxa, dtype=np.int64)
+        known = (taxa > 0) & (taxa < len(self.parent))
+        entries = np.where(known, self.entry[np.where(known, taxa, 0)], -1)
+        candidates = np.array([x for x in taxa_list if self.is_valid(x) and
+                               not x == self.root], dtype=np.int64)
+        if not len(candidates) or not len(taxa):
+            return np.zeros(len(taxa), dtype=np.int64)
+        candidate_entries = self.entry[candidates].astype(np.int64)
+        inside = (candidate_entries[None, :] < entries[:, None]) & \
+            (entries[:, None] <= self.exit[candidates][None, :])
+        scores = np.where(inside, candidate_entries[None, :], -1)
+        return np.where(scores.max(axis=1) >= 0,
+                        candidates[scores.argmax(axis=1)], 0)
+
+    def batch_is_member(self, taxa, taxon2):
+        """
+        Vectorized `is_taxon_member` for an array of taxa and a single
+        supertaxon. Invalid taxa are not members of anything. Requires the
+        index (see `build_index`).
+        :param taxa: np.ndarray or list of int
+        :param taxon2: int
+        :return: np.ndarray of bool
+        """
+        return self.batch_supertaxa(taxa, [taxon2]) == taxon2
+
+    def build_lca(self):
+        """
+        Build the binary lifting table for LCA queries: `ancestors[k][t]` is
+        the 2**k-th ancestor of `t` (root is its own ancestor). Builds the DFS
+        index first if necessary. Returns the tree itself.
+        :return: TaxonomyTree
+        """
+        if self.entry is None:
+            self.build_index()
+        levels = max(int(self.depth.max()), 1).bit_length()
+        ancestors = np.empty((levels, len(self.parent)), dtype=np.int32)
+        ancestors[0] = self.parent
+        for k in range(1, levels):
+            ancestors[k] = ancestors[k - 1][ancestors[k - 1]]
+        self.ancestors = ancestors
+        return self
+
+    def pairwise_lca(self, taxa1, taxa2):
+        """
+        LCA for every pair of taxa from two arrays of equal length. Both
+        arrays should contain only valid taxa (see `is_valid`).
+        :param taxa1: np.ndarray or list of int
+        :param taxa2: np.ndarray or list of int
+        :return: np.ndarray
+        """
+        if self.ancestors is None:
+            self.build_lca()
+        a = np.array(taxa1, dtype=np.int64)
+        b = np.array(taxa2, dtype=np.int64)
+        #  `a` is always the deeper one
+        swap = self.depth[a] < self.depth[b]
+        a[swap], b[swap] = b[swap], a[swap]
+        difference = self.depth[a] - self.depth[b]
+        for k in range(len(self.ancestors)):
+            lift = (difference >> k) & 1 == 1
+            a[lift] = self.ancestors[k][a[lift]]
+        for k in reversed(range(len(self.ancestors))):
+            differ = self.ancestors[k][a] != self.ancestors[k][b]
+            a[differ] = self.ancestors[k][a[differ]]
+            b[differ] = self.ancestors[k][b[differ]]
+        return np.where(a == b, a, self.parent[a])
+
+    def group_lca(self, taxa, groups, group_count=None):
+        """
+        LCA of a set of taxa for every group, eg all hits of every query.
+        `groups` contains a group number for every taxon. Invalid and absent
+        taxa are ignored. Returns an array with LCA for every group number
+        from 0 to `group_count` - 1 (by default, max group number); groups
+        without any valid taxa get 0.
+        The LCA of a set is the LCA of its members with the lowest and the
+        highest DFS entry number, so there is only one pairwise LCA per group.
+        :param taxa: np.ndarray or list of int
+        :param groups: np.ndarray or list of int
+        :param group_count: int
+        :return: np.ndarray
+        """
+        if self.ancestors is None:
+            self.build_lca()
+        taxa = np.asarray(taxa, dtype=np.int64)
+        groups = np.asarray(groups, dtype=np.int64)
+        if group_count is None:
+            group_count = int(groups.max()) + 1 if len(groups) else 0
+        known = (taxa > 0) & (taxa < len(self.parent))
+        known[known] = self.entry[taxa[known]] >= 0
+        taxa = taxa[known]
+        groups = groups[known]
+        result = np.zeros(group_count, dtype=np.int64)
+        if not len(taxa):
+            return result
+        order = np.lexsort((self.entry[taxa], groups))
+        taxa = taxa[order]
+        groups = groups[order]
+        present, first, counts = np.unique(groups, return_index=True,
+                                           return_counts=True)
+        result[present] = self.pairwise_lca(taxa[first],
+                                            taxa[first + counts - 1])
+        return result
+
+    def lca(self, taxa):
+        """
+        LCA of a set of taxa, or None if none of them is valid.
+        :param taxa: list of int
+        :return: int or None
+        """
+        result = int(self.group_lca(taxa, np.zeros(len(taxa)), 1)[0])
+        return result or None
+
 
 def descend_taxon_tree(starting_taxon, cursor):
     """
@@ -15,9 +448,12 @@ def descend_taxon_tree(starting_taxon, cursor):
     Returns neither query taxon nor root. Raises ValueError if supplied an
     invalid taxon ID.
     :param starting_taxon:
-    :param cursor:
+    :param cursor: cursor, TaxonomyTree or LineageStore
     :return:
     """
+    if isinstance(cursor, (TaxonomyTree, LineageStore)):
+        yield from cursor.descend_taxon_tree(starting_taxon)
+        return
     if not isinstance(starting_taxon, int):
         raise TypeError('Taxon ID should be int')
     cursor.execute('SELECT `taxon_id` FROM taxon WHERE `ncbi_taxon_id`={};'
@@ -60,6 +496,8 @@ def is_taxon_member(taxon1, taxon2, cursor):
     :param cursor:
     :return:
     """
+    if isinstance(cursor, TaxonomyTree):
+        return cursor.is_taxon_member(taxon1, taxon2)
     for taxon in descend_taxon_tree(taxon1, cursor):
         if taxon == taxon2:
             return True
@@ -80,7 +518,188 @@ def get_supertaxon_from_list(taxon, taxa_list, cursor):
     :param cursor:
     :return:
     """
+    if isinstance(cursor, TaxonomyTree):
+        return cursor.get_supertaxon_from_list(taxon, taxa_list)
+    taxa_set = set(taxa_list)
     for supertaxon in descend_taxon_tree(taxon, cursor):
-        if supertaxon in taxa_list:
+        if supertaxon in taxa_set:
             return supertaxon
     return None
+
+
+class SupertaxonCache:
+    """
+    LRU cache for `get_supertaxon_from_list`.
+    Keys are (taxon, tuple of supertaxa), so the same cache can serve
+    different supertaxa lists. Unknown taxa are cached as well, and the
+    ValueError is re-raised every time they are requested. At most
+    `max_size` entries are kept; `hits`, `misses` and `evictions` count
+    what happened to the requests. The cache can be saved to a TSV file and
+    loaded at the next run.
+    """
+    def __init__(self, max_size=2**20, filename=None):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if filename is not None and os.path.exists(filename):
+            self.load(filename)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _add(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, taxon, taxa_list, cursor):
+        """
+        Same as `get_supertaxon_from_list`, but cached.
+        :param taxon: int
+        :param taxa_list: list of int
+        :param cursor: cursor or TaxonomyTree
+        :return: int or None
+        """
+        key = (taxon, tuple(taxa_list))
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            value = self.entries[key]
+        else:
+            self.misses += 1
+            try:
+                value = get_supertaxon_from_list(taxon, taxa_list, cursor)
+            except ValueError:
+                value = ValueError
+            self._add(key, value)
+        if value is ValueError:
+            raise ValueError('Invalid NCBI taxon id {}'.format(taxon))
+        return value
+
+    def stats(self):
+        """
+        Return a human-readable summary of the counters.
+        :return: str
+        """
+        return '{} entries, {} hits, {} misses, {} evictions'.format(
+            len(self.entries), self.hits, self.misses, self.evictions)
+
+    def save(self, filename):
+        """
+        Save the cache as a TSV file of taxon, comma-separated supertaxa and
+        the result (empty for None, `invalid` for unknown taxa). Entries are
+        written from the least to the most recently used one.
+        :param filename: str
+        :return:
+        """
+        with open(filename, mode='w') as handle:
+            for (taxon, taxa_list), value in self.entries.items():
+                if value is ValueError:
+                    value = 'invalid'
+                elif value is None:
+                    value = ''
+                print('{}\t{}\t{}'.format(taxon,
+                                          ','.join(str(x) for x in taxa_list),
+                                          value), file=handle)
+
+    def load(self, filename):
+        """
+        Add entries from a file made by `save`.
+        :param filename: str
+        :return:
+        """
+        with open(filename, mode='r') as handle:
+            for line in handle:
+                taxon, taxa_list, value = line.rstrip('\n').split('\t')
+                if value == 'invalid':
+                    value = ValueError
+                else:
+                    value = int(value) if value else None
+                self._add((int(taxon),
+                           tuple(int(x) for x in taxa_list.split(',') if x)),
+                          value)
+
+
+class LineageStore:
+    """
+    On-disk lineage cache shared by several processes.
+    Lineages (as yielded by `descend_taxon_tree`) are stored in an SQLite
+    database in WAL mode, so that any number of processes can read it and
+    fill it at the same time. Every process should open its own store (an
+    SQLite connection can't be shared across fork). Missing lineages are
+    requested from `cursor` (a mySQL cursor or a TaxonomyTree), and the
+    lineages of all ancestors are stored along the way.
+    The store can be passed to the functions of this module instead of the
+    cursor.
+    """
+    def __init__(self, filename, cursor, mmap_size=2**28):
+        self.cursor = cursor
+        self.connection = sqlite3.connect(filename, timeout=600,
+                                          isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL;')
+        self.connection.execute('PRAGMA synchronous=NORMAL;')
+        self.connection.execute('PRAGMA mmap_size={};'.format(mmap_size))
+        #  Lineage is a comma-separated list, or NULL for invalid taxa
+        self.connection.execute('CREATE TABLE IF NOT EXISTS lineages '
+                                '(taxon INTEGER PRIMARY KEY, lineage TEXT);')
+
+    def close(self):
+        self.connection.close()
+
+    def get_lineages(self, taxa):
+        """
+        Return a dict of taxon to its lineage (a list of ancestors, as in
+        `descend_taxon_tree`) or None for invalid taxa.
+        Everything not yet in the store is looked up via the cursor and
+        written in a single transaction.
+        :param taxa: iterable of int
+        :return: dict
+        """
+        taxa = list(set(int(x) for x in taxa))
+        lineages = {}
+        #  Staying well below SQLite's limit on the number of variables
+        for i in range(0, len(taxa), 500):
+            chunk = taxa[i:i + 500]
+            for taxon, lineage in self.connection.execute(
+                    'SELECT taxon, lineage FROM lineages WHERE taxon IN ({});'
+                    .format(', '.join(['?'] * len(chunk))), chunk):
+                lineages[taxon] = None if lineage is None else \
+                    [int(x) for x in lineage.split(',') if x]
+        missing = [x for x in taxa if x not in lineages]
+        if not missing:
+            return lineages
+        rows = []
+        for taxon in missing:
+            try:
+                lineage = [int(x) for x in
+                           descend_taxon_tree(taxon, self.cursor)]
+            except ValueError:
+                lineages[taxon] = None
+                rows.append((taxon, None))
+                continue
+            lineages[taxon] = lineage
+            for i, ancestor in enumerate([taxon] + lineage):
+                rows.append((ancestor,
+                             ','.join(str(x) for x in lineage[i:])))
+        self.connection.execute('BEGIN;')
+        self.connection.executemany('INSERT OR IGNORE INTO lineages '
+                                    'VALUES (?, ?);', rows)
+        self.connection.execute('COMMIT;')
+        return lineages
+
+    def descend_taxon_tree(self, starting_taxon):
+        """
+        Same as the module-level `descend_taxon_tree`, but from the store.
+        :param starting_taxon: int
+        :return:
+        """
+        if not isinstance(starting_taxon, int):
+            raise TypeError('Taxon ID should be int')
+        lineage = self.get_lineages([starting_taxon])[starting_taxon]
+        if lineage is None:
+            raise ValueError('Invalid NCBI taxon id {}'.format(starting_taxon))
+        yield from lineage
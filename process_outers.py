@@ -11,53 +11,85 @@
 
 from argparse import ArgumentParser
 from multiprocessing import Pool
+from tempfile import TemporaryDirectory
+import os
 import sys
 
+import pymysql
+
+from phylome.accessions import get_taxids, AccessionIndex
+from phylome.fasta import read_fasta, write_fasta
+from phylome.taxonomy import get_supertaxon_from_list, TaxonomyTree, \
+    SupertaxonCache, LineageStore
+
+
 def process_fasta(filename, host='127.0.0.1', username='root',
                   password='password', database='biosql',
-                  excluded = [2836], nonreduced=[2763, 33090]):
+                  excluded = [2836], nonreduced=[2763, 33090], taxonomy=None,
+                  accessions=None, cache=None, cursor=None):
     """
     Process a single FASTA file. Returns a log line
     Log consists of filename, counts of all nonreduced (in the order in which
     they are in the kwarg) and the count of non-excluded, non-nonreduced seqs
+    If `taxonomy` (a TaxonomyTree or a LineageStore) is supplied, supertaxa
+    are looked up in it instead of the database. If the tree is indexed, all
+    taxids of the file are classified in a single vectorized call. Likewise,
+    `accessions` (an AccessionIndex) replaces the `acc2taxid` table.
+    Supertaxa are cached in `cache` (a SupertaxonCache) if it's supplied.
+    If `cursor` is None and the database is needed, a new connection is made
+    for this file.
     :param filename:
     :return:
     """
-    # These are gonna be multiprocessed and each process will import
-    # independently anyway.
-    from Bio import SeqIO
-    from phylome.taxonomy import get_supertaxon_from_list
-    import pymysql
-    records = {x.id.split('.')[0]: x for x in SeqIO.parse(filename, 'fasta')}
+    records = {x.id.split('.')[0]: x for x in read_fasta(filename)}
     if len(records) == 0:
         # A quick-and-dirty wrap around empty fasta case
         return '{}\t0\t0\t0\t0'.format(filename)
-    cnx = pymysql.connect(user=username, host=host, password=password,
+    if taxonomy is None or accessions is None:
+        if cursor is None:
+            cnx = pymysql.connect(user=username, host=host, password=password,
                                   database=database)
-    cursor = cnx.cursor()
-    # In a separate variable solely for the readability
-    taxid_request = 'select * from acc2taxid where accession in ({});'
-    r = taxid_request.format(', '.join(['\"'+x+'\"' for x in records.keys()]))
-    cursor.execute(r)
-    result = cursor.fetchall()
+            cursor = cnx.cursor()
+        if taxonomy is None:
+            taxonomy = cursor
+        if accessions is None:
+            accessions = cursor
     tax2seq = {}
-    for x in result:
-        if x[1] in tax2seq:
-            tax2seq[x[1]].append(x[0])
+    for accession, taxid in get_taxids(records.keys(), accessions).items():
+        if taxid in tax2seq:
+            tax2seq[taxid].append(accession)
         else:
-            tax2seq[x[1]] = [x[0]]
+            tax2seq[taxid] = [accession]
     rest_seqid = []
     nonreduced_seqid = {x: [] for x in nonreduced}
     nonreduced_counts = {x: 0 for x in nonreduced}
     excluded_count = 0
+    batch_supertaxa = None
+    if isinstance(taxonomy, LineageStore):
+        # Fetching all the missing lineages of this file at once
+        taxonomy.get_lineages(tax2seq.keys())
+    elif getattr(taxonomy, 'entry', None) is not None:
+        # Unknown taxids get 0 here, so they end up in the rest anyway
+        taxids = list(tax2seq.keys())
+        batch_supertaxa = dict(zip(taxids, taxonomy.batch_supertaxa(
+            taxids, excluded+nonreduced).tolist()))
     for taxid in tax2seq:
-        try:
-            supertaxon = get_supertaxon_from_list(taxid, excluded+nonreduced, cursor)
-        except ValueError:
-            # An unknown taxonid is treated like it belongs to the rest
-            # This is probably because my testing DB is old-ish
-            rest_seqid += tax2seq[taxid]
-            continue
+        if batch_supertaxa is not None:
+            supertaxon = batch_supertaxa[taxid]
+        else:
+            try:
+                if cache is not None:
+                    supertaxon = cache.get(taxid, excluded+nonreduced,
+                                           taxonomy)
+                else:
+                    supertaxon = get_supertaxon_from_list(taxid,
+                                                          excluded+nonreduced,
+                                                          taxonomy)
+            except ValueError:
+                # An unknown taxonid is treated like it belongs to the rest
+                # This is probably because my testing DB is old-ish
+                rest_seqid += tax2seq[taxid]
+                continue
         if supertaxon:
             # The taxid is either from excluded or from nonreduced
             if supertaxon in excluded:
@@ -68,12 +100,14 @@ def process_fasta(filename, host='127.0.0.1', username='root',
                 nonreduced_counts[supertaxon] += len(tax2seq[taxid])
         else:
             rest_seqid += tax2seq[taxid]
+    # Records are written exactly as they were in the input
     for clade in nonreduced_seqid:
         if nonreduced_seqid[clade]:
-            SeqIO.write([records[x] for x in nonreduced_seqid[clade]],
-                        '{}.{}'.format(filename, clade), 'fasta')
-    SeqIO.write([records[x] for x in rest_seqid],
-                '{}.rest'.format(filename), 'fasta')
+            with open('{}.{}'.format(filename, clade), mode='wb') as handle:
+                write_fasta([records[x] for x in nonreduced_seqid[clade]],
+                            handle)
+    with open('{}.rest'.format(filename), mode='wb') as handle:
+        write_fasta([records[x] for x in rest_seqid], handle)
     return '\t'.join([filename, str(excluded_count)] +
                      [str(nonreduced_counts[x]) for x in nonreduced] +
                       [str(len(rest_seqid))])
@@ -88,10 +122,66 @@ parser.add_argument('-u', type=str, help='MySQL username', default='root')
 parser.add_argument('-p', type=str, help='MySQL password', default='password')
 parser.add_argument('-d', type=str, help='Database name', default='biosql')
 parser.add_argument('-t', type=int, help='Process number', default=1)
+parser.add_argument('-m', action='store_true',
+                    help='Load the entire taxonomy in memory')
+parser.add_argument('--taxonomy', type=str,
+                    help='Taxonomy directory made by build_taxonomy.py')
+parser.add_argument('-a', type=str,
+                    help='Accession index made by build_accessions.py')
+parser.add_argument('--cache', type=str,
+                    help='Supertaxon cache file, loaded if exists and saved at exit. Only updated with a single process')
+parser.add_argument('--cache_size', type=int, default=2**20,
+                    help='Max number of cached supertaxa')
+parser.add_argument('--lineages', type=str,
+                    help='Lineage store (SQLite) to keep between runs. By default a temporary one is used')
 args = parser.parse_args()
 
-# process_partial = partial(process_fasta, host=args.o, username=args.u,
-#                           database=args.d, password=args.p)
+taxonomy = None
+if args.taxonomy:
+    # Memory-mapped, so the pages are shared by all workers
+    taxonomy = TaxonomyTree.load(args.taxonomy)
+elif args.m:
+    # Loaded before the pool is created, so workers share it via fork
+    cnx = pymysql.connect(user=args.u, host=args.o, password=args.p,
+                          database=args.d)
+    taxonomy = TaxonomyTree.from_cursor(cnx.cursor()).build_index()
+    cnx.close()
+
+accessions = None
+if args.a:
+    accessions = AccessionIndex(args.a)
+
+# Every worker process gets its own copy
+supertaxon_cache = SupertaxonCache(args.cache_size, args.cache)
+
+# Lineages are resolved via the database once per run and shared by all
+# workers. Unless the store should be kept, it's a temporary file
+lineage_dir = None
+lineage_file = None
+if taxonomy is None:
+    if args.lineages:
+        lineage_file = args.lineages
+    else:
+        lineage_dir = TemporaryDirectory()
+        lineage_file = os.path.join(lineage_dir.name, 'lineages.sqlite')
+
+# Per-process state, set by init_worker
+cursor = None
+lineages = None
+
+
+def init_worker():
+    """
+    Open a database connection and a lineage store once per process. In
+    single-process mode it's simply called once.
+    :return:
+    """
+    global cursor, lineages
+    if taxonomy is None or accessions is None:
+        cursor = pymysql.connect(user=args.u, host=args.o, password=args.p,
+                                 database=args.d).cursor()
+    if lineage_file is not None:
+        lineages = LineageStore(lineage_file, cursor)
 
 
 def wrapper(fasta_file):
@@ -100,19 +190,31 @@ def wrapper(fasta_file):
     :param fasta_file:
     :return:
     """
-    global args
+    global args, taxonomy, accessions, supertaxon_cache, cursor, lineages
     return process_fasta(fasta_file, host=args.o, username=args.u,
-                         password=args.p, database=args.d)
+                         password=args.p, database=args.d,
+                         taxonomy=taxonomy if lineages is None else lineages,
+                         accessions=accessions, cache=supertaxon_cache,
+                         cursor=cursor)
 
 if args.t > 1:
-    with Pool(processes=args.t) as pool:
+    with Pool(processes=args.t, initializer=init_worker) as pool:
         results = pool.map(wrapper, args.f)
 else:
+    init_worker()
     results = []
     for fasta in args.f:
         r = wrapper(fasta)
         results.append(r)
         print(r, file=sys.stderr, flush=True)
+    print('Supertaxon cache: {}'.format(supertaxon_cache.stats()),
+          file=sys.stderr)
+    if args.cache:
+        supertaxon_cache.save(args.cache)
 with open(args.l, mode='w') as output_file:
     for x in results:
         print(x, file=output_file)
+if lineage_dir is not None:
+    if lineages is not None:
+        lineages.close()
+    lineage_dir.cleanup()
@@ -1,16 +1,46 @@
 #! /usr/bin/env python3
 
+import gzip
+import os
+import random
+import struct
+import threading
+import zlib
+from functools import partial
+from io import StringIO
+from itertools import chain
+
 # Not my code, but needed for tests
 import mysql.connector
+import numpy as np
 import pytest
+from Bio import SeqIO
 
 # Stuff to be tested
 from phylome.blast_parser import BlastHSP, parse_blast_line, \
     parse_blast_file_to_hsps, \
-    assemble_hits, BlastHit, parse_blast_file_to_hits, iterate_by_query
-from phylome.multiplicates import is_duplicate
+    assemble_hits, BlastHit, parse_blast_file_to_hits, iterate_by_query, \
+    parse_blast_file_to_table, tables_to_hits, query_aligned_shards, \
+    parse_blast_file_parallel, build_query_index, load_query_index, \
+    query_index_is_current, BlastIndex, parse_unsorted_blast_file_to_hits, write_blast_cache, \
+    parse_unsorted_blast_file_to_hsps, \
+    BlastCache, CompactHit, compact_hits, tables_to_compact_hits, \
+    query_aligned_tables, map_blast_table_shards, pool_shards, \
+    iterate_blast_shard
+from phylome.accessions import build_accession_index, AccessionIndex, \
+    get_taxids, prefetch_taxids
+from phylome.clusters import ClusterStore
+from phylome.compressed import compression_type
+from phylome.fasta import Demultiplexer, demultiplex_fasta, read_fasta, \
+    write_fasta, sequence_bytes, fasta_statistics, filter_fasta_records
+from phylome.fasta_index import build_fasta_index, load_fasta_index, \
+    FastaIndex
+from phylome.multiplicates import is_duplicate, is_duplicate_pairwise, \
+    overlapping_pairs, hit_duplicate_flags, table_duplicate_fractions, query_duplicate_fractions, \
+    table_sweep_fractions
 from phylome.taxonomy import descend_taxon_tree, get_taxa_list, is_taxon_member, \
-    get_supertaxon_from_list
+    SupertaxonCache, LineageStore, \
+    get_supertaxon_from_list, TaxonomyTree
 
 
 def test_valid_blast_lines():
@@ -99,6 +129,182 @@ def test_invalid_blast_file_to_hits():
         g = list(parse_blast_file_to_hits(open('README.md', mode='r')))
 
 
+def test_blast_filters():
+    unfiltered = list(parse_blast_file_to_hsps('test_data/clusterize.tsv'))
+    hsps = list(parse_blast_file_to_hsps('test_data/clusterize.tsv',
+                                         evalue_cutoff=1e-30))
+    assert hsps == [x for x in unfiltered if x.evalue < 1e-30]
+    hsps = list(parse_blast_file_to_hsps('test_data/clusterize.tsv',
+                                         min_length=300))
+    assert 0 < len(hsps) < len(unfiltered)
+    assert all(x.query_pos[1] - x.query_pos[0] > 200 for x in hsps)
+    queries = {'Thaps_actinlike_1', 'Botrytis_cinerea_chitin'}
+    hsps = list(parse_blast_file_to_hsps('test_data/clusterize.tsv',
+                                         query_ids=queries,
+                                         hit_ids={'Thaps_actinlike_3',
+                                                  'Aspergillus_nidans_chitin'}))
+    assert [(x.query_id, x.hit_id) for x in hsps] == \
+        [('Thaps_actinlike_1', 'Thaps_actinlike_3'),
+         ('Botrytis_cinerea_chitin', 'Aspergillus_nidans_chitin')]
+    hits = list(parse_blast_file_to_hits('test_data/clusterize.tsv',
+                                         query_ids=queries))
+    assert len(hits) == 5
+    # Filtered lines are not validated
+    assert list(parse_blast_file_to_hsps('README.md', query_ids=queries)) == []
+
+
+def write_bgzf(data, filename, block_size=1000):
+    #  A minimal BGZF writer: every block is a gzip member with BC subfield
+    with open(filename, mode='wb') as handle:
+        for start in list(range(0, len(data), block_size)) + [len(data)]:
+            block = data[start:start+block_size]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            payload = compressor.compress(block) + compressor.flush()
+            handle.write(b'\x1f\x8b\x08\x04' + b'\x00' * 6 +
+                         struct.pack('<HBBHH', 6, 66, 67, 2,
+                                     len(payload) + 25))
+            handle.write(payload)
+            handle.write(struct.pack('<II', zlib.crc32(block), len(block)))
+
+
+def test_compressed_blast(tmp_path):
+    data = open('test_data/clusterize.tsv', mode='rb').read()
+    expected = list(parse_blast_file_to_hits('test_data/clusterize.tsv'))
+    gzip_file = str(tmp_path / 'clusterize.tsv.gz')
+    with gzip.open(gzip_file, mode='wb') as handle:
+        handle.write(data)
+    bgzf_file = str(tmp_path / 'clusterize.tsv.bgz')
+    write_bgzf(data, bgzf_file)
+    assert compression_type('test_data/clusterize.tsv') is None
+    assert compression_type(gzip_file) == 'gzip'
+    assert compression_type(bgzf_file) == 'bgzf'
+    assert list(parse_blast_file_to_hits(gzip_file)) == expected
+    assert list(parse_blast_file_to_hits(bgzf_file)) == expected
+    with pytest.raises(ValueError):
+        build_query_index(bgzf_file, str(tmp_path / 'index'))
+    #  Pipes are opened once, so the magic bytes are not lost
+    pipe = str(tmp_path / 'pipe')
+    os.mkfifo(pipe)
+    def write_pipe(source):
+        with open(pipe, mode='wb') as handle:
+            handle.write(open(source, mode='rb').read())
+    for source in ('test_data/clusterize.tsv', gzip_file, bgzf_file):
+        writer = threading.Thread(target=write_pipe, args=(source,))
+        writer.start()
+        assert list(parse_blast_file_to_hits(pipe)) == expected
+        writer.join()
+    zstandard = pytest.importorskip('zstandard')
+    zstd_file = str(tmp_path / 'clusterize.tsv.zst')
+    with open(zstd_file, mode='wb') as handle:
+        handle.write(zstandard.ZstdCompressor().compress(data))
+    assert compression_type(zstd_file) == 'zstd'
+    assert list(parse_blast_file_to_hits(zstd_file)) == expected
+
+
+def test_unsorted_blast(tmp_path):
+    lines = open('test_data/clusterize.tsv').readlines()
+    # A second HSP for one of the hits, to check that HSP order is retained
+    extra = lines[1].split('\t')
+    extra[6:10] = ['400', '450', '400', '450']
+    lines.append('\t'.join(extra))
+    random.Random(42).shuffle(lines)
+    shuffled = str(tmp_path / 'shuffled.tsv')
+    open(shuffled, mode='w').write(''.join(lines))
+    # Stable in-memory sort is the reference
+    expected = list(assemble_hits(sorted(parse_blast_file_to_hsps(shuffled),
+                                         key=lambda x: (x.query_id,
+                                                        x.hit_id))))
+    assert len(expected) == 62
+    # Tiny memory limit to make sure there are several runs
+    hits = list(parse_unsorted_blast_file_to_hits(shuffled, memory_limit=10000,
+                                                  temp_dir=str(tmp_path)))
+    assert hits == expected
+    assert list(parse_unsorted_blast_file_to_hits(shuffled)) == expected
+    #  A run for every couple of lines, merged three at a time in several
+    #  passes
+    temp_dir = tmp_path / 'temp'
+    temp_dir.mkdir()
+    assert list(parse_unsorted_blast_file_to_hits(
+        shuffled, memory_limit=300, temp_dir=str(temp_dir),
+        max_runs=3)) == expected
+    hsps = parse_unsorted_blast_file_to_hsps(shuffled, memory_limit=300,
+                                             temp_dir=str(temp_dir))
+    next(hsps)
+    assert len(list(next(temp_dir.iterdir()).iterdir())) > 20
+    hsps.close()
+    assert list(temp_dir.iterdir()) == []
+    assert len(list(iterate_by_query(iter(hits)))) == 16
+
+
+def test_blast_cache(tmp_path):
+    cache_dir = write_blast_cache('test_data/clusterize.tsv',
+                                  str(tmp_path / 'cache'), chunk_size=500)
+    cache = BlastCache(cache_dir)
+    # All 17 queries are stored, including the one with trivial hits only
+    assert len(cache) == 17
+    assert len(cache.columns['evalue']) == 79
+    table = cache.query_table(1)
+    assert table.names[table.query_ids[0]] == 'Thaps_actinlike_2'
+    assert len(table.evalue) == 5
+    # Without filters tables are views of memory maps
+    assert all(x.evalue.base is not None for x in
+               cache.tables(ignore_trivial=False, chunk_rows=10))
+    assert list(parse_blast_file_to_hits(cache_dir)) == \
+        list(parse_blast_file_to_hits('test_data/clusterize.tsv'))
+    assert list(iterate_by_query(cache)) == list(iterate_by_query(
+        parse_blast_file_to_hits('test_data/clusterize.tsv')))
+    queries = {'Thaps_actinlike_1', 'Botrytis_cinerea_chitin', 'foo'}
+    assert list(cache.iterate_hits(evalue_cutoff=1e-30, query_ids=queries)) == \
+        list(parse_blast_file_to_hits('test_data/clusterize.tsv',
+                                      evalue_cutoff=1e-30, query_ids=queries))
+    assert list(parse_blast_file_to_hits(cache_dir, min_length=300)) == \
+        list(parse_blast_file_to_hits('test_data/clusterize.tsv',
+                                      min_length=300))
+    #  Shards split the cache between queries and cover it all
+    shards = cache.shards(4)
+    assert shards[0][0] == 0 and shards[-1][1] == 79
+    assert all(x[1] == y[0] for x, y in zip(shards, shards[1:]))
+    assert list(chain.from_iterable(
+        tables_to_hits(cache.tables(start=start, end=end, chunk_rows=10))
+        for start, end in shards)) == \
+        list(parse_blast_file_to_hits('test_data/clusterize.tsv'))
+    assert len(cache.shards(100)) == 17
+    #  A failed rewrite leaves the old cache intact and no temporary files
+    with pytest.raises(ValueError):
+        write_blast_cache('README.md', cache_dir)
+    assert len(BlastCache(cache_dir)) == 17
+    assert [x.name for x in tmp_path.iterdir()] == ['cache']
+    with pytest.raises(ValueError):
+        BlastCache(str(tmp_path))
+
+
+def test_compact_hits(tmp_path):
+    hits = list(parse_blast_file_to_hits('test_data/clusterize.tsv'))
+    compact = list(compact_hits(hits))
+    assert all(isinstance(x, CompactHit) for x in compact)
+    assert [x.to_hit() for x in compact] == hits
+    from_tables = tables_to_compact_hits(parse_blast_file_to_table(
+        'test_data/clusterize.tsv', chunk_size=500))
+    assert [x.to_hit() for x in from_tables] == hits
+    assert [x.to_hit() for x in compact_hits('test_data/clusterize.tsv')] == \
+        hits
+    cache_dir = write_blast_cache('test_data/clusterize.tsv',
+                                  str(tmp_path / 'cache'))
+    assert [x.to_hit() for x in compact_hits(cache_dir)] == hits
+    hit = CompactHit.from_hit(BlastHit('q', 'h', [
+        BlastHSP('q', 'h', (1, 100), (5, 95), 1e-10),
+        BlastHSP('q', 'h', (150, 250), (1, 100), 1e-5)]))
+    assert len(hit.hsps) == 2
+    assert hit.hsps[-1].hit_pos == (1, 100)
+    assert hit.hsps[0].evalue == 1e-10
+    assert [x.query_pos for x in hit.hsps] == [(1, 100), (150, 250)]
+    with pytest.raises(IndexError):
+        hit.hsps[2]
+    with pytest.raises(AttributeError):
+        hit.foo = 'bar'
+    assert is_duplicate(hit)
+
+
 def test_assemble_hits():
     # This file contains 46 hits, only 5 out of which have 2 hsps and the rest 1
     hits = list(assemble_hits(parse_blast_file_to_hsps('test_data/BLAST_test.tsv')))
@@ -116,6 +322,103 @@ def test_iterate_by_query():
     assert [len(x) for x in l] == [5, 3, 5, 6, 6, 6, 6, 4, 5]
 
 
+def test_blast_table():
+    # 79 lines, 17 of them trivial. Tiny chunks to make hits span tables
+    tables = list(parse_blast_file_to_table('test_data/clusterize.tsv',
+                                            chunk_size=500))
+    assert len(tables) > 1
+    assert sum(len(x.evalue) for x in tables) == 62
+    assert all(x.names is tables[0].names for x in tables)
+    assert tables[0].query_start.dtype == 'int32'
+    assert tables[0].evalue.dtype == 'float64'
+    assert list(tables_to_hits(tables)) == \
+        list(parse_blast_file_to_hits('test_data/clusterize.tsv'))
+    untrivial = parse_blast_file_to_table('test_data/clusterize.tsv',
+                                          ignore_trivial=False)
+    assert sum(len(x.evalue) for x in untrivial) == 79
+    #  IDs are coded in the order of appearance
+    lines = [x.split('\t')[:2] for x in open('test_data/clusterize.tsv')]
+    table = next(parse_blast_file_to_table('test_data/clusterize.tsv'))
+    assert table.names == list(dict.fromkeys(chain(*zip(*lines))))
+    with pytest.raises(ValueError):
+        list(parse_blast_file_to_table('README.md'))
+    #  Empty input (or everything filtered out) makes no hits at all
+    assert list(parse_blast_file_to_hits(StringIO(''))) == []
+    assert list(parse_blast_file_to_hits('test_data/clusterize.tsv',
+                                         evalue_cutoff=0)) == []
+    assert list(iterate_by_query(iter([]))) == []
+
+
+def test_parallel_parsing():
+    shards = query_aligned_shards('test_data/clusterize.tsv', 5)
+    assert len(shards) > 1
+    assert shards[0][0] == 0 and shards[-1][1] == 6420
+    # Every shard should start with a new query
+    lines = open('test_data/clusterize.tsv', mode='rb').read()
+    for start, end in shards[1:]:
+        assert lines[start-1:start] == b'\n'
+        assert lines[:start].split(b'\n')[-2].split(b'\t')[0] != \
+            lines[start:].split(b'\t')[0]
+    sequential = list(iterate_by_query(
+        parse_blast_file_to_hits('test_data/clusterize.tsv')))
+    parallel = list(parse_blast_file_parallel('test_data/clusterize.tsv',
+                                              processes=2, shard_size=500))
+    assert parallel == sequential
+    unordered = parse_blast_file_parallel('test_data/clusterize.tsv',
+                                          processes=2, ordered=False,
+                                          shard_size=500)
+    assert sorted(unordered) == sorted(sequential)
+    # Shard count follows the file size
+    assert len(pool_shards('test_data/clusterize.tsv', 2, 10**6)) == 2
+    shards = pool_shards('test_data/clusterize.tsv', 2, 500)
+    assert len(shards) > 5
+    assert list(chain.from_iterable(
+        iterate_blast_shard('test_data/clusterize.tsv', start, end)
+        for start, end in shards)) == sequential
+    with pytest.raises(TypeError):
+        list(parse_blast_file_parallel(open('test_data/clusterize.tsv')))
+
+
+def test_query_index(tmp_path):
+    index_file = build_query_index('test_data/clusterize.tsv',
+                                   str(tmp_path / 'clusterize.qidx'))
+    index = load_query_index(index_file)
+    assert len(index) == 17
+    assert index['Thaps_actinlike_1'][0] == 0
+    groups = {x[0].query_id: x for x in iterate_by_query(
+        parse_blast_file_to_hits('test_data/clusterize.tsv'))}
+    with BlastIndex('test_data/clusterize.tsv', index_file) as blast_index:
+        assert 'C._fusiformis_SIT4' in blast_index
+        assert blast_index.get_hits('C._fusiformis_SIT4') == \
+            groups['C._fusiformis_SIT4']
+        # Only trivial hits here
+        assert blast_index.get_hits('SAcus_actinlike_2') == []
+        with pytest.raises(KeyError):
+            blast_index.get_hits('foo')
+        queries = ['Botrytis_cinerea_chitin', 'foo', 'Thaps_actinlike_3']
+        assert list(blast_index.iterate_queries(queries)) == \
+            [('Thaps_actinlike_3', groups['Thaps_actinlike_3']),
+             ('Botrytis_cinerea_chitin', groups['Botrytis_cinerea_chitin'])]
+    # Unsorted file
+    lines = open('test_data/clusterize.tsv').readlines()
+    unsorted = tmp_path / 'unsorted.tsv'
+    unsorted.write_text(''.join(lines[2:] + lines[:2]))
+    with pytest.raises(ValueError):
+        build_query_index(str(unsorted))
+    #  Nothing is left from the failed build
+    assert sorted(tmp_path.iterdir()) == [tmp_path / 'clusterize.qidx',
+                                          unsorted]
+    #  Index of another version of the file is rejected
+    copy = tmp_path / 'copy.tsv'
+    copy.write_text(''.join(lines))
+    build_query_index(str(copy))
+    assert query_index_is_current(str(copy))
+    copy.write_text(''.join(lines[:-1]))
+    assert not query_index_is_current(str(copy))
+    with pytest.raises(ValueError):
+        BlastIndex(str(copy))
+
+
 def test_duplicates():
     # Test the duplicate-detection methods.
     # query1 is duplicate, query2 isn't, single_hsp is guess what
@@ -140,6 +443,587 @@ def test_duplicates():
     assert not is_duplicate(non_duplicate_hit)
 
 
+def test_sweep_duplicates():
+    # The sweep should always agree with the pairwise reference
+    rng = random.Random(0)
+    for _ in range(2000):
+        hsps = []
+        for _ in range(rng.randint(0, 12)):
+            query_start = rng.randint(1, 500)
+            hit_start = rng.randint(1, 300)
+            hit_pos = (hit_start, hit_start + rng.randint(0, 150))
+            if rng.random() < 0.02:
+                hit_pos = hit_pos[::-1]
+            hsps.append(BlastHSP('q', 'h',
+                                 (query_start,
+                                  query_start + rng.randint(0, 150)),
+                                 hit_pos, 1e-10))
+        hit = BlastHit('q', 'h', hsps)
+        for overlap_cutoff, len_cutoff in ((0.5, 50), (0.2, 10), (0.9, 0)):
+            assert is_duplicate(hit, overlap_cutoff, len_cutoff) == \
+                is_duplicate_pairwise(hit, overlap_cutoff, len_cutoff)
+
+
+def random_blast_lines(rng, query_count=30):
+    # Lots of overlapping HSPs to have both duplicates and non-duplicates
+    lines = []
+    for query in range(query_count):
+        for hit in range(rng.randint(1, 5)):
+            for _ in range(rng.randint(1, 6)):
+                query_start = rng.randint(1, 500)
+                hit_start = rng.randint(1, 300)
+                lines.append('\t'.join(
+                    ['q{}'.format(query), 'h{}'.format(hit), '50.0', '100',
+                     '10', '0', str(query_start),
+                     str(query_start + rng.randint(0, 150)), str(hit_start),
+                     str(hit_start + rng.randint(0, 150)), '1e-10',
+                     '100\n']))
+    return lines
+
+
+def test_batch_duplicates(tmp_path):
+    #  Only the HSPs overlapping on hit are paired, in any input order
+    first, second, skipped = overlapping_pairs(
+        np.array([0, 0, 0, 1, 2, 2, 2]), np.array([50, 1, 90, 1, 1, 1, 10]),
+        np.array([100, 60, 95, 9, 5, 5, 20]))
+    assert sorted(zip(first.tolist(), second.tolist())) == \
+        [(0, 2), (1, 0), (4, 5)]
+    assert len(skipped) == 0
+    assert overlapping_pairs(np.array([0, 0, 0, 1, 1]), np.array([1] * 5),
+                             np.array([10] * 5), max_hit_pairs=2)[2].tolist() \
+        == [0]
+    lines = random_blast_lines(random.Random(1))
+    blast_file = str(tmp_path / 'random.tsv')
+    open(blast_file, mode='w').write(''.join(lines))
+    for overlap_cutoff, len_cutoff in ((0.5, 50), (0.2, 10)):
+        expected = []
+        for group in iterate_by_query(parse_blast_file_to_hits(blast_file)):
+            duplicates = [is_duplicate(x, overlap_cutoff, len_cutoff)
+                          for x in group]
+            expected.append((group[0].query_id,
+                             sum(duplicates) / len(duplicates)))
+        assert 0 < sum(x[1] for x in expected) < len(expected)
+        tables = query_aligned_tables(parse_blast_file_to_table(
+            blast_file, chunk_size=1000))
+        fractions = []
+        for table in tables:
+            fractions += query_duplicate_fractions(table, overlap_cutoff,
+                                                   len_cutoff)
+        assert fractions == expected
+        shards = map_blast_table_shards(
+            partial(query_duplicate_fractions, overlap_cutoff=overlap_cutoff,
+                    len_cutoff=len_cutoff),
+            blast_file, processes=2, shard_size=1000)
+        assert sum(shards, []) == expected
+    queries, fractions = table_duplicate_fractions(
+        next(parse_blast_file_to_table(blast_file)))
+    assert len(queries) == len(fractions) == 30
+    #  Falling back to `is_duplicate` for every hit, and for reverse ranges
+    hits = list(parse_blast_file_to_hits(blast_file))
+    hits[0] = BlastHit(hits[0].query_id, hits[0].hit_id,
+                       [x._replace(hit_pos=x.hit_pos[::-1])
+                        for x in hits[0].hsps])
+    hit_index = np.repeat(np.arange(len(hits)), [len(x.hsps) for x in hits])
+    coordinates = [np.array([x.query_pos[0] for y in hits for x in y.hsps]),
+                   np.array([x.query_pos[1] for y in hits for x in y.hsps]),
+                   np.array([x.hit_pos[0] for y in hits for x in y.hsps]),
+                   np.array([x.hit_pos[1] for y in hits for x in y.hsps])]
+    expected = [is_duplicate(x, 0.2, 10) for x in hits]
+    for max_hit_pairs in (0, 2**16):
+        assert hit_duplicate_flags(hit_index, *coordinates, overlap_cutoff=0.2,
+                                   len_cutoff=10,
+                                   max_hit_pairs=max_hit_pairs).tolist() == \
+            expected
+
+
+def test_sweep_fractions(tmp_path):
+    blast_file = str(tmp_path / 'random.tsv')
+    open(blast_file, mode='w').write(''.join(
+        random_blast_lines(random.Random(2))))
+    table = next(parse_blast_file_to_table(blast_file))
+    overlap_cutoffs = [0.1, 0.5, 0.9]
+    len_cutoffs = [0, 50, 100]
+    queries, fractions = table_sweep_fractions(table, overlap_cutoffs,
+                                               len_cutoffs)
+    assert fractions.shape == (3, 3, 30)
+    groups = list(iterate_by_query(parse_blast_file_to_hits(blast_file)))
+    for i, overlap_cutoff in enumerate(overlap_cutoffs):
+        for j, len_cutoff in enumerate(len_cutoffs):
+            expected = [sum(is_duplicate(x, overlap_cutoff, len_cutoff)
+                            for x in group) / len(group) for group in groups]
+            assert fractions[i, j].tolist() == expected
+    #  Same through `is_duplicate` for every hit
+    assert (table_sweep_fractions(table, overlap_cutoffs, len_cutoffs,
+                                  max_hit_pairs=0)[1] == fractions).all()
+
+
+# NCBI taxon ID and parent ID for a few lineages. Diatoms are the same as
+# in test_taxa_descent, the rest are real taxa, too
+TEST_TAXA = [(1, 1), (131567, 1), (2, 131567), (2157, 131567),
+             (2759, 131567), (33634, 2759), (2836, 33634), (33853, 2836),
+             (33854, 33853), (33855, 33854), (33856, 33855), (191584, 33856),
+             (33090, 2759), (2763, 2759), (2806, 2763), (3193, 33090)]
+
+
+class FakeBioSQLCursor:
+    """
+    Answers the queries phylome.taxonomy makes to a BioSQL taxon table.
+    Internal IDs are assigned in the list order, root being 1.
+    """
+    def __init__(self, taxa):
+        self.internal = {ncbi: i + 1 for i, (ncbi, _) in enumerate(taxa)}
+        self.rows = [(self.internal[ncbi], ncbi, self.internal[parent])
+                     for ncbi, parent in taxa]
+        self.result = []
+        self.query_count = 0
+
+    def execute(self, query):
+        self.query_count += 1
+        value = query.rstrip(';').split('=')[-1]
+        if 'WHERE' not in query:
+            self.result = list(self.rows)
+        elif query.startswith('SELECT `taxon_id`'):
+            self.result = [(x[0],) for x in self.rows if x[1] == int(value)]
+        elif query.startswith('SELECT `parent_taxon_id`'):
+            self.result = [(x[2],) for x in self.rows if x[0] == int(value)]
+        else:
+            self.result = [(x[1],) for x in self.rows if x[0] == int(value)]
+
+    def fetchall(self):
+        return self.result
+
+
+def test_taxonomy_tree():
+    cursor = FakeBioSQLCursor(TEST_TAXA)
+    tree = TaxonomyTree.from_cursor(cursor)
+    assert cursor.query_count == 1
+    for taxon, _ in TEST_TAXA:
+        assert list(descend_taxon_tree(taxon, tree)) == \
+            list(descend_taxon_tree(taxon, cursor))
+    assert cursor.query_count > 1
+    cursor.query_count = 0
+    assert list(descend_taxon_tree(191584, tree)) == [
+        33856, 33855, 33854, 33853, 2836, 33634, 2759, 131567]
+    assert tree.get_taxa_list(191584) == get_taxa_list(191584, tree) == [
+        131567, 2759, 33634, 2836, 33853, 33854, 33855, 33856]
+    assert is_taxon_member(191584, 2836, tree)
+    assert not tree.is_taxon_member(191584, 2)
+    assert get_supertaxon_from_list(191584, [2, 2157, 2759], tree) == 2759
+    assert tree.get_supertaxon_from_list(3193, [2763, 33090]) == 33090
+    assert tree.get_supertaxon_from_list(2, [2763, 33090]) is None
+    assert cursor.query_count == 0
+    with pytest.raises(ValueError):
+        list(descend_taxon_tree(10000000, tree))
+    with pytest.raises(ValueError):
+        list(descend_taxon_tree(5, tree))
+    with pytest.raises(TypeError):
+        list(descend_taxon_tree('foo', tree))
+
+
+def test_taxdump(tmp_path):
+    ranks = {1: 'no rank', 2: 'superkingdom', 2759: 'superkingdom',
+             2836: 'phylum', 191584: 'genus'}
+    with open(str(tmp_path / 'nodes.dmp'), mode='w') as nodes:
+        for taxon, parent in TEST_TAXA:
+            print('\t|\t'.join([str(taxon), str(parent),
+                                ranks.get(taxon, 'clade'), 'XX', '0\t|']),
+                  file=nodes)
+    with open(str(tmp_path / 'names.dmp'), mode='w') as names:
+        print('2836\t|\tBacillariophyta\t|\t\t|\tscientific name\t|',
+              file=names)
+        print('2836\t|\tdiatoms\t|\t\t|\tcommon name\t|', file=names)
+        print('2\t|\tBacteria\t|\tBacteria <bacteria>\t|\tscientific name\t|',
+              file=names)
+    tree = TaxonomyTree.from_taxdump(str(tmp_path / 'nodes.dmp'),
+                                     str(tmp_path / 'names.dmp'))
+    tree.save(str(tmp_path / 'taxonomy'))
+    loaded = TaxonomyTree.load(str(tmp_path / 'taxonomy'))
+    assert isinstance(loaded.parent, np.memmap)
+    reference = TaxonomyTree.from_cursor(FakeBioSQLCursor(TEST_TAXA))
+    for taxon, _ in TEST_TAXA:
+        assert get_taxa_list(taxon, loaded) == get_taxa_list(taxon, reference)
+    assert loaded.root == 1
+    assert loaded.get_rank(2836) == 'phylum'
+    assert loaded.get_rank(33634) == 'clade'
+    assert loaded.get_name(2836) == 'Bacillariophyta'
+    assert loaded.get_name(2) == 'Bacteria'
+    assert loaded.get_name(33634) == ''
+    assert get_supertaxon_from_list(191584, [2, 2157, 2759], loaded) == 2759
+    with pytest.raises(ValueError):
+        loaded.get_name(5)
+
+
+def test_taxonomy_index(tmp_path):
+    walking = TaxonomyTree.from_cursor(FakeBioSQLCursor(TEST_TAXA))
+    tree = TaxonomyTree.from_cursor(FakeBioSQLCursor(TEST_TAXA)).build_index()
+    taxa = [taxon for taxon, _ in TEST_TAXA]
+    assert tree.depth[1] == 0 and tree.depth[191584] == 9
+    for taxon in taxa:
+        for other in taxa:
+            assert tree.is_taxon_member(taxon, other) == \
+                walking.is_taxon_member(taxon, other)
+        assert tree.get_supertaxon_from_list(taxon, [2763, 33090, 2836, 2]) \
+            == walking.get_supertaxon_from_list(taxon, [2763, 33090, 2836, 2])
+    assert tree.get_supertaxon_from_list(191584, [2759, 33853, 2836]) == 33853
+    assert tree.get_supertaxon_from_list(191584, [1, 5, 191584]) is None
+    with pytest.raises(ValueError):
+        tree.is_taxon_member(5, 2759)
+    supertaxa = tree.batch_supertaxa(np.array(taxa + [5, 10**8]),
+                                     [2763, 33090, 2759])
+    assert supertaxa.tolist() == [
+        walking.get_supertaxon_from_list(x, [2763, 33090, 2759]) or 0
+        for x in taxa] + [0, 0]
+    assert tree.batch_is_member([191584, 3193, 2], 2759).tolist() == \
+        [True, True, False]
+    tree.save(str(tmp_path / 'taxonomy'))
+    loaded = TaxonomyTree.load(str(tmp_path / 'taxonomy'))
+    assert np.array_equal(loaded.exit, tree.exit)
+    assert loaded.is_taxon_member(2806, 2763)
+
+
+def test_taxonomy_lca():
+    tree = TaxonomyTree.from_cursor(FakeBioSQLCursor(TEST_TAXA)).build_lca()
+    taxa = [taxon for taxon, _ in TEST_TAXA]
+    rng = random.Random(7)
+    first = [rng.choice(taxa) for _ in range(200)]
+    second = [rng.choice(taxa) for _ in range(200)]
+    for a, b, lca in zip(first, second, tree.pairwise_lca(first, second)):
+        common = [x for x in [a] + list(descend_taxon_tree(a, tree)) + [1]
+                  if x in [b] + list(descend_taxon_tree(b, tree)) + [1]]
+        assert lca == common[0]
+    assert tree.lca([191584, 2806, 3193]) == 2759
+    assert tree.lca([2806, 3193, 5]) == 2759
+    assert tree.lca([33856, 191584]) == 33856
+    assert tree.lca([2, 191584]) == 131567
+    assert tree.lca([5]) is None
+    assert tree.group_lca([2806, 3193, 2, 191584, 33854], [0, 0, 2, 3, 3],
+                          5).tolist() == [2759, 0, 2, 33854, 0]
+
+
+def test_supertaxon_cache(tmp_path):
+    cursor = FakeBioSQLCursor(TEST_TAXA)
+    cache = SupertaxonCache(max_size=3)
+    assert cache.get(3193, [2763, 33090], cursor) == 33090
+    queries = cursor.query_count
+    assert cache.get(3193, [2763, 33090], cursor) == 33090
+    assert cursor.query_count == queries
+    assert cache.get(3193, [2763], cursor) is None
+    with pytest.raises(ValueError):
+        cache.get(5, [2763], cursor)
+    with pytest.raises(ValueError):
+        cache.get(5, [2763], cursor)
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 3, 0)
+    #  (3193, (2763, 33090)) is the least recently used one
+    assert cache.get(2806, [2763, 33090], cursor) == 2763
+    assert cache.evictions == 1
+    assert (3193, (2763, 33090)) not in cache.entries
+    cache.save(str(tmp_path / 'cache.tsv'))
+    loaded = SupertaxonCache(filename=str(tmp_path / 'cache.tsv'))
+    assert loaded.entries == cache.entries
+    queries = cursor.query_count
+    with pytest.raises(ValueError):
+        loaded.get(5, [2763], cursor)
+    assert loaded.get(3193, [2763], cursor) is None
+    assert cursor.query_count == queries
+
+
+def test_lineage_store(tmp_path):
+    cursor = FakeBioSQLCursor(TEST_TAXA)
+    store = LineageStore(str(tmp_path / 'lineages.sqlite'), cursor)
+    lineages = store.get_lineages([191584, 3193, 5])
+    assert lineages == {191584: list(descend_taxon_tree(191584, cursor)),
+                        3193: [33090, 2759, 131567], 5: None}
+    #  Another process would open its own store on the same file
+    cursor.query_count = 0
+    other = LineageStore(str(tmp_path / 'lineages.sqlite'), cursor)
+    assert list(descend_taxon_tree(33855, other)) == \
+        [33854, 33853, 2836, 33634, 2759, 131567]
+    assert get_supertaxon_from_list(191584, [2836, 2763], other) == 2836
+    assert is_taxon_member(3193, 33090, other)
+    with pytest.raises(ValueError):
+        list(descend_taxon_tree(5, other))
+    assert cursor.query_count == 0
+    assert get_supertaxon_from_list(2806, [2763], other) == 2763
+    assert cursor.query_count > 0
+    for x in (store, other):
+        x.close()
+
+
+def test_demultiplexer(tmp_path):
+    rng = random.Random(5)
+    filenames = [str(tmp_path / '{}.txt'.format(x)) for x in range(7)]
+    expected = {x: '' for x in filenames}
+    with Demultiplexer(max_handles=2, buffer_size=50,
+                       max_buffered=120) as demultiplexer:
+        for filename in filenames:
+            demultiplexer.create(filename)
+        for i in range(500):
+            filename = rng.choice(filenames)
+            data = '{}\n'.format(i).encode() * rng.randint(1, 5)
+            demultiplexer.write(filename, data)
+            expected[filename] += data.decode()
+            assert len(demultiplexer.handles) <= 2
+    for filename in filenames:
+        assert open(filename).read() == expected[filename]
+    routes = {'Thaps_actinlike_1': [filenames[0], filenames[1]],
+              'C._fusiformis_SIT1': [filenames[1]], 'missing': [filenames[2]]}
+    with Demultiplexer(max_handles=1) as demultiplexer:
+        for filename in filenames[:3]:
+            demultiplexer.create(filename)
+        assert demultiplex_fasta('test_data/clusterize.fasta', routes,
+                                 demultiplexer) == 2
+    records = {x.id: x.raw.decode() for x in
+               read_fasta('test_data/clusterize.fasta')}
+    assert open(filenames[0]).read() == records['Thaps_actinlike_1']
+    assert open(filenames[1]).read() == records['Thaps_actinlike_1'] + \
+        records['C._fusiformis_SIT1']
+    assert open(filenames[2]).read() == ''
+
+
+def test_cluster_store(tmp_path):
+    lists = [['b', 'a', 'c'], ['d', 'a'], [], ['e', 'e']]
+    store = ClusterStore.from_lists(iter(lists))
+    store.save(str(tmp_path / 'clusters'))
+    for clusters in (store, ClusterStore.load(str(tmp_path / 'clusters'))):
+        assert len(clusters) == 4
+        assert [clusters.members_of(x) for x in range(4)] == \
+            [['b', 'a', 'c'], ['d', 'a'], [], ['e']]
+        assert clusters.codes(['a', 'e', 'missing', 'aaaaaaaaaa']).tolist() \
+            == [0, 4, -1, -1]
+        assert list(clusters.clusters_of('a')) == [0, 1]
+        assert clusters.cluster_of('a') == 1
+        assert clusters.cluster_of('missing') == -1
+        assert 'd' in clusters and 'f' not in clusters
+    pairs = ClusterStore.from_pairs([(2, 'x'), (0, 'y'), (2, 'x'), (0, 'x')],
+                                    cluster_count=4)
+    assert [pairs.members_of(x) for x in range(4)] == [['x', 'y'], [], ['x'],
+                                                      []]
+    filenames = [str(tmp_path / '{}.fasta'.format(x)) for x in range(2)]
+    store = ClusterStore.from_lists([['Thaps_actinlike_1'],
+                                     ['Thaps_actinlike_1',
+                                      'C._fusiformis_SIT1']])
+    with Demultiplexer() as demultiplexer:
+        for filename in filenames:
+            demultiplexer.create(filename)
+        assert demultiplex_fasta('test_data/clusterize.fasta',
+                                 store.routes(filenames), demultiplexer,
+                                 batch_size=3) == 2
+    records = {x.id: x.raw.decode() for x in
+               read_fasta('test_data/clusterize.fasta')}
+    assert open(filenames[0]).read() == records['Thaps_actinlike_1']
+    assert open(filenames[1]).read() == records['Thaps_actinlike_1'] + \
+        records['C._fusiformis_SIT1']
+    #  Saved parameters are checked on loading
+    store.save(str(tmp_path / 'saved'), {'min': 1, 'list': 'list.txt'})
+    assert len(ClusterStore.load(str(tmp_path / 'saved'),
+                                 {'min': 1, 'list': None})) == 2
+    with pytest.raises(ValueError):
+        ClusterStore.load(str(tmp_path / 'saved'), {'min': 2})
+    (tmp_path / 'clusters' / 'parameters.tsv').unlink()
+    with pytest.raises(ValueError):
+        ClusterStore.load(str(tmp_path / 'clusters'), {'min': 1})
+    #  Stores filter BLAST queries in batches, same as sets
+    queries = ['Thaps_actinlike_1', 'C._fusiformis_SIT1', 'foo']
+    store = ClusterStore.from_lists([queries])
+    expected = list(parse_blast_file_to_hits('test_data/clusterize.tsv',
+                                             query_ids=set(queries)))
+    assert len(expected) > 2
+    assert list(parse_blast_file_to_hits('test_data/clusterize.tsv',
+                                         query_ids=store)) == expected
+    cache_dir = write_blast_cache('test_data/clusterize.tsv',
+                                  str(tmp_path / 'cache'))
+    assert list(parse_blast_file_to_hits(cache_dir,
+                                         query_ids=store)) == expected
+    blast_file = tmp_path / 'blast.tsv'
+    blast_file.write_text(open('test_data/clusterize.tsv').read())
+    build_query_index(str(blast_file))
+    with BlastIndex(str(blast_file)) as blast_index:
+        assert list(blast_index.iterate_queries(store)) == \
+            list(blast_index.iterate_queries(queries))
+
+
+def test_read_fasta(tmp_path):
+    reference = list(SeqIO.parse('test_data/clusterize.fasta', 'fasta'))
+    raw = open('test_data/clusterize.fasta', mode='rb').read()
+    with gzip.open(str(tmp_path / 'seqs.fasta.gz'), mode='wb') as handle:
+        handle.write(raw)
+    #  Tiny chunks to split records between them
+    for records in (list(read_fasta('test_data/clusterize.fasta')),
+                    list(read_fasta(str(tmp_path / 'seqs.fasta.gz'),
+                                    chunk_size=100))):
+        assert [x.id for x in records] == [x.id for x in reference]
+        assert [x.header.decode() for x in records] == \
+            [x.description for x in reference]
+        assert [sequence_bytes(x).decode() for x in records] == \
+            [str(x.seq) for x in reference]
+        with open(str(tmp_path / 'copy.fasta'), mode='wb') as handle:
+            assert write_fasta(records, handle) == len(reference)
+        assert open(str(tmp_path / 'copy.fasta'), mode='rb').read() == raw
+    #  Record boundaries at every position relative to the chunks
+    for chunk_size in (1, 2, 3, 61, 1000):
+        assert b''.join(x.raw for x in read_fasta(
+            'test_data/clusterize.fasta', chunk_size=chunk_size)) == raw
+    with open(str(tmp_path / 'ragged.fasta'), mode='wb') as handle:
+        handle.write(b'>a desc\r\nMA A\r\n\n>b\n>c\nMK')
+    records = list(read_fasta(str(tmp_path / 'ragged.fasta')))
+    assert [(x.id, x.header, sequence_bytes(x)) for x in records] == \
+        [('a', b'a desc', b'MAA'), ('b', b'b', b''), ('c', b'c', b'MK')]
+
+
+def test_fasta_statistics(tmp_path):
+    with open(str(tmp_path / 'masked.fasta'), mode='wb') as handle:
+        handle.write(b'>a\nMAXx\nmaa\n>empty\n>b\nXXXX XXXX\r\nMAAAAAAA\n')
+    records = list(read_fasta('test_data/clusterize.fasta')) + \
+        list(read_fasta(str(tmp_path / 'masked.fasta')))
+    statistics = fasta_statistics(records)
+    sequences = [sequence_bytes(x).decode() for x in records]
+    assert statistics.length.tolist() == [len(x) for x in sequences]
+    assert statistics.length.tolist()[:17] == \
+        [len(x) for x in SeqIO.parse('test_data/clusterize.fasta', 'fasta')]
+    assert statistics.x_count.tolist() == \
+        [x.count('X') + x.count('x') for x in sequences]
+    assert statistics.lowercase_count.tolist()[-3:] == [4, 0, 0]
+    assert statistics.masked_count.tolist()[-3:] == [5, 0, 8]
+    assert [x.id for x in filter_fasta_records(records[-3:],
+                                               max_masked=0.5)] == \
+        ['empty', 'b']
+    assert [x.id for x in filter_fasta_records(records[-3:], min_length=6,
+                                               max_x=0.5)] == ['a']
+    long_ones = [x.id for x in filter_fasta_records(records, min_length=400,
+                                                    batch_size=4)]
+    assert long_ones == [x.id for x, length in zip(records, statistics.length)
+                         if length > 400]
+
+
+def test_fasta_index(tmp_path):
+    lines = open('test_data/clusterize.fasta').read().splitlines()
+    #  No newline at the end
+    with open(str(tmp_path / 'seqs.fasta'), mode='w') as fasta:
+        fasta.write('\n'.join(lines))
+    records = {x.id: x for x in
+               SeqIO.parse(str(tmp_path / 'seqs.fasta'), 'fasta')}
+    index_filename = build_fasta_index(str(tmp_path / 'seqs.fasta'))
+    assert index_filename == str(tmp_path / 'seqs.fasta.fidx')
+    with FastaIndex(str(tmp_path / 'seqs.fasta')) as fasta_index:
+        assert list(fasta_index) == list(records)
+        for seqid, record in records.items():
+            raw = fasta_index.get_raw(seqid)
+            assert raw.startswith(b'>') and raw.endswith(b'\n')
+            parsed = next(SeqIO.parse(StringIO(raw.decode()), 'fasta'))
+            assert parsed.description == record.description
+            assert parsed.seq == record.seq
+        wanted = ['Aspergillus_nidans_chitin', 'missing', 'Thaps_actinlike_1']
+        with open(str(tmp_path / 'out.fasta'), mode='wb') as handle:
+            assert fasta_index.write_records(wanted, handle) == 2
+    assert [x.id for x in SeqIO.parse(str(tmp_path / 'out.fasta'),
+                                      'fasta')] == \
+        ['Thaps_actinlike_1', 'Aspergillus_nidans_chitin']
+    #  Rewriting the FASTA in place makes the old index outdated
+    text = '\n'.join(lines)
+    with open(str(tmp_path / 'seqs.fasta'), mode='w') as fasta:
+        fasta.write(text[text.index('\n>') + 1:])
+    with pytest.raises(ValueError):
+        load_fasta_index(index_filename, str(tmp_path / 'seqs.fasta'))
+    with FastaIndex(str(tmp_path / 'seqs.fasta')) as fasta_index:
+        assert list(fasta_index) == list(records)[1:]
+        raw = fasta_index.get_raw('Aspergillus_nidans_chitin')
+        assert str(next(SeqIO.parse(StringIO(raw.decode()), 'fasta')).seq) == \
+            str(records['Aspergillus_nidans_chitin'].seq)
+    assert sorted(x.name for x in tmp_path.iterdir()) == \
+        ['out.fasta', 'seqs.fasta', 'seqs.fasta.fidx']
+    with gzip.open(str(tmp_path / 'seqs.fasta.gz'), mode='wt') as fasta:
+        fasta.write('>foo\nMAAA\n')
+    with pytest.raises(ValueError):
+        build_fasta_index(str(tmp_path / 'seqs.fasta.gz'))
+    #  Repeated IDs keep the first record; an old TSV index is replaced
+    repeated = str(tmp_path / 'repeated.fasta')
+    with open(repeated, mode='w') as fasta:
+        fasta.write('junk\n>b first\nMA\n>a\nMC\n>b second\nMD\n>c\n')
+    with open(repeated + '.fidx', mode='w') as index:
+        index.write('b\t0\t10\n')
+    build_fasta_index(repeated, chunk_size=2)
+    with FastaIndex(repeated) as fasta_index:
+        assert list(fasta_index) == ['b', 'a', 'c']
+        assert fasta_index.get_raw('b') == b'>b first\nMA\n'
+        assert fasta_index.get_raw('c') == b'>c\n'
+        assert 'a' in fasta_index and 'missing' not in fasta_index
+        with pytest.raises(KeyError):
+            fasta_index.get_raw('missing')
+
+
+def test_accession_index(tmp_path):
+    rng = random.Random(3)
+    mapping = {'{}_{:06d}'.format(rng.choice(['XP', 'WP', 'NP']),
+                                  rng.randrange(10**6)): rng.randrange(1, 10**6)
+               for _ in range(500)}
+    mapping['P12345'] = 2836
+    with gzip.open(str(tmp_path / 'prot.accession2taxid.gz'), mode='wt') as f:
+        print('accession\taccession.version\ttaxid\tgi', file=f)
+        for accession, taxid in mapping.items():
+            print('{0}\t{0}.1\t{1}\t0'.format(accession, taxid), file=f)
+        #  Repeated accession in a later run, the first one is used
+        print('P12345\tP12345.2\t1\t0', file=f)
+    #  Several runs to be merged
+    build_accession_index(str(tmp_path / 'prot.accession2taxid.gz'),
+                          str(tmp_path / 'index'), chunk_size=64)
+    index = AccessionIndex(str(tmp_path / 'index'))
+    assert len(index) == len(mapping) + 1
+    assert list(index.keys) == sorted([x.encode() for x in mapping] +
+                                      [b'P12345'])
+    queries = list(mapping.keys())
+    rng.shuffle(queries)
+    assert index.lookup_many([x + '.2' for x in queries]).tolist() == \
+        [mapping[x] for x in queries]
+    assert index.lookup('P12345.3') == 2836
+    assert index.lookup('XP_0000001234567') is None
+    assert 'P12345' in index and 'Q00000' not in index
+    assert get_taxids(['P12345.1', 'Q00000.1', 'WP_1'], index) == \
+        {'P12345': 2836}
+    groups = [queries[i:i + rng.randint(1, 10)] + ['Q00000']
+              for i in range(0, len(queries), 7)]
+    prefetched = list(prefetch_taxids(iter(groups), lambda: index,
+                                      batch_size=4, lookahead=1))
+    assert [x[0] for x in prefetched] == groups
+    for group, acc2taxid in prefetched:
+        assert {x: acc2taxid.get(x) for x in group} == \
+            {x: mapping.get(x) for x in group}
+    #  Early exit doesn't hang, and errors reach the consumer
+    next(prefetch_taxids(iter(groups), lambda: index, batch_size=1,
+                         lookahead=1))
+    with pytest.raises(AttributeError):
+        list(prefetch_taxids(iter(groups), lambda: None))
+
+    class Connection:
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    class Cursor:
+        connection = Connection()
+
+        def execute(self, query, values):
+            self.result = [(x, mapping[x]) for x in values if x in mapping]
+
+        def fetchall(self):
+            return self.result
+
+    cursor = Cursor()
+    assert [x[0] for x in prefetch_taxids(iter(groups), lambda: cursor,
+                                          batch_size=4)] == groups
+    assert cursor.connection.closed
+
+    class Interrupt(BaseException):
+        pass
+
+    def interrupted():
+        yield groups[0]
+        raise Interrupt()
+
+    with pytest.raises(Interrupt):
+        list(prefetch_taxids(interrupted(), lambda: index))
+
+
 def test_taxa_descent():
     #  All mySQL tests are kept in a single function to avoid lengthy creation
     #  of a connection for every test I need to run.